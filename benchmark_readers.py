@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""Compare the xml readers import_wikipedia can split a dump with.
+
+Each reader runs in a fresh process over the same (sample) dump, so the peak memory reported is that of the
+reader alone. Only splitting is measured, not parsing the wikitext, since that cost is the same for all of them.
+"""
+
+import argparse
+import multiprocessing
+import resource
+import time
+
+from import_wikipedia import READ_BLOCK_SIZE, READERS, iter_pages, open_dump
+
+
+def run_reader(reader, dump, limit):
+    """Returns (pages, bytes of wikitext, seconds, peak rss in MB) for splitting dump with reader."""
+    chunks = open_dump(dump, block_size=0 if reader == 'sax' else READ_BLOCK_SIZE)
+    pages = 0
+    text_size = 0
+    start = time.time()
+    for _, _, text in iter_pages(chunks, reader=reader):
+        pages += 1
+        text_size += len(text)
+        if limit and pages >= limit:
+            break
+    elapsed = time.time() - start
+    # ru_maxrss is in kilobytes on linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return pages, text_size, elapsed, peak_rss
+
+
+def main(dump, readers, limit):
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for reader in readers:
+        with context.Pool(1) as pool:
+            results[reader] = pool.apply(run_reader, (reader, dump, limit))
+        pages, text_size, elapsed, peak_rss = results[reader]
+        print('%-10s pages: %8d  pages/sec: %9.1f  peak rss: %7.1f MB' % (
+            reader, pages, pages / max(elapsed, 1e-9), peak_rss))
+    if len({result[:2] for result in results.values()}) > 1:
+        print('the readers disagree on the number or size of the pages!')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the xml readers on a wikipedia dump')
+    parser.add_argument('--readers', type=str, default=','.join(sorted(READERS)), help='comma separated readers')
+    parser.add_argument('--limit', type=int, default=0, help='stop after this many pages, 0 for all')
+    parser.add_argument('dump', type=str, help='BZipped wikipedia dump')
+
+    args = parser.parse_args()
+    main(args.dump, args.readers.split(','), args.limit)
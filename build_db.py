@@ -16,6 +16,8 @@ from urllib.parse import unquote
 
 import requests
 
+import instrument
+
 ENDPOINT = "https://qlever.cs.uni-freiburg.de/api/wikidata"
 USER_AGENT = "WikiPeopleImporter/1.0 (https://douwe.com; douwe.osinga@gmail.com)"
 DEFAULT_DB = Path(__file__).parent / "static" / "wikipeople.db"
@@ -181,13 +183,15 @@ def row_for_db(b):
 
 def fetch(query, timeout):
     for attempt in range(4):
-        r = requests.get(
-            ENDPOINT,
-            params={"query": query, "format": "json"},
-            headers={"User-Agent": USER_AGENT,
-                     "Accept": "application/sparql-results+json"},
-            timeout=timeout,
-        )
+        with instrument.stage("sparql"):
+            r = requests.get(
+                ENDPOINT,
+                params={"query": query, "format": "json"},
+                headers={"User-Agent": USER_AGENT,
+                         "Accept": "application/sparql-results+json"},
+                timeout=timeout,
+            )
+        instrument.count("sparql", 1, len(r.content))
         if r.status_code == 429:
             wait = int(r.headers.get("Retry-After", 30))
             print(f"  rate-limited; sleeping {wait}s", file=sys.stderr)
@@ -223,13 +227,15 @@ INSERT OR REPLACE INTO person (
 def import_bucket(conn, bucket, query, timeout):
     bindings = fetch(query, timeout)
     rows = [row_for_db(b) for b in bindings]
-    conn.executemany(INSERT_SQL, rows)
-    conn.execute(
-        "INSERT OR REPLACE INTO import_progress (bucket, imported_at, row_count) "
-        "VALUES (?, datetime('now'), ?)",
-        (bucket, len(rows)),
-    )
-    conn.commit()
+    with instrument.stage("insert"):
+        conn.executemany(INSERT_SQL, rows)
+        conn.execute(
+            "INSERT OR REPLACE INTO import_progress (bucket, imported_at, row_count) "
+            "VALUES (?, datetime('now'), ?)",
+            (bucket, len(rows)),
+        )
+        conn.commit()
+    instrument.count("insert", len(rows))
     return len(rows)
 
 
@@ -264,25 +270,27 @@ def main():
                         help="re-import buckets already recorded")
     parser.add_argument("--only", type=int,
                         help="import just this one year (handy for testing)")
+    instrument.add_arguments(parser)
     args = parser.parse_args()
 
-    db_path = Path(args.db)
-    db_path.parent.mkdir(parents=True, exist_ok=True)
-    conn = sqlite3.connect(db_path)
-    conn.executescript(SCHEMA)
+    with instrument.instrumented("build_db", args.profile, args.stats):
+        db_path = Path(args.db)
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(db_path)
+        conn.executescript(SCHEMA)
 
-    done = set()
-    if not args.force:
-        done = {r[0] for r in conn.execute("SELECT bucket FROM import_progress")}
+        done = set()
+        if not args.force:
+            done = {r[0] for r in conn.execute("SELECT bucket FROM import_progress")}
 
-    years = [args.only] if args.only else range(args.start, args.end + 1)
-    for year in years:
-        if str(year) in done:
-            continue
-        import_year(conn, year, args.timeout)
-        time.sleep(args.throttle)
+        years = [args.only] if args.only else range(args.start, args.end + 1)
+        for year in years:
+            if str(year) in done:
+                continue
+            import_year(conn, year, args.timeout)
+            time.sleep(args.throttle)
 
-    conn.close()
+        conn.close()
 
 
 if __name__ == "__main__":
@@ -4,6 +4,9 @@
 Collects every QID referenced in the person table (gender, occupation, field,
 manner-of-death, place-of-birth, place-of-death) and asks QLever for its
 English label. Resumable: only QIDs without a label are queried.
+
+With --label_store the labels come from a store built from a local wikidata
+dump by label_store.py instead, without touching the network.
 """
 
 import argparse
@@ -14,6 +17,9 @@ from pathlib import Path
 
 import requests
 
+import instrument
+from name_map import NameMap
+
 ENDPOINT = "https://qlever.cs.uni-freiburg.de/api/wikidata"
 USER_AGENT = "WikiPeopleImporter/1.0 (https://douwe.com; douwe.osinga@gmail.com)"
 DEFAULT_DB = Path(__file__).parent / "static" / "wikipeople.db"
@@ -58,13 +64,15 @@ def fetch_labels(qids):
     values = " ".join(f"wd:{q}" for q in qids)
     query = QUERY_TMPL % values
     for attempt in range(4):
-        r = requests.post(
-            ENDPOINT,
-            data={"query": query},
-            headers={"User-Agent": USER_AGENT,
-                     "Accept": "application/sparql-results+json"},
-            timeout=180,
-        )
+        with instrument.stage("sparql"):
+            r = requests.post(
+                ENDPOINT,
+                data={"query": query},
+                headers={"User-Agent": USER_AGENT,
+                         "Accept": "application/sparql-results+json"},
+                timeout=180,
+            )
+        instrument.count("sparql", 1, len(r.content))
         if r.status_code == 429:
             wait = int(r.headers.get("Retry-After", 30))
             print(f"  rate-limited; sleeping {wait}s", file=sys.stderr)
@@ -84,45 +92,68 @@ def fetch_labels(qids):
     raise RuntimeError("repeated SPARQL failures")
 
 
+def store_labels(qids, store):
+    out = {}
+    for q in qids:
+        label = store.get(q)
+        if label is not None:
+            out[q] = label
+    return out
+
+
 def main():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument("--db", default=str(DEFAULT_DB))
     parser.add_argument("--throttle", type=float, default=0.3)
     parser.add_argument("--force", action="store_true",
                         help="re-fetch even QIDs already labelled")
+    parser.add_argument("--label_store",
+                        help="look the labels up in this store built by label_store.py rather than online")
+    instrument.add_arguments(parser)
     args = parser.parse_args()
 
-    conn = sqlite3.connect(args.db)
-    conn.executescript(SCHEMA)
-
-    print("Collecting QIDs from person table ...", flush=True)
-    needed = collect_qids(conn)
-    print(f"  {len(needed)} distinct QIDs referenced", flush=True)
-
-    if not args.force:
-        have = {r[0] for r in conn.execute("SELECT qid FROM qid_label")}
-        needed -= have
-        print(f"  {len(needed)} still need a label", flush=True)
-
-    needed = sorted(needed)
-    for i in range(0, len(needed), BATCH_SIZE):
-        chunk = needed[i:i + BATCH_SIZE]
-        try:
-            labels = fetch_labels(chunk)
-        except RuntimeError as e:
-            print(f"  batch {i}: {e} — skipping", file=sys.stderr)
-            continue
-        conn.executemany(
-            "INSERT OR REPLACE INTO qid_label (qid, label) VALUES (?, ?)",
-            labels.items(),
-        )
-        conn.commit()
-        print(f"  {i + len(chunk)} / {len(needed)}  (+{len(labels)} labels)",
-              flush=True)
-        time.sleep(args.throttle)
-
-    print("done.")
-    conn.close()
+    with instrument.instrumented("build_labels", args.profile, args.stats):
+        conn = sqlite3.connect(args.db)
+        conn.executescript(SCHEMA)
+
+        print("Collecting QIDs from person table ...", flush=True)
+        needed = collect_qids(conn)
+        print(f"  {len(needed)} distinct QIDs referenced", flush=True)
+
+        if not args.force:
+            have = {r[0] for r in conn.execute("SELECT qid FROM qid_label")}
+            needed -= have
+            print(f"  {len(needed)} still need a label", flush=True)
+
+        store = NameMap.load(args.label_store) if args.label_store else None
+        needed = sorted(needed)
+        for i in range(0, len(needed), BATCH_SIZE):
+            chunk = needed[i:i + BATCH_SIZE]
+            try:
+                if store is not None:
+                    with instrument.stage("label store"):
+                        labels = store_labels(chunk, store)
+                else:
+                    labels = fetch_labels(chunk)
+            except RuntimeError as e:
+                print(f"  batch {i}: {e} — skipping", file=sys.stderr)
+                continue
+            with instrument.stage("insert"):
+                conn.executemany(
+                    "INSERT OR REPLACE INTO qid_label (qid, label) VALUES (?, ?)",
+                    labels.items(),
+                )
+                conn.commit()
+            instrument.count("insert", len(labels))
+            print(f"  {i + len(chunk)} / {len(needed)}  (+{len(labels)} labels)",
+                  flush=True)
+            if store is None:
+                time.sleep(args.throttle)
+
+        print("done.")
+        if store is not None:
+            store.close()
+        conn.close()
 
 
 if __name__ == "__main__":
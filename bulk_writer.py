@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""Buffered COPY-based writer shared by the postgres importers.
+
+Rows are collected in memory and streamed to postgres with COPY ... FROM STDIN once batch_size of them have
+piled up. Inserting one row at a time costs a round trip per row, which adds up to days for a full import.
+
+When on_conflict is given, batches are copied into a temporary table first and merged into the target table
+with INSERT ... SELECT ... ON CONFLICT <on_conflict>, since COPY itself has no way to skip or update duplicates.
+Use 'DO NOTHING' to skip them or upsert_clause() to overwrite them.
+"""
+
+import io
+import json
+from collections import namedtuple
+
+import instrument
+
+DEFAULT_BATCH_SIZE = 10000
+
+NULL = '\\N'
+COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+class GeoPoint(namedtuple('GeoPoint', ['lng', 'lat'])):
+    """A value for a GEOGRAPHY(POINT,4326) column."""
+
+
+def geo_point(lng, lat):
+    if lng is None or lat is None:
+        return None
+    return GeoPoint(lng, lat)
+
+
+def encode_array_element(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return repr(value)
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def encode_value(value):
+    """Encode a python value as a field in postgres' COPY text format."""
+    if value is None:
+        return NULL
+    if isinstance(value, GeoPoint):
+        return 'SRID=4326;POINT(%r %r)' % (float(value.lng), float(value.lat))
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, (bytes, bytearray)):
+        # bytea in hex format, with the backslash escaped for COPY
+        return '\\\\x' + value.hex()
+    if isinstance(value, (list, tuple)):
+        value = '{' + ','.join(encode_array_element(x) for x in value) + '}'
+    elif isinstance(value, dict):
+        value = json.dumps(value)
+    return str(value).translate(COPY_ESCAPES)
+
+
+def encode_row(row):
+    return '\t'.join(encode_value(value) for value in row) + '\n'
+
+
+def upsert_clause(key, columns):
+    """ON CONFLICT clause that overwrites all columns but key of an existing row."""
+    updates = ', '.join('%s = excluded.%s' % (column, column) for column in columns if column != key)
+    return '(%s) DO UPDATE SET %s' % (key, updates)
+
+
+class BulkWriter:
+    def __init__(self, cursor, table, columns, batch_size=DEFAULT_BATCH_SIZE, on_conflict=None, after_merge=()):
+        """after_merge are statements to run after each merged batch, they can refer to the batch as {copy_table}."""
+        self._cursor = cursor
+        self._table = table
+        self._columns = ', '.join(columns)
+        self._batch_size = batch_size
+        self._on_conflict = on_conflict
+        self._after_merge = after_merge
+        self._rows = []
+        self.count = 0
+        self._copy_table = None
+        if on_conflict:
+            self._copy_table = 'copy_' + table
+            cursor.execute('DROP TABLE IF EXISTS %s' % self._copy_table)
+            cursor.execute('CREATE TEMP TABLE %s (LIKE %s INCLUDING DEFAULTS)' % (self._copy_table, table))
+
+    def add(self, row):
+        self._rows.append(encode_row(row))
+        if len(self._rows) >= self._batch_size:
+            self.flush()
+
+    def merge(self):
+        self._cursor.execute(
+            'INSERT INTO %s (%s) SELECT %s FROM %s ON CONFLICT %s'
+            % (self._table, self._columns, self._columns, self._copy_table, self._on_conflict)
+        )
+        for sql in self._after_merge:
+            self._cursor.execute(sql.format(copy_table=self._copy_table))
+
+    def flush(self):
+        if not self._rows:
+            return
+        data = ''.join(self._rows)
+        target = self._copy_table or self._table
+        with instrument.stage('copy ' + self._table):
+            if self._copy_table:
+                self._cursor.execute('TRUNCATE %s' % self._copy_table)
+            self._cursor.copy_expert('COPY %s (%s) FROM STDIN' % (target, self._columns), io.StringIO(data))
+            if self._copy_table:
+                self.merge()
+        instrument.count('copy ' + self._table, len(self._rows), len(data))
+        self.count += len(self._rows)
+        self._rows = []
+
+    def close(self):
+        self.flush()
+        if self._copy_table:
+            self._cursor.execute('DROP TABLE IF EXISTS %s' % self._copy_table)
+            self._copy_table = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+import unittest
+
+from bulk_writer import BulkWriter, encode_row, encode_value, geo_point, upsert_clause
+
+
+class FakeCursor:
+    def __init__(self):
+        self.statements = []
+        self.copied = []
+
+    def execute(self, sql, params=None):
+        self.statements.append(sql)
+
+    def copy_expert(self, sql, data):
+        self.statements.append(sql)
+        self.copied.append(data.read())
+
+
+class TestBulkWriter(unittest.TestCase):
+    def test_encode_value(self):
+        self.assertEqual(encode_value(None), '\\N')
+        self.assertEqual(encode_value(12), '12')
+        self.assertEqual(encode_value(True), 't')
+        self.assertEqual(encode_value('tab\there\nback\\slash'), 'tab\\there\\nback\\\\slash')
+        self.assertEqual(encode_value(['a', 'say "hi"', None]), '{"a","say \\\\"hi\\\\"",NULL}')
+        self.assertEqual(encode_value([]), '{}')
+        self.assertEqual(encode_value({'color': ['Red', 'White']}), '{"color": ["Red", "White"]}')
+        self.assertEqual(encode_value(b'\x01\xff'), '\\\\x01ff')
+        self.assertEqual(encode_value(geo_point(4.9, 52.4)), 'SRID=4326;POINT(4.9 52.4)')
+        self.assertEqual(geo_point(None, 52.4), None)
+
+    def test_encode_row(self):
+        self.assertEqual(encode_row(('Socrates', None, 3)), 'Socrates\t\\N\t3\n')
+
+    def test_batches(self):
+        cursor = FakeCursor()
+        with BulkWriter(cursor, 'wikistats', ('title', 'viewcount'), batch_size=2) as writer:
+            for row in ('a', 1), ('b', 2), ('c', 3):
+                writer.add(row)
+        self.assertEqual(cursor.copied, ['a\t1\nb\t2\n', 'c\t3\n'])
+        self.assertEqual(writer.count, 3)
+        self.assertEqual(cursor.statements[0], 'COPY wikistats (title, viewcount) FROM STDIN')
+
+    def test_on_conflict_do_nothing(self):
+        cursor = FakeCursor()
+        writer = BulkWriter(cursor, 'wikipedia', ('title', 'wiki_id'), on_conflict='DO NOTHING')
+        writer.add(('Anarchism', 12))
+        writer.close()
+        self.assertIn('COPY copy_wikipedia (title, wiki_id) FROM STDIN', cursor.statements)
+        self.assertIn(
+            'INSERT INTO wikipedia (title, wiki_id) SELECT title, wiki_id FROM copy_wikipedia ON CONFLICT DO NOTHING',
+            cursor.statements,
+        )
+
+    def test_upsert(self):
+        cursor = FakeCursor()
+        columns = ('title', 'wiki_id', 'infobox')
+        writer = BulkWriter(
+            cursor,
+            'wikipedia',
+            columns,
+            on_conflict=upsert_clause('title', columns),
+            after_merge=['DELETE FROM wikipedia_redirect USING {copy_table} c WHERE from_title = c.title'],
+        )
+        writer.add(('Anarchism', 12, None))
+        writer.close()
+        self.assertIn(
+            'INSERT INTO wikipedia (title, wiki_id, infobox) SELECT title, wiki_id, infobox FROM copy_wikipedia '
+            'ON CONFLICT (title) DO UPDATE SET wiki_id = excluded.wiki_id, infobox = excluded.infobox',
+            cursor.statements,
+        )
+        self.assertIn('DELETE FROM wikipedia_redirect USING copy_wikipedia c WHERE from_title = c.title', cursor.statements)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+"""Decompress the dumps, in parallel where the file allows it.
+
+bzcat and zcat use a single core and go strictly in order. The multistream wikipedia dumps, the wikidata dumps
+and any file made by concatenating compressed files consist of independent bz2 streams or gzip members, which can
+be decompressed side by side. open_compressed cuts the file into segments of about segment_size at stream
+boundaries, found by their magic bytes, and decompresses those in a pool of threads (bz2 and zlib let go of the
+GIL while they work), handing the output back in order with at most a few segments in flight per worker.
+
+A segment that isn't a clean sequence of whole streams, because the magic bytes turned up inside the compressed
+data, is caught when it is decompressed; from there on the rest of the file is read serially. The same goes for
+a file that has no next stream within MAX_STREAM_SIZE, like a regular single stream bz2 file, so those are
+decompressed by bzcat or zcat exactly like before.
+"""
+
+import argparse
+import bz2
+import functools
+import gzip
+import os
+import re
+import subprocess
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_SEGMENT_SIZE = 8 * 1024 * 1024
+# how far past a cut we look for the next stream before deciding the file isn't split up in streams
+MAX_STREAM_SIZE = 64 * 1024 * 1024
+SCAN_SIZE = 1024 * 1024
+# segments queued per worker
+IN_FLIGHT = 2
+# a gzip magic is only three bytes and turns up in compressed data; this much has to inflate before we believe it
+GZIP_CHECK_SIZE = 64 * 1024
+
+
+class Format:
+    def __init__(self, magic, command, decompress, stream_re, plausible=None):
+        self.magic = magic
+        self.command = command
+        self.decompress = decompress
+        self.stream_re = stream_re
+        self.plausible = plausible
+
+
+def plausible_gzip(data):
+    try:
+        zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data)
+    except zlib.error:
+        return False
+    return True
+
+
+# a bz2 stream starts with BZh and the block size, followed by the magic of its first block
+BZ2 = Format(b'BZh', 'bzcat', bz2.decompress, re.compile(rb'BZh[1-9]1AY&SY'))
+# a gzip member starts with the magic, deflate as the method and flags with the reserved bits clear
+GZIP = Format(b'\x1f\x8b', 'zcat', gzip.decompress, re.compile(rb'\x1f\x8b\x08[\x00-\x1f]'), plausible_gzip)
+
+
+def detect_format(path, offset=0):
+    with open(path, 'rb') as fin:
+        fin.seek(offset)
+        head = fin.read(4)
+    for fmt in BZ2, GZIP:
+        if head.startswith(fmt.magic):
+            return fmt
+    raise ValueError('%s is neither bz2 nor gzip' % path)
+
+
+def find_stream(fin, fmt, start, limit):
+    """The offset of the first stream starting at or after start and before limit, or None."""
+    overlap = 16
+    pos = start
+    while pos < limit:
+        fin.seek(pos)
+        data = fin.read(min(SCAN_SIZE, limit - pos) + overlap)
+        if not data:
+            return None
+        for m in fmt.stream_re.finditer(data):
+            if fmt.plausible is None:
+                return pos + m.start()
+            fin.seek(pos + m.start())
+            if fmt.plausible(fin.read(GZIP_CHECK_SIZE)):
+                return pos + m.start()
+        pos += SCAN_SIZE
+    return None
+
+
+def iter_segments(path, fmt, offset=0, segment_size=DEFAULT_SEGMENT_SIZE):
+    """Yield (start, end) of runs of whole streams of about segment_size. end is None for a rest that couldn't
+    be split, which has to be read serially."""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as fin:
+        start = offset
+        while start < size:
+            if start + segment_size >= size:
+                yield start, size
+                return
+            end = find_stream(fin, fmt, start + segment_size, min(size, start + segment_size + MAX_STREAM_SIZE))
+            if end is None:
+                yield start, None
+                return
+            yield start, end
+            start = end
+
+
+def decompress_segment(path, fmt, start, end):
+    """The decompressed segment, or None if it isn't a sequence of whole streams."""
+    with open(path, 'rb') as fin:
+        fin.seek(start)
+        data = fin.read(end - start)
+    try:
+        return fmt.decompress(data)
+    except (OSError, EOFError, ValueError, zlib.error):
+        return None
+
+
+def serial(path, fmt, offset=0, block_size=0):
+    """What bzcat or zcat make of path from offset on, as lines or blocks of block_size."""
+    fin = open(path, 'rb')
+    fin.seek(offset)
+    stdout = subprocess.Popen([fmt.command], stdin=fin, stdout=subprocess.PIPE).stdout
+    return iter(functools.partial(stdout.read, block_size), b'') if block_size else stdout
+
+
+def parallel_blocks(path, fmt, offset, workers, segment_size):
+    with ThreadPoolExecutor(workers) as executor:
+        pending = deque()
+        segments = iter_segments(path, fmt, offset, segment_size)
+        rest = None
+        while True:
+            while rest is None and len(pending) < workers * IN_FLIGHT:
+                start, end = next(segments, (None, None))
+                if start is None:
+                    break
+                if end is None:
+                    rest = start
+                    break
+                pending.append((start, executor.submit(decompress_segment, path, fmt, start, end)))
+            if not pending:
+                break
+            start, future = pending.popleft()
+            data = future.result()
+            if data is None:
+                for _, queued in pending:
+                    queued.cancel()
+                rest = start
+                break
+            yield data
+    if rest is not None:
+        yield from serial(path, fmt, rest, SCAN_SIZE)
+
+
+def iter_lines(blocks):
+    """Lines, newline included, from an iterator of byte blocks."""
+    rest = b''
+    for block in blocks:
+        lines = (rest + block).split(b'\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if rest:
+        yield rest
+
+
+def open_compressed(path, offset=0, block_size=0, workers=1, segment_size=DEFAULT_SEGMENT_SIZE):
+    """The decompressed contents of the bz2 or gzip file at path, starting with the stream at offset, as lines or,
+    with block_size, as blocks (of about that size when read serially). With more than one worker the streams are
+    decompressed in parallel, see the module docstring."""
+    fmt = detect_format(path, offset)
+    if workers <= 1:
+        return serial(path, fmt, offset, block_size)
+    with open(path, 'rb') as fin:
+        probe = find_stream(fin, fmt, offset + 1, offset + segment_size + MAX_STREAM_SIZE)
+    if probe is None:
+        print('%s is not split in streams, decompressing it serially' % path)
+        return serial(path, fmt, offset, block_size)
+    blocks = parallel_blocks(path, fmt, offset, workers, segment_size)
+    return blocks if block_size else iter_lines(blocks)
+
+
+def benchmark(path, worker_counts, limit=0):
+    """Print the decompressed MB/s for each number of workers, 1 being bzcat or zcat."""
+    results = {}
+    for workers in worker_counts:
+        start = time.time()
+        size = 0
+        for block in open_compressed(path, block_size=SCAN_SIZE, workers=workers):
+            size += len(block)
+            if limit and size >= limit:
+                break
+        elapsed = time.time() - start
+        results[workers] = size / 1e6 / max(elapsed, 1e-9)
+        print('workers: %3d  %10.1f MB  %8.1f MB/s' % (workers, size / 1e6, results[workers]))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark decompressing a dump with a number of workers')
+    parser.add_argument('--workers', type=str, default='1,2,4,8', help='comma separated worker counts to try')
+    parser.add_argument('--limit', type=int, default=0, help='stop after this many decompressed bytes, 0 for all')
+    parser.add_argument('dump', type=str, help='bz2 or gzip file')
+
+    args = parser.parse_args()
+    benchmark(args.dump, [int(workers) for workers in args.workers.split(',')], args.limit)
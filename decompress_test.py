@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+import bz2
+import gzip
+import os
+import tempfile
+import unittest
+
+from decompress import BZ2, GZIP, iter_lines, iter_segments, open_compressed
+
+TEXT = b''.join(b'line %d of the dump\n' % i for i in range(20000))
+PARTS = [TEXT[i : i + 20000] for i in range(0, len(TEXT), 20000)]
+
+
+class TestDecompress(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, data):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, 'wb') as fout:
+            fout.write(data)
+        return path
+
+    def check(self, path, workers=3):
+        self.assertEqual(list(open_compressed(path, workers=workers, segment_size=4096)), TEXT.splitlines(True))
+        blocks = open_compressed(path, block_size=1000, workers=workers, segment_size=4096)
+        self.assertEqual(b''.join(blocks), TEXT)
+
+    def test_multistream(self):
+        for name, compress in ('dump.bz2', bz2.compress), ('dump.gz', gzip.compress):
+            path = self.write(name, b''.join(compress(part) for part in PARTS))
+            self.check(path, workers=1)
+            self.check(path)
+
+    def test_segments(self):
+        streams = [bz2.compress(part) for part in PARTS]
+        path = self.write('dump.bz2', b''.join(streams))
+        segments = list(iter_segments(path, BZ2, segment_size=1))
+        self.assertEqual(len(segments), len(streams))
+        self.assertEqual(segments[1][0], len(streams[0]))
+        # starting at the second stream, like a resumed import
+        offset = len(streams[0])
+        self.assertEqual(b''.join(open_compressed(path, offset, 1000, workers=2, segment_size=4096)), TEXT[20000:])
+
+    def test_single_stream(self):
+        self.check(self.write('dump.bz2', bz2.compress(TEXT)))
+        self.check(self.write('dump.gz', gzip.compress(TEXT)))
+
+    def test_false_boundary(self):
+        # stored, the inner gzip file shows up verbatim and looks like the start of a member
+        inner = gzip.compress(b'not a member of its own\n')
+        path = self.write('dump.gz', gzip.compress(TEXT[:50000] + inner + TEXT[50000:], compresslevel=0))
+        self.assertGreater(len(list(iter_segments(path, GZIP, segment_size=4096))), 1)
+        expected = TEXT[:50000] + inner + TEXT[50000:]
+        self.assertEqual(b''.join(open_compressed(path, block_size=1000, workers=3, segment_size=4096)), expected)
+
+    def test_iter_lines(self):
+        self.assertEqual(list(iter_lines([b'a\nb', b'c\n', b'', b'd'])), [b'a\n', b'bc\n', b'd'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""Fast path for the bits of wikitext import_wikipedia needs: template names, category links and coordinates.
+
+A full mwparserfromhell parse builds a node tree for every page, while we only look at template names, the
+titles of [[Category:...]] links and the parameters of the first usable coord template. extract finds those by
+pairing up {{ }} and [[ ]] with a regex scan. Whenever it runs into something mwparserfromhell might read
+differently (argument braces, odd runs of brackets, tags whose content isn't parsed, comments or markup inside
+names) it gives up and returns None, so the caller can fall back to the full parse.
+
+Run as a script over a (sample) dump to compare the two paths: it reports the speedup, the fallback rate and
+any pages where the output differs.
+"""
+
+import argparse
+import re
+import subprocess
+import time
+from collections import OrderedDict
+
+import mwparserfromhell
+
+CAT_PREFIX = 'Category:'
+
+TOKEN_RE = re.compile(r'\{\{|\}\}|\[\[|\]\]')
+# three or more opening braces are template arguments or ambiguous nestings, odd runs of closing ones likewise
+UNSURE_RE = re.compile(r'\{\{\{|\[\[\[|(?<!\})\}\}\}(\}\})*(?!\})|(?<!\])\]\]\](\]\])*(?!\])')
+COMMENT_RE = re.compile(r'<!--.*?-->', re.DOTALL)
+BLACKLIST_TAG_RE = re.compile(
+    r'<\s*/?\s*(%s|includeonly|noinclude|onlyinclude)\b' % '|'.join(mwparserfromhell.definitions.PARSER_BLACKLIST),
+    re.IGNORECASE,
+)
+# comments are blanked out with this rather than removed, so offsets into the original text stay valid
+COMMENT_FILL = '\x00'
+# '' starts bold or italic markup, which mwparserfromhell strips from template names
+BAD_NAME_CHARS = re.compile("[\n{}\\[\\]<>&\x00]|''")
+BAD_LINK_CHARS = re.compile('[\n{}\\[\\]<>\x00]|://')
+
+
+def blank_comments(text):
+    if '<!--' not in text:
+        return text
+    text = COMMENT_RE.sub(lambda m: COMMENT_FILL * len(m.group()), text)
+    if '<!--' in text:
+        # an unterminated comment
+        return None
+    return text
+
+
+def pair_brackets(text):
+    """Return (start, end) pairs for templates and for wikilinks, or None if the brackets don't pair up."""
+    templates = []
+    wikilinks = []
+    stack = []
+    for m in TOKEN_RE.finditer(text):
+        token = m.group()
+        if token == '{{' or token == '[[':
+            stack.append((token, m.start()))
+            continue
+        if not stack:
+            return None
+        opener, start = stack.pop()
+        if token == '}}' and opener == '{{':
+            templates.append((start, m.end()))
+        elif token == ']]' and opener == '[[':
+            wikilinks.append((start, m.end()))
+        else:
+            return None
+    if stack:
+        return None
+    templates.sort()
+    wikilinks.sort()
+    return templates, wikilinks
+
+
+def inner_head(text, start, end):
+    """The part of [[...]] or {{...}} before the first pipe."""
+    pipe = text.find('|', start + 2, end - 2)
+    if pipe == -1:
+        pipe = end - 2
+    return text[start + 2 : pipe]
+
+
+def extract(text):
+    """Return (template_dict, category_titles) for text, or None if it needs a full mwparserfromhell parse.
+
+    template_dict maps stripped template names to the source of the (last) template with that name in document
+    order, the same way import_wikipedia builds it from mwparserfromhell templates. category_titles are the
+    titles of the Category links with the prefix removed.
+    """
+    if UNSURE_RE.search(text) or BLACKLIST_TAG_RE.search(text):
+        return None
+    scan = blank_comments(text)
+    if scan is None:
+        return None
+    paired = pair_brackets(scan)
+    if paired is None:
+        return None
+    templates, wikilinks = paired
+
+    template_dict = OrderedDict()
+    for start, end in templates:
+        name = inner_head(scan, start, end).strip()
+        if not name or BAD_NAME_CHARS.search(name):
+            return None
+        template_dict[name] = text[start:end]
+
+    category_titles = []
+    for start, end in wikilinks:
+        title = inner_head(scan, start, end)
+        if title.startswith(CAT_PREFIX):
+            if BAD_LINK_CHARS.search(title):
+                return None
+            category_titles.append(title[len(CAT_PREFIX) :])
+    return template_dict, category_titles
+
+
+def as_template(template):
+    """The fast path hands back template source; turn it into a mwparserfromhell template when it is needed."""
+    if isinstance(template, str):
+        return mwparserfromhell.parse(template).filter_templates(recursive=False)[0]
+    return template
+
+
+def compare(dump, limit):
+    from import_wikipedia import iter_pages, parse_page
+
+    pages = []
+    for page in iter_pages(subprocess.Popen(['bzcat'], stdin=open(dump), stdout=subprocess.PIPE).stdout):
+        pages.append(page)
+        if limit and len(pages) >= limit:
+            break
+
+    start = time.time()
+    slow = [parse_page(page) for page in pages]
+    slow_time = time.time() - start
+    start = time.time()
+    fast = [parse_page(page, fast=True) for page in pages]
+    fast_time = time.time() - start
+    fallbacks = sum(1 for _, _, text in pages if extract(text) is None)
+
+    def normalized(row):
+        if row is None:
+            return None
+        return row[:4] + tuple(sorted(x) for x in row[4:7]) + (row[7],)
+
+    differences = 0
+    for page, slow_row, fast_row in zip(pages, slow, fast):
+        if normalized(slow_row) != normalized(fast_row):
+            differences += 1
+            print('difference for:', page[0])
+            print('  mwparserfromhell:', normalized(slow_row))
+            print('  fast path:       ', normalized(fast_row))
+
+    print('pages: %d, fallbacks: %d (%.1f%%), differences: %d' % (
+        len(pages), fallbacks, 100.0 * fallbacks / max(1, len(pages)), differences))
+    print('mwparserfromhell: %.2fs, fast path: %.2fs, speedup: %.1fx' % (
+        slow_time, fast_time, slow_time / max(fast_time, 1e-9)))
+    return differences
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the fast path extractor to mwparserfromhell on a dump')
+    parser.add_argument('--limit', type=int, default=10000, help='number of pages to compare, 0 for all')
+    parser.add_argument('dump', type=str, help='BZipped wikipedia dump')
+
+    args = parser.parse_args()
+    compare(args.dump, args.limit)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+import unittest
+
+from fast_wikitext import extract
+from import_wikipedia import parse_page
+
+ARTICLE = """{{Infobox settlement
+| name = Amsterdam <!-- official: name -->
+| coordinates = {{coord|52|22|N|4|54|E|region:NL|display=inline,title}}
+| population = {{formatnum:872680}}<ref>{{cite web|url=http://example.com|title=Stats}}</ref>
+}}
+'''Amsterdam''' is the [[capital city|capital]] of the [[Netherlands]].
+[[File:Amsterdam.jpg|thumb|The [[Amstel]] in {{date|1900}}]]
+{| class="wikitable"
+|-
+| a || b
+|}
+[[Category:Capitals in Europe]]
+[[Category:Populated places in North Holland|Amsterdam]]
+"""
+
+SNIPPETS = [
+    ARTICLE,
+    '{{a|{{b|{{c}}}}}} [[Category:Nested templates]]',
+    '{{coord|52|22|N<!-- note: north -->|4|54|E}} {{coord|1|2}}',
+    '{{Coord missing|Netherlands}} {{geolinks-bldg|52.1|4.3}}',
+    '{{{argument}}} {{Infobox person}}',
+    '<nowiki>{{not a template}}</nowiki> [[Category:Nowiki]]',
+    '{{a<!--x-->b}} [[Category:Commented]]',
+    '[[Category:Broken\nlink]] [[Category:Good]]',
+    '[[Category:With {{PAGENAME}}]]',
+    '{{unclosed [[Category:Unclosed]]',
+    '{{Infobox person|name=A}} {{INFOBOX Writer}} [[ Category:Spaced]] [[:Category:Linked]]',
+    '<!-- unterminated {{x}}',
+    '{{a&amp;b}} {{#if:x|y}} [[Category:Entities &amp; more]]',
+    "{{'''bold'''}} {{O'Brien}} [[Category:'''Bold''']]",
+]
+
+
+def normalized(row):
+    return row[:4] + tuple(sorted(x) for x in row[4:7]) + (row[7],)
+
+
+class TestFastWikitext(unittest.TestCase):
+    def test_same_as_mwparserfromhell(self):
+        for idx, text in enumerate(SNIPPETS):
+            page = ('Page %d' % idx, '1', text)
+            self.assertEqual(normalized(parse_page(page)), normalized(parse_page(page, fast=True)), text)
+
+    def test_fast_path_taken(self):
+        template_dict, categories = extract(ARTICLE)
+        self.assertEqual(
+            list(template_dict.keys()), ['Infobox settlement', 'coord', 'formatnum:872680', 'cite web', 'date']
+        )
+        self.assertEqual(categories, ['Capitals in Europe', 'Populated places in North Holland'])
+        self.assertTrue(template_dict['coord'].startswith('{{coord|52|22|N'))
+
+    def test_falls_back(self):
+        self.assertIsNone(extract('{{{argument}}}'))
+        self.assertIsNone(extract('<nowiki>{{x}}</nowiki>'))
+        self.assertIsNone(extract('{{a<!--x-->b}}'))
+        self.assertIsNone(extract('{{unclosed'))
+        self.assertIsNone(extract('<!-- unterminated'))
+        self.assertIsNone(extract("{{'''bold'''}}"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,31 +1,180 @@
 #!/usr/bin/env python
 
-from collections import Counter
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
 import argparse
-import subprocess
 import datetime
+import functools
 import calendar
+import heapq
+import itertools
+import multiprocessing
 import random
+import re
+import threading
 import psycopg2
 import requests
 import urllib
 import urllib.parse
+from operator import itemgetter
+
+import instrument
+from bulk_writer import BulkWriter
+from decompress import open_compressed
+from spilling_counter import SpillingCounter, estimated_size
+from staged_load import DEFAULT_INDEX_WORKERS, TableLoad
 
 REMOTE_PATH = 'https://dumps.wikimedia.org/other/pageviews/%(year)04d/%(year)04d-%(month)02d/pageviews-%(year)04d%(month)02d%(day)02d-%(hour)02d0000.gz'
 LOCAL_PATH = 'pagecounts-%(year)04d%(month)02d%(day)02d-%(hour)02d0000.gz'
+LOCAL_PATH_RE = re.compile(r'pagecounts-(\d{4})(\d\d)(\d\d)-(\d\d)0000\.gz$')
+# downloads go here first and are renamed to the real name once complete
+PART_SUFFIX = '.part'
+# the names of the completely downloaded files, one per line
+MANIFEST = 'manifest.txt'
+DEFAULT_CONCURRENCY = 4
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_TIMEOUT = 60
+TOP_COUNT = 25
+# files a worker adds up before handing back its counts; titles recur every hour, so this shrinks what is sent back
+FILES_PER_TASK = 4
+# tasks per worker handed to the pool at a time; the rest wait until the merge has taken in the finished ones
+TASKS_PER_WORKER = 2
+TITLE_CACHE_SIZE = 1 << 20
+
+# titles by the raw, quoted id in the dumps, per process
+_titles = {}
+
+COLUMNS = ('title', 'viewcount')
+TABLE_COLUMNS = '(title TEXT PRIMARY KEY,  viewcount INTEGER)'
+TABLE_INDEXES = [('viewcount', '(viewcount)')]
+# the dumps added by an incremental import
+FILE_TABLE = (
+    'CREATE TABLE IF NOT EXISTS wikistats_file ('
+    '    name TEXT PRIMARY KEY,'
+    '    ingested_at TIMESTAMP NOT NULL DEFAULT now()'
+    ')'
+)
+ADD_FILES = 'INSERT INTO wikistats_file (name) SELECT unnest(%s::TEXT[])'
+# an incremental import adds its counts to those already there
+ADD_VIEWS = '(title) DO UPDATE SET viewcount = wikistats.viewcount + excluded.viewcount'
+
+# with --daily, counts are keyed by title + DAY_SEPARATOR + the yyyymmdd of the dump; NUL can't be in a title in
+# postgres and sorts before anything else, so the keys of a title stay together and in date order
+DAY_SEPARATOR = '\x00'
+DAILY_TABLE = 'wikistats_daily'
+DAILY_COLUMNS = ('title', 'month', 'views')
+# one row per title and month, views[d] holding the views on day d of that month
+DAILY_TABLE_COLUMNS = '(title TEXT, month DATE, views INTEGER[], PRIMARY KEY (title, month))'
+DAILY_TABLE_INDEXES = [('month', '(month)')]
+# both arrays have a slot for every day of the month
+ADD_DAILY_VIEWS = (
+    '(title, month) DO UPDATE SET views = '
+    'ARRAY(SELECT a + b FROM unnest(wikistats_daily.views, excluded.views) AS u(a, b))'
+)
 
+# the views per title for the days from start through end, most viewed first
+WINDOW_SQL = '''
+SELECT d.title, SUM(v.views) AS views
+FROM {table} d, unnest(d.views) WITH ORDINALITY AS v(views, day)
+WHERE d.month BETWEEN date_trunc('month', %(start)s::date)::date AND %(end)s
+  AND d.month + v.day::int - 1 BETWEEN %(start)s AND %(end)s{titles}
+GROUP BY d.title
+ORDER BY views DESC, d.title
+LIMIT %(limit)s
+'''
 
-def setup_db(connection_string):
+# the views of a title per day from start through end
+SERIES_SQL = '''
+SELECT d.month + v.day::int - 1 AS day, v.views
+FROM {table} d, unnest(d.views) WITH ORDINALITY AS v(views, day)
+WHERE d.title = %(title)s
+  AND d.month BETWEEN date_trunc('month', %(start)s::date)::date AND %(end)s
+  AND d.month + v.day::int - 1 BETWEEN %(start)s AND %(end)s
+ORDER BY day
+'''
+
+
+def setup_db(connection_string, staged=False):
     conn = psycopg2.connect(connection_string)
     cursor = conn.cursor()
-    cursor.execute('DROP TABLE IF EXISTS wikistats')
-    cursor.execute('CREATE TABLE wikistats (title TEXT PRIMARY KEY,  viewcount INTEGER)')
-    cursor.execute('CREATE INDEX wikistats_viewcount ON wikistats(viewcount)')
+    load = TableLoad('wikistats', TABLE_COLUMNS, TABLE_INDEXES, staged)
+    load.create(cursor)
+    return conn, cursor, load
+
+
+def setup_daily(cursor, staged=False):
+    daily_load = TableLoad(DAILY_TABLE, DAILY_TABLE_COLUMNS, DAILY_TABLE_INDEXES, staged)
+    daily_load.create(cursor)
+    return daily_load
+
+
+def setup_incremental(connection_string):
+    """Make sure the tables exist without touching what is in them; main_incremental sees to wikistats_daily."""
+    conn = psycopg2.connect(connection_string)
+    cursor = conn.cursor()
+    TableLoad('wikistats', TABLE_COLUMNS, TABLE_INDEXES).ensure(cursor)
+    cursor.execute(FILE_TABLE)
+    conn.commit()
     return conn, cursor
 
 
-def fetch_dumps(dump_dir, dumps_to_fetch):
+def check_incremental(cursor, dump_dir, daily=False, seed_manifest=False):
+    """The dumps in wikistats_file, after checking the tables an incremental import adds to are consistent.
+
+    A wikistats from before wikistats_file existed doesn't say which dumps it holds, so adding to it would count
+    them all again; with seed_manifest the dumps now in dump_dir are taken to be the ones in it. wikistats_daily
+    has to be kept up to date if it exists and can't be started while there are counts without it.
+    """
+    cursor.execute('SELECT name FROM wikistats_file')
+    ingested = {row[0] for row in cursor.fetchall()}
+    cursor.execute('SELECT EXISTS (SELECT 1 FROM wikistats)')
+    has_counts = cursor.fetchone()[0]
+    cursor.execute('SELECT to_regclass(%s) IS NOT NULL', (DAILY_TABLE,))
+    has_daily = cursor.fetchone()[0]
+    if has_daily and not daily:
+        raise ValueError('%s exists and would fall behind, add to it with daily' % DAILY_TABLE)
+    if daily and not has_daily and has_counts:
+        raise ValueError('wikistats has counts without %s, a full import with daily starts it' % DAILY_TABLE)
+    if has_counts and not ingested:
+        if not seed_manifest:
+            raise ValueError(
+                'wikistats has counts but wikistats_file does not list the dumps in them, '
+                'with seed_manifest the dumps in %s are taken to be those' % dump_dir
+            )
+        ingested = {fn for fn in os.listdir(dump_dir) if fn.endswith('.gz')}
+        cursor.execute(ADD_FILES, (sorted(ingested),))
+        print('listed %d dumps as ingested' % len(ingested))
+    if daily:
+        TableLoad(DAILY_TABLE, DAILY_TABLE_COLUMNS, DAILY_TABLE_INDEXES).ensure(cursor)
+    return ingested
+
+
+class Manifest:
+    """The files in dump_dir that were downloaded completely, kept in a text file there."""
+
+    def __init__(self, dump_dir):
+        self.path = os.path.join(dump_dir, MANIFEST)
+        self.done = set()
+        if os.path.exists(self.path):
+            with open(self.path) as fin:
+                self.done = {line.strip() for line in fin if line.strip()}
+        self._lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self.done
+
+    def add(self, name):
+        with self._lock:
+            self.done.add(name)
+            with open(self.path, 'a') as fout:
+                fout.write(name + '\n')
+                fout.flush()
+                os.fsync(fout.fileno())
+
+
+def random_hours(count, skip=()):
+    """count distinct random hours from roughly the last year whose LOCAL_PATH isn't in skip."""
     # don't try anything in the last month, it might not be online yet
     last_date = datetime.datetime.today() - datetime.timedelta(30)
     year = last_date.year
@@ -36,48 +185,367 @@ def fetch_dumps(dump_dir, dumps_to_fetch):
         days = 366
     else:
         days = 365
-    for i in range(dumps_to_fetch):
-        local_path = None
-        remote_path = None
-        while not local_path or os.path.isdir(local_path):
-            random_day = last_date - datetime.timedelta(days=random.randint(1, days))
-            random_hour = random.randint(1, 24)
-            d = {'year': random_day.year, 'month': random_day.month, 'day': random_day.day, 'hour': random_hour}
-            remote_path = REMOTE_PATH % d
-            local_path = os.path.join(dump_dir, LOCAL_PATH % d)
-        print('getting', local_path)
-        data = requests.get(remote_path).content
-        with open(local_path, 'wb') as fout:
-            fout.write(data)
-
-
-def main(dump_dir, cursor, dumps_to_fetch):
+    hours = {}
+    while len(hours) < min(count, days * 24 - len(skip)):
+        random_day = last_date - datetime.timedelta(days=random.randint(1, days))
+        d = {'year': random_day.year, 'month': random_day.month, 'day': random_day.day, 'hour': random.randint(0, 23)}
+        if LOCAL_PATH % d not in skip:
+            hours[LOCAL_PATH % d] = d
+    return list(hours.values())
+
+
+def interrupted_hours(dump_dir):
+    """The hours of the downloads in dump_dir that didn't finish."""
+    hours = []
+    for fn in sorted(os.listdir(dump_dir)):
+        m = fn.endswith(PART_SUFFIX) and LOCAL_PATH_RE.match(fn[: -len(PART_SUFFIX)])
+        if m:
+            year, month, day, hour = map(int, m.groups())
+            hours.append({'year': year, 'month': month, 'day': day, 'hour': hour})
+    return hours
+
+
+_sessions = threading.local()
+
+
+def get_session():
+    """A session per download thread, so connections to the server are reused."""
+    if not hasattr(_sessions, 'session'):
+        _sessions.session = requests.Session()
+    return _sessions.session
+
+
+def download(url, local_path):
+    """Download url to local_path, streaming into local_path + PART_SUFFIX and renaming that when complete.
+
+    If a part is there from an earlier attempt, only the rest is requested. Returns the bytes downloaded.
+    """
+    part_path = local_path + PART_SUFFIX
+    have = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    fetched = 0
+    headers = {'Range': 'bytes=%d-' % have} if have else {}
+    with get_session().get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        if response.status_code == 416:
+            if not have:
+                raise IOError('%s: the server has nothing to send' % url)
+            # the part we have is everything there is
+            expected = have
+        else:
+            response.raise_for_status()
+            if response.status_code != 206:
+                # the server sent all of it after all
+                have = 0
+            length = response.headers.get('Content-Length')
+            expected = have + int(length) if length is not None else None
+            with open(part_path, 'ab' if have else 'wb') as fout:
+                # the bytes as sent; a server that says the .gz files are gzip encoded shouldn't get them unpacked
+                for chunk in response.raw.stream(DOWNLOAD_CHUNK_SIZE, decode_content=False):
+                    fout.write(chunk)
+                    fetched += len(chunk)
+            have += fetched
+    if expected is not None and have != expected:
+        raise IOError('%s: got %d of %d bytes' % (url, have, expected))
+    os.replace(part_path, local_path)
+    return fetched
+
+
+def download_hours(dump_dir, hours, concurrency=DEFAULT_CONCURRENCY, remote_path=REMOTE_PATH, manifest=None):
+    """Download the dumps for hours in concurrency threads, returning the names of those that completed."""
+    manifest = manifest or Manifest(dump_dir)
+    completed = []
+    with instrument.stage('download'), ThreadPoolExecutor(max(1, concurrency)) as executor:
+        futures = {
+            executor.submit(download, remote_path % d, os.path.join(dump_dir, LOCAL_PATH % d)): LOCAL_PATH % d
+            for d in hours
+            if LOCAL_PATH % d not in manifest
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                size = future.result()
+            except (requests.RequestException, IOError) as e:
+                print('failed', name, e)
+                continue
+            manifest.add(name)
+            completed.append(name)
+            instrument.count('download', 1, size)
+            print('got', name, size)
+    return completed
+
+
+def fetch_dumps(dump_dir, dumps_to_fetch, concurrency=DEFAULT_CONCURRENCY, remote_path=REMOTE_PATH):
+    """Fetch dumps_to_fetch random hourly dumps we don't have yet, finishing interrupted downloads first."""
+    manifest = Manifest(dump_dir)
+    hours = interrupted_hours(dump_dir)[:dumps_to_fetch]
+    skip = manifest.done | {LOCAL_PATH % d for d in hours}
+    hours += random_hours(dumps_to_fetch - len(hours), skip)
+    return download_hours(dump_dir, hours, concurrency, remote_path, manifest)
+
+
+def unquote_title(wikipedia_id):
+    """The title for a quoted id from a dump, memoized since the same pages come back hour after hour."""
+    title = _titles.get(wikipedia_id)
+    if title is None:
+        if len(_titles) >= TITLE_CACHE_SIZE:
+            _titles.clear()
+        # what urllib.parse.unquote does with the decoded id, without decoding it first
+        title = urllib.parse.unquote_to_bytes(wikipedia_id).decode('utf8', 'replace').replace('_', ' ')
+        _titles[wikipedia_id] = title
+    return title
+
+
+def count_lines(lines, counts, suffix=''):
+    """Add the views of the English, non-namespaced pages in lines of a dump to counts, keyed by title + suffix.
+
+    Works on the raw bytes, so the lines of the other wikis are dropped without ever being decoded.
+    """
+    for line in lines:
+        if line.startswith(b'en '):
+            bits = line.split(b' ')
+            if len(bits) != 4:
+                continue
+            wikipedia_id = bits[1]
+            if b':' not in wikipedia_id:
+                counts[unquote_title(wikipedia_id) + suffix] += int(bits[2])
+    return counts
+
+
+def day_suffix(path):
+    """DAY_SEPARATOR + the yyyymmdd of the dump at path, or '' if its name doesn't say."""
+    m = LOCAL_PATH_RE.search(path)
+    if not m:
+        print('no date in', path)
+        return ''
+    return DAY_SEPARATOR + ''.join(m.groups()[:3])
+
+
+def count_files(paths, decompress_workers=1, daily=False, max_size=None):
+    """The English page views in the dumps at paths, per day if daily, and the paths that weren't counted.
+
+    With max_size, stops after the dump that takes the counts over about max_size bytes and leaves the rest.
+    """
+    counts = Counter()
+    for idx, path in enumerate(paths):
+        count_lines(open_compressed(path, workers=decompress_workers), counts, day_suffix(path) if daily else '')
+        if max_size and estimated_size(counts) > max_size:
+            return counts, paths[idx + 1 :]
+    return counts, []
+
+
+def map_files(paths, workers=1, decompress_workers=1, daily=False, memory_budget=None):
+    """Yield partial counts for paths, computed by a pool of workers if there is more than one.
+
+    Only TASKS_PER_WORKER tasks per worker are in the pool at a time, so finished counts don't pile up while the
+    merge catches up. With a memory_budget a task stops taking on dumps once its counts pass their share of the
+    budget, and the dumps it didn't get to go into a new task; the partial counts in flight then take about one
+    more memory_budget, or a dump's worth each if single dumps are bigger than that.
+    """
+    window = TASKS_PER_WORKER * workers
+    process = functools.partial(
+        count_files,
+        decompress_workers=decompress_workers,
+        daily=daily,
+        max_size=memory_budget // window if memory_budget else None,
+    )
+    tasks = deque(paths[i : i + FILES_PER_TASK] for i in range(0, len(paths), FILES_PER_TASK))
+    done = 0
+
+    def finished(pool):
+        in_flight = deque()
+        while tasks or in_flight:
+            while tasks and len(in_flight) < window:
+                task = tasks.popleft()
+                in_flight.append((task, pool.apply_async(process, (task,))))
+            task, result = in_flight.popleft()
+            yield task, result.get()
+
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            for task, (counts, rest) in instrument.timed(finished(pool), 'count (waiting on pool)'):
+                if rest:
+                    tasks.appendleft(rest)
+                done += len(task) - len(rest)
+                print('%d / %d files' % (done, len(paths)))
+                yield counts
+    else:
+        while tasks:
+            task = tasks.popleft()
+            with instrument.stage('count'):
+                counts, rest = process(task)
+            if rest:
+                tasks.appendleft(rest)
+            done += len(task) - len(rest)
+            print('%d / %d files' % (done, len(paths)))
+            yield counts
+
+
+def daily_rows(items, daily_writer):
+    """Write a (title, month, views per day) row to daily_writer for the merged, per day items and yield the
+    (title, total) of each title. Counts from dumps without a date only go into the total."""
+    for title, keys in itertools.groupby(items, key=lambda item: item[0].partition(DAY_SEPARATOR)[0]):
+        total = 0
+        month = views = None
+        for key, count in keys:
+            total += count
+            day = key.partition(DAY_SEPARATOR)[2]
+            if not day:
+                continue
+            day_month = datetime.date(int(day[:4]), int(day[4:6]), 1)
+            if day_month != month:
+                if views:
+                    daily_writer.add((title, month, views))
+                month = day_month
+                views = [0] * calendar.monthrange(month.year, month.month)[1]
+            views[int(day[6:]) - 1] += count
+        if views:
+            daily_writer.add((title, month, views))
+        yield title, total
+
+
+def window_views(cursor, start, end, titles=None, limit=None, table=DAILY_TABLE):
+    """(title, views) from start through end (dates, inclusive) for titles, or all, most viewed first."""
+    params = {'start': start, 'end': end, 'limit': limit, 'titles': list(titles or ())}
+    sql = WINDOW_SQL.format(table=table, titles='\n  AND d.title = ANY(%(titles)s)' if titles is not None else '')
+    cursor.execute(sql, params)
+    return cursor.fetchall()
+
+
+def daily_views(cursor, title, start, end, table=DAILY_TABLE):
+    """(date, views) for each day from start through end that there are counts of title for."""
+    cursor.execute(SERIES_SQL.format(table=table), {'title': title, 'start': start, 'end': end})
+    return cursor.fetchall()
+
+
+def count_dumps(paths, workers=1, decompress_workers=1, memory_budget=None, spill_dir=None, daily=False):
+    """Add up the English pageviews in the dumps at paths into a SpillingCounter.
+
+    The dumps are parsed by a pool of workers if there is more than one, each adding up a few files at a time;
+    the partial counts are merged here. With a memory_budget in bytes the counts that don't fit are spilled to
+    sorted runs in spill_dir and merged at the end, see SpillingCounter, and the partial counts coming in are
+    bounded by map_files, so memory stays bounded however many dumps there are.
+    """
+    c = SpillingCounter(memory_budget, spill_dir)
+    for counts in map_files(paths, workers, decompress_workers, daily, memory_budget):
+        with instrument.stage('merge partial counts'):
+            for title, count in counts.items():
+                c.add(title, count)
+        instrument.count('merge partial counts', len(counts))
+    return c
+
+
+def write_counts(c, writer, daily_writer=None):
+    """Stream the merged counts of c into writer, and the views per day into daily_writer, returning the top ones."""
+
+    def written(items):
+        for item in items:
+            writer.add(item)
+            yield item
+
+    with instrument.stage('merge counts'):
+        items = c.items()
+        if daily_writer is not None:
+            items = daily_rows(items, daily_writer)
+        # the merged counts stream into the table; only the top ones are kept around to print
+        return heapq.nlargest(TOP_COUNT, written(items), key=itemgetter(1))
+
+
+def main(
+    dump_dir,
+    cursor,
+    dumps_to_fetch,
+    table='wikistats',
+    decompress_workers=1,
+    concurrency=DEFAULT_CONCURRENCY,
+    memory_budget=None,
+    spill_dir=None,
+    workers=1,
+    daily_table=None,
+):
+    """Add up the English pageviews in the dumps in dump_dir and write them to table, see count_dumps. Returns
+    the names of the dumps counted, for finish_import to record.
+
+    With a daily_table, the views are also counted per day, going by the date in the name of each dump, and
+    written there as a row per title and month with an array of the views per day, see daily_rows and
+    window_views.
+    """
     if dumps_to_fetch > 0:
-        fetch_dumps(dump_dir, dumps_to_fetch)
-
-    c = Counter()
-    for fn in os.listdir(dump_dir):
-        if fn.endswith('.gz'):
-            print(fn)
-            path = os.path.join(dump_dir, fn)
-            for line in subprocess.Popen(['zcat'], stdin=open(path), stdout=subprocess.PIPE).stdout:
-                line = line.decode('utf8')
-                if line.startswith('en '):
-                    bits = line.split(' ')
-                    if len(bits) != 4:
-                        continue
-                    _, wikipedia_id, count, size = bits
-                    if not ':' in wikipedia_id:
-                        try:
-                            title = urllib.parse.unquote(wikipedia_id).replace('_', ' ')
-                        except UnicodeDecodeError:
-                            continue
-                        c[title] += int(count)
-    for k, v in c.items():
-        cursor.execute("INSERT INTO wikistats (title, viewcount) VALUES (%s, %s)", (k, v))
+        fetch_dumps(dump_dir, dumps_to_fetch, concurrency)
+
+    names = sorted(fn for fn in os.listdir(dump_dir) if fn.endswith('.gz'))
+    paths = [os.path.join(dump_dir, fn) for fn in names]
+    c = count_dumps(paths, workers, decompress_workers, memory_budget, spill_dir, daily_table is not None)
+    writer = BulkWriter(cursor, table, COLUMNS)
+    daily_writer = BulkWriter(cursor, daily_table, DAILY_COLUMNS) if daily_table is not None else None
+    top = write_counts(c, writer, daily_writer)
+    writer.close()
+    if daily_writer:
+        daily_writer.close()
     import pprint
 
-    pprint.pprint(c.most_common(25))
+    pprint.pprint(top)
+    return names
+
+
+def finish_import(conn, connection_string, loads, names, index_workers=DEFAULT_INDEX_WORKERS):
+    """Finish the loads of a full import and list the dumps in them in wikistats_file instead of what was there.
+
+    That happens in the transaction that swaps the tables in, or loads them if they aren't staged, so an
+    incremental import never sees counts that don't match the list and adds dumps twice.
+    """
+    for load in loads:
+        load.prepare(conn, connection_string, index_workers)
+    cursor = conn.cursor()
+    for load in loads:
+        load.swap(cursor)
+    cursor.execute(FILE_TABLE)
+    cursor.execute('TRUNCATE wikistats_file')
+    cursor.execute(ADD_FILES, (names,))
+    conn.commit()
+
+
+def main_incremental(
+    dump_dir,
+    conn,
+    cursor,
+    dumps_to_fetch,
+    decompress_workers=1,
+    concurrency=DEFAULT_CONCURRENCY,
+    memory_budget=None,
+    spill_dir=None,
+    workers=1,
+    daily=False,
+    seed_manifest=False,
+):
+    """Add the pageviews in the dumps in dump_dir that weren't ingested before to the existing tables.
+
+    The new counts are upserted in batches, adding to the views that are there, and the dumps recorded in
+    wikistats_file, all in one transaction, so a failed run can simply be repeated. See check_incremental for
+    when the tables can't be added to.
+    """
+    # before fetching, so seed_manifest only lists the dumps that were there
+    ingested = check_incremental(cursor, dump_dir, daily, seed_manifest)
+    if dumps_to_fetch > 0:
+        fetch_dumps(dump_dir, dumps_to_fetch, concurrency)
+
+    names = sorted(fn for fn in os.listdir(dump_dir) if fn.endswith('.gz') and fn not in ingested)
+    print('%d new dumps, %d ingested before' % (len(names), len(ingested)))
+    if not names:
+        conn.commit()
+        return
+
+    paths = [os.path.join(dump_dir, fn) for fn in names]
+    c = count_dumps(paths, workers, decompress_workers, memory_budget, spill_dir, daily)
+    writer = BulkWriter(cursor, 'wikistats', COLUMNS, on_conflict=ADD_VIEWS)
+    daily_writer = BulkWriter(cursor, DAILY_TABLE, DAILY_COLUMNS, on_conflict=ADD_DAILY_VIEWS) if daily else None
+    top = write_counts(c, writer, daily_writer)
+    writer.close()
+    if daily_writer:
+        daily_writer.close()
+    cursor.execute(ADD_FILES, (names,))
+    conn.commit()
+    import pprint
+
+    pprint.pprint(top)
 
 
 if __name__ == '__main__':
@@ -86,14 +554,77 @@ if __name__ == '__main__':
     parser.add_argument(
         '--dumps_to_fetch', type=int, default=0, help='randomly fetch this amount of dumps from the last year'
     )
+    parser.add_argument(
+        '--concurrency', type=int, default=DEFAULT_CONCURRENCY, help='download this many dumps at the same time'
+    )
+    parser.add_argument(
+        '--staged', action='store_true', help='load into an unlogged staging table and swap it in when done'
+    )
+    parser.add_argument(
+        '--index_workers', type=int, default=DEFAULT_INDEX_WORKERS, help='parallel index builds for --staged'
+    )
+    parser.add_argument(
+        '--decompress_workers', type=int, default=1, help='if larger than 1, decompress the dumps in this many threads'
+    )
+    parser.add_argument(
+        '--memory_budget', type=int, default=0, help='spill counts to disk above this many MB, 0 to keep all in memory'
+    )
+    parser.add_argument('--spill_dir', type=str, help='where to spill the counts, by default the temp directory')
+    parser.add_argument(
+        '--workers', type=int, default=1, help='if larger than 1, parse the dumps in a pool of this many processes'
+    )
+    parser.add_argument(
+        '--daily', action='store_true', help='also keep the views per title per day, in %s' % DAILY_TABLE
+    )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='add the dumps that were not ingested before to the existing tables rather than starting over',
+    )
+    parser.add_argument(
+        '--seed_manifest',
+        action='store_true',
+        help='with --incremental, take the dumps in the directory to be those in a wikistats without wikistats_file',
+    )
     parser.add_argument('dumps', type=str, help='directory where the downloaded page coungs are stored')
+    instrument.add_arguments(parser)
 
     args = parser.parse_args()
-    conn, cursor = setup_db(args.postgres)
-
-    if not os.path.isdir(args.dumps):
-        os.makedirs(args.dumps)
+    with instrument.instrumented('import_stats', args.profile, args.stats):
+        if not os.path.isdir(args.dumps):
+            os.makedirs(args.dumps)
 
-    main(args.dumps, cursor, args.dumps_to_fetch)
+        if args.incremental:
+            if args.staged:
+                parser.error('--incremental updates the tables in place and can not be --staged')
+            conn, cursor = setup_incremental(args.postgres)
+            main_incremental(
+                args.dumps,
+                conn,
+                cursor,
+                args.dumps_to_fetch,
+                args.decompress_workers,
+                args.concurrency,
+                args.memory_budget * 1024 * 1024,
+                args.spill_dir,
+                args.workers,
+                args.daily,
+                args.seed_manifest,
+            )
+        else:
+            conn, cursor, load = setup_db(args.postgres, args.staged)
+            daily_load = setup_daily(cursor, args.staged) if args.daily else None
+            names = main(
+                args.dumps,
+                cursor,
+                args.dumps_to_fetch,
+                load.target,
+                args.decompress_workers,
+                args.concurrency,
+                args.memory_budget * 1024 * 1024,
+                args.spill_dir,
+                args.workers,
+                daily_load.target if daily_load else None,
+            )
 
-    conn.commit()
+            finish_import(conn, args.postgres, [load] + ([daily_load] if daily_load else []), names, args.index_workers)
@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+
+import datetime
+import gzip
+from collections import Counter
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import import_stats
+from bulk_writer_test import FakeCursor
+from staged_load import TableLoad
+from import_stats import (
+    ADD_FILES,
+    DAILY_TABLE,
+    DAY_SEPARATOR,
+    LOCAL_PATH,
+    MANIFEST,
+    PART_SUFFIX,
+    TABLE_COLUMNS,
+    Manifest,
+    download_hours,
+    finish_import,
+    fetch_dumps,
+    interrupted_hours,
+    count_files,
+    count_lines,
+    daily_rows,
+    daily_views,
+    main,
+    main_incremental,
+    map_files,
+    window_views,
+)
+
+class IngestedCursor(FakeCursor):
+    """A FakeCursor for which wikistats_file lists ingested, wikistats has rows if has_counts and so on."""
+
+    def __init__(self, ingested, has_counts=False, has_daily=False):
+        super().__init__()
+        self.ingested = ingested
+        self.has_counts = has_counts
+        self.has_daily = has_daily
+        self.params = []
+
+    def execute(self, sql, params=None):
+        super().execute(sql, params)
+        self.params.append(params)
+
+    def fetchall(self):
+        return [(name,) for name in self.ingested]
+
+    def fetchone(self):
+        if 'to_regclass' in self.statements[-1]:
+            return (self.has_daily,)
+        return (self.has_counts,)
+
+
+class FakePool:
+    """Runs the tasks as they are submitted, keeping track of how many results were not taken in yet."""
+
+    def __init__(self, workers):
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def apply_async(self, func, args):
+        pool = self
+        result = func(*args)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+        class Result:
+            def get(self):
+                pool.in_flight -= 1
+                return result
+
+        return Result()
+
+
+class FakeConnection:
+    def __init__(self, cursor=None):
+        self._cursor = cursor
+        self.commits = 0
+
+    def cursor(self):
+        return self._cursor
+
+    def commit(self):
+        self.commits += 1
+        if self._cursor:
+            self._cursor.statements.append('COMMIT')
+
+
+HOURS = [{'year': 2016, 'month': 3, 'day': day, 'hour': hour} for day in (1, 2) for hour in (0, 13)]
+
+
+def dump_for(path):
+    # without a fixed mtime the bytes change when the clock ticks over a second between two calls
+    return gzip.compress(''.join('en %s_%d %d 0\n' % (path, i, i) for i in range(2000)).encode('utf8'), mtime=0)
+
+
+class DumpHandler(BaseHTTPRequestHandler):
+    """Serves dump_for(path) with support for Range requests, or fails for the paths in server.failing.
+
+    Paths in server.unsatisfiable get a 416, those in server.encoded are sent as gzip content encoded.
+    """
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('Range')))
+        if self.path in self.server.failing:
+            self.send_error(503)
+            return
+        if self.path in self.server.unsatisfiable:
+            self.send_error(416)
+            return
+        data = dump_for(self.path)
+        start = 0
+        if self.headers.get('Range'):
+            start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+            if start >= len(data):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - start))
+        if self.path in self.server.encoded:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class TestFetchDumps(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), DumpHandler)
+        self.server.requests = []
+        self.server.failing = set()
+        self.server.unsatisfiable = set()
+        self.server.encoded = set()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.remote_path = 'http://127.0.0.1:%d/%s' % (self.server.server_port, LOCAL_PATH)
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def test_download_hours(self):
+        self.server.failing.add('/' + LOCAL_PATH % HOURS[3])
+        completed = download_hours(self.tmp.name, HOURS, concurrency=3, remote_path=self.remote_path)
+        self.assertEqual(sorted(completed), sorted(LOCAL_PATH % d for d in HOURS[:3]))
+        for d in HOURS[:3]:
+            with open(os.path.join(self.tmp.name, LOCAL_PATH % d), 'rb') as fin:
+                self.assertEqual(fin.read(), dump_for('/' + LOCAL_PATH % d))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, LOCAL_PATH % HOURS[3])))
+        self.assertEqual(Manifest(self.tmp.name).done, set(completed))
+
+        # what is in the manifest isn't fetched again
+        self.server.failing.clear()
+        self.server.requests.clear()
+        self.assertEqual(download_hours(self.tmp.name, HOURS, remote_path=self.remote_path), [LOCAL_PATH % HOURS[3]])
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_encoded_and_unsatisfiable(self):
+        self.server.encoded.add('/' + LOCAL_PATH % HOURS[0])
+        self.server.unsatisfiable.add('/' + LOCAL_PATH % HOURS[1])
+        completed = download_hours(self.tmp.name, HOURS[:2], remote_path=self.remote_path)
+        self.assertEqual(completed, [LOCAL_PATH % HOURS[0]])
+        # written as sent rather than unpacked
+        with open(os.path.join(self.tmp.name, LOCAL_PATH % HOURS[0]), 'rb') as fin:
+            self.assertEqual(fin.read(), dump_for('/' + LOCAL_PATH % HOURS[0]))
+        self.assertEqual(sorted(os.listdir(self.tmp.name)), sorted([MANIFEST, LOCAL_PATH % HOURS[0]]))
+
+    def test_resume(self):
+        name = LOCAL_PATH % HOURS[0]
+        data = dump_for('/' + name)
+        with open(os.path.join(self.tmp.name, name + PART_SUFFIX), 'wb') as fout:
+            fout.write(data[:1000])
+        self.assertEqual(interrupted_hours(self.tmp.name), [HOURS[0]])
+        self.assertEqual(fetch_dumps(self.tmp.name, 1, remote_path=self.remote_path), [name])
+        self.assertEqual(self.server.requests, [('/' + name, 'bytes=1000-')])
+        with open(os.path.join(self.tmp.name, name), 'rb') as fin:
+            self.assertEqual(fin.read(), data)
+        self.assertEqual(sorted(os.listdir(self.tmp.name)), sorted([MANIFEST, name]))
+
+
+class TestImportStats(unittest.TestCase):
+    def test_main(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for hour in range(3):
+                lines = ['en Page_%d %d 100\n' % (i, hour + 1) for i in range(hour * 10, 50)]
+                lines += ['de Seite 7 100\n', 'en Talk:Page_1 4 100\n', 'en A%C3%A9 2 100\n']
+                with open(os.path.join(tmp, LOCAL_PATH % HOURS[hour]), 'wb') as fout:
+                    fout.write(gzip.compress(''.join(lines).encode('utf8')))
+            copied = {}
+            for budget, workers in (None, 1), (1000, 1), (1000, 2):
+                cursor = FakeCursor()
+                main(tmp, cursor, 0, memory_budget=budget, workers=workers)
+                copied[budget, workers] = ''.join(cursor.copied)
+        self.assertEqual(copied[1000, 1], copied[None, 1])
+        self.assertEqual(copied[1000, 2], copied[None, 1])
+        counts = dict(line.split('\t') for line in copied[None, 1].splitlines())
+        self.assertEqual(len(counts), 51)
+        self.assertEqual(counts['Page 0'], '1')
+        self.assertEqual(counts['Page 49'], '6')
+        self.assertEqual(counts['Aé'], '6')
+
+    def test_daily(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for idx, d in enumerate(HOURS):
+                lines = ['en Page_%d %d 100\n' % (i, idx + 1) for i in range(3)]
+                with open(os.path.join(tmp, LOCAL_PATH % d), 'wb') as fout:
+                    fout.write(gzip.compress(''.join(lines).encode('utf8')))
+            cursor = FakeCursor()
+            main(tmp, cursor, 0, daily_table=DAILY_TABLE)
+        copies = dict(zip([sql for sql in cursor.statements if sql.startswith('COPY')], cursor.copied))
+        (totals,) = [data for sql, data in copies.items() if DAILY_TABLE not in sql]
+        (daily,) = [data for sql, data in copies.items() if DAILY_TABLE in sql]
+        self.assertEqual(totals.splitlines()[0], 'Page 0\t10')
+        # hours 1 and 2 are on march 1st, 3 and 4 on the 2nd
+        views = '{3,7' + ',0' * 29 + '}'
+        self.assertEqual(daily.splitlines(), ['Page %d\t2016-03-01\t%s' % (i, views) for i in range(3)])
+
+    def test_incremental(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for idx, d in enumerate(HOURS):
+                with open(os.path.join(tmp, LOCAL_PATH % d), 'wb') as fout:
+                    fout.write(gzip.compress(b'en Page %d 100\n' % (10 ** idx)))
+            cursor = IngestedCursor([LOCAL_PATH % d for d in HOURS[:2]], has_counts=True, has_daily=True)
+            conn = FakeConnection()
+            main_incremental(tmp, conn, cursor, 0, daily=True)
+            self.assertEqual(conn.commits, 1)
+            # only the new dumps are counted and their counts are added to what is there
+            self.assertEqual(cursor.copied[0], 'Page\t1100\n')
+            self.assertEqual(cursor.copied[1], 'Page\t2016-03-01\t{0,1100' + ',0' * 29 + '}\n')
+            upsert = 'viewcount = wikistats.viewcount + excluded.viewcount'
+            self.assertTrue(any(upsert in sql for sql in cursor.statements))
+            self.assertEqual(cursor.params[-1], ([LOCAL_PATH % d for d in HOURS[2:]],))
+
+            # nothing new, nothing to do
+            cursor = IngestedCursor([LOCAL_PATH % d for d in HOURS], has_counts=True)
+            main_incremental(tmp, conn, cursor, 0)
+            self.assertEqual(cursor.copied, [])
+            self.assertFalse(any(sql.startswith('INSERT') for sql in cursor.statements))
+
+    def test_incremental_checks(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for idx, d in enumerate(HOURS[:2]):
+                with open(os.path.join(tmp, LOCAL_PATH % d), 'wb') as fout:
+                    fout.write(gzip.compress(b'en Page %d 100\n' % (10 ** idx)))
+            # counts from before wikistats_file would be counted again
+            with self.assertRaises(ValueError):
+                main_incremental(tmp, FakeConnection(), IngestedCursor([], has_counts=True), 0)
+            # unless the dumps there are taken to be the ones in them
+            cursor = IngestedCursor([], has_counts=True)
+            conn = FakeConnection()
+            main_incremental(tmp, conn, cursor, 0, seed_manifest=True)
+            self.assertEqual(cursor.copied, [])
+            self.assertIn(ADD_FILES, cursor.statements)
+            self.assertEqual(cursor.params[cursor.statements.index(ADD_FILES)], ([LOCAL_PATH % d for d in HOURS[:2]],))
+            self.assertEqual(conn.commits, 1)
+
+            # wikistats_daily would fall behind without daily
+            with self.assertRaises(ValueError):
+                main_incremental(tmp, FakeConnection(), IngestedCursor([], has_daily=True), 0)
+            # and would only hold the new days if daily started it
+            with self.assertRaises(ValueError):
+                main_incremental(tmp, FakeConnection(), IngestedCursor(['x'], has_counts=True), 0, daily=True)
+            # an empty wikistats can start it though
+            cursor = IngestedCursor([])
+            main_incremental(tmp, FakeConnection(), cursor, 0, daily=True)
+            self.assertEqual(len(cursor.copied), 2)
+
+    def test_full_then_incremental(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for idx, d in enumerate(HOURS):
+                with open(os.path.join(tmp, LOCAL_PATH % d), 'wb') as fout:
+                    fout.write(gzip.compress(b'en Page %d 100\n' % (10 ** idx)))
+                if idx == 1:
+                    cursor = IngestedCursor([])
+                    names = main(tmp, cursor, 0)
+                    self.assertEqual(cursor.copied, ['Page\t11\n'])
+                    conn = FakeConnection(cursor)
+                    finish_import(conn, None, [TableLoad('wikistats', TABLE_COLUMNS, [], staged=True)], names)
+            # the table is swapped in and the dumps in it listed in the same transaction
+            swap = cursor.statements.index('DROP TABLE IF EXISTS wikistats')
+            self.assertEqual(
+                cursor.statements[swap:],
+                [
+                    'DROP TABLE IF EXISTS wikistats',
+                    'ALTER TABLE wikistats_staging RENAME TO wikistats',
+                    'ALTER INDEX IF EXISTS wikistats_staging_pkey RENAME TO wikistats_pkey',
+                    import_stats.FILE_TABLE,
+                    'TRUNCATE wikistats_file',
+                    ADD_FILES,
+                    'COMMIT',
+                ],
+            )
+            self.assertEqual(cursor.params[-1], ([LOCAL_PATH % d for d in HOURS[:2]],))
+
+            # so the incremental import after it only counts the two dumps that came in since
+            cursor = IngestedCursor(cursor.params[-1][0], has_counts=True)
+            main_incremental(tmp, FakeConnection(), cursor, 0)
+            self.assertEqual(cursor.copied[0], 'Page\t1100\n')
+
+    def test_daily_rows(self):
+        items = [
+            ('Page', 1),
+            ('Page' + DAY_SEPARATOR + '20160131', 2),
+            ('Page' + DAY_SEPARATOR + '20160201', 3),
+            ('Page' + DAY_SEPARATOR + '20160229', 4),
+            ('Page 2' + DAY_SEPARATOR + '20160301', 5),
+        ]
+        rows = []
+
+        class Writer:
+            add = rows.append
+
+        self.assertEqual(list(daily_rows(items, Writer())), [('Page', 10), ('Page 2', 5)])
+        self.assertEqual(
+            rows,
+            [
+                ('Page', datetime.date(2016, 1, 1), [0] * 30 + [2]),
+                ('Page', datetime.date(2016, 2, 1), [3] + [0] * 27 + [4]),
+                ('Page 2', datetime.date(2016, 3, 1), [5] + [0] * 30),
+            ],
+        )
+
+    def test_bounded_pool(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = []
+            for idx in range(30):
+                paths.append(os.path.join(tmp, 'pagecounts-20160301-%02d0000.gz' % idx))
+                lines = ['en Page_%d_%d 1 100\n' % (idx, i) for i in range(20)] + ['en Shared 1 100\n']
+                with open(paths[-1], 'wb') as fout:
+                    fout.write(gzip.compress(''.join(lines).encode('utf8')))
+            counts, rest = count_files(paths[:4], max_size=1)
+            self.assertEqual((len(counts), rest), (21, paths[1:4]))
+
+            pools = []
+
+            def make_pool(workers):
+                pools.append(FakePool(workers))
+                return pools[-1]
+
+            with mock.patch.object(import_stats.multiprocessing, 'Pool', make_pool):
+                # a share of 1000 bytes for each of the 4 tasks in flight, less than the counts of one file
+                partials = list(map_files(paths, workers=2, memory_budget=4000))
+        self.assertLessEqual(pools[0].max_in_flight, 4)
+        self.assertEqual(pools[0].in_flight, 0)
+        self.assertEqual(len(partials), 30)
+        self.assertTrue(all(len(partial) == 21 for partial in partials))
+        self.assertEqual(sum((partial for partial in partials), Counter())['Shared'], 30)
+
+    def test_window_views(self):
+        # a window over the end of february and the start of march 2016
+        start, end = datetime.date(2016, 2, 27), datetime.date(2016, 3, 2)
+        cursor = IngestedCursor([])
+        window_views(cursor, start, end)
+        sql = cursor.statements[-1]
+        self.assertIn('FROM wikistats_daily d, unnest(d.views) WITH ORDINALITY AS v(views, day)\n', sql)
+        # the rows of the months the window touches, and of those the days in it
+        self.assertIn("WHERE d.month BETWEEN date_trunc('month', %(start)s::date)::date AND %(end)s\n", sql)
+        self.assertIn('  AND d.month + v.day::int - 1 BETWEEN %(start)s AND %(end)s\nGROUP BY d.title', sql)
+        self.assertTrue(sql.rstrip().endswith('LIMIT %(limit)s'))
+        self.assertNotIn('ANY', sql)
+        # LIMIT NULL is no limit at all
+        self.assertEqual(cursor.params[-1], {'start': start, 'end': end, 'limit': None, 'titles': []})
+
+        # no titles is no rows rather than all of them
+        window_views(cursor, start, end, titles=[], table='stats')
+        self.assertIn('FROM stats d,', cursor.statements[-1])
+        self.assertIn('BETWEEN %(start)s AND %(end)s\n  AND d.title = ANY(%(titles)s)\n', cursor.statements[-1])
+        self.assertEqual(cursor.params[-1]['titles'], [])
+        window_views(cursor, start, end, titles=('Page', 'Page 2'), limit=10)
+        self.assertIn('AND d.title = ANY(%(titles)s)', cursor.statements[-1])
+        self.assertEqual(cursor.params[-1], {'start': start, 'end': end, 'limit': 10, 'titles': ['Page', 'Page 2']})
+
+        daily_views(cursor, 'Page', start, end)
+        sql = cursor.statements[-1]
+        self.assertIn('SELECT d.month + v.day::int - 1 AS day, v.views\n', sql)
+        self.assertIn('WHERE d.title = %(title)s\n', sql)
+        self.assertIn("  AND d.month BETWEEN date_trunc('month', %(start)s::date)::date AND %(end)s\n", sql)
+        self.assertTrue(sql.rstrip().endswith('ORDER BY day'))
+        self.assertEqual(cursor.params[-1], {'title': 'Page', 'start': start, 'end': end})
+
+        # a model of the date arithmetic above over the rows daily_rows writes for the two months
+        rows = []
+
+        class Writer:
+            add = rows.append
+
+        items = [('Page' + DAY_SEPARATOR + '201602%02d' % day, day) for day in range(1, 30)]
+        items += [('Page' + DAY_SEPARATOR + '201603%02d' % day, 100 * day) for day in range(1, 32)]
+        list(daily_rows(items, Writer()))
+        days = [
+            (month + datetime.timedelta(day - 1), views)
+            for _, month, views_per_day in rows
+            if start.replace(day=1) <= month <= end
+            for day, views in enumerate(views_per_day, 1)
+            if start <= month + datetime.timedelta(day - 1) <= end
+        ]
+        self.assertEqual([day.day for day, _ in days], [27, 28, 29, 1, 2])
+        self.assertEqual(sum(views for _, views in days), 27 + 28 + 29 + 100 + 200)
+
+    def test_count_lines(self):
+        lines = [b'en Caf%C3%A9_society 2 0\n', b'en Caf%E9 1 0\n', b'nl Caf%C3%A9_society 5 0\n', b'en Bad 1\n']
+        lines.append(b'en Caf%C3%A9_society 3 0\n')
+        self.assertEqual(dict(count_lines(lines, Counter())), {'Café society': 5, 'Caf\ufffd': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,40 +1,255 @@
 #!/usr/bin/env python
 
 from collections import defaultdict
+from functools import partial
 
 import argparse
-import subprocess
+import itertools
+import multiprocessing
 import json
+import os
+import re
+import tempfile
 
 import psycopg2
-from psycopg2 import extras
 
+import instrument
+from bulk_writer import BulkWriter, geo_point
+from decompress import open_compressed
+from name_map import NameMap, NameMapBuilder, TitleSet
+from staged_load import DEFAULT_INDEX_WORKERS, TableLoad
 
-def setup_db(connection_string):
+COLUMNS = ('wikipedia_id', 'title', 'wikidata_id', 'description', 'properties')
+
+TABLE_COLUMNS = (
+    '('
+    '    wikipedia_id TEXT PRIMARY KEY,'
+    '    title TEXT,'
+    '    wikidata_id TEXT,'
+    '    description TEXT,'
+    '    properties JSONB'
+    ')'
+)
+TABLE_INDEXES = [('wikidata_id', '(wikidata_id)'), ('properties', 'USING gin(properties)')]
+
+# the column type and index definition for each kind of typed property
+TYPED_KINDS = {
+    'timestamp': ('TIMESTAMP', '(%s)'),
+    'numeric': ('DOUBLE PRECISION', '(%s)'),
+    'geography': ('GEOGRAPHY(POINT,4326)', 'USING gist(%s)'),
+}
+TYPED_PROPERTIES_EXAMPLE = 'population:P1082:numeric,born:P569:timestamp,location:P625:geography'
+COLUMN_NAME_RE = re.compile(r'[a-z_][a-z0-9_]*$')
+PROPERTY_ID_RE = re.compile(r'P([0-9]+)$')
+ITEM_ID_RE = re.compile(r'Q([0-9]+)$')
+MAPPED_TIME_RE = re.compile(r'(-?\d+)-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)$')
+DAYS_IN_MONTH = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+# what a postgres timestamp can hold, as astronomical years (1 BC is year 0, 4713 BC is -4712)
+MIN_YEAR = -4712
+MAX_YEAR = 294276
+
+DATE_PARSE_RE = re.compile(r'([-+]?\d+)-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)Z')
+# 'depricated' never matches, so deprecated values are never picked
+RANKS = ('preferred', 'normal', 'depricated')
+
+# the single pass import keeps the names of all entities and the claims of the articles by raw ids in these
+LABEL_TABLE = 'wikidata_label'
+LABEL_COLUMNS = ('id', 'name')
+LABEL_TABLE_COLUMNS = '(id TEXT PRIMARY KEY, name TEXT NOT NULL)'
+RAW_TABLE = 'wikidata_raw'
+RAW_COLUMNS = ('wikipedia_id', 'title', 'wikidata_id', 'description', 'claims')
+
+# the claims of the articles that refer to other items, by the numbers of the ids, so Q42 is 42
+EDGE_TABLE = 'wikidata_edge'
+EDGE_COLUMNS = ('subject_qid', 'property_pid', 'object_qid', 'rank')
+EDGE_TABLE_COLUMNS = (
+    '(subject_qid INT NOT NULL, property_pid INT NOT NULL, object_qid INT NOT NULL, rank SMALLINT NOT NULL)'
+)
+EDGE_TABLE_INDEXES = [
+    ('subject', '(subject_qid, property_pid, object_qid)'),
+    ('object', '(object_qid, property_pid, subject_qid)'),
+]
+# rank in the edge table is the index in this
+EDGE_RANKS = ('preferred', 'normal', 'deprecated')
+
+# raw lines handed to a worker at a time
+ENTITY_BATCH_SIZE = 256
+# every entity with an enwiki sitelink has this in its line, so lines without it can be dropped undecoded
+ENWIKI_MARKER = b'"enwiki"'
+# the top level keys of an entity lazy_entity looks for; none of them is used as a key further down
+SECTION_RE = re.compile(r'"(labels|descriptions|aliases|claims|sitelinks)":\s*')
+ENTITY_ID_RE = re.compile(r'"id":\s*"([^"]*)"')
+KEY_RES = {key: re.compile(r'"%s":\s*' % key) for key in ('en', 'enwiki')}
+DECODER = json.JSONDecoder()
+# the names articles_batch maps properties with; set by main, or by load_worker_names in the pool's workers
+_worker_names = None
+
+# Builds properties from the claims in the raw table the same way map_properties does: the names of properties and
+# entities are looked up in the label table, values without a name are dropped, the first rank that has values
+# left wins and if there is more than one value, they are sorted.
+RESOLVE_SQL = """
+INSERT INTO {table} (wikipedia_id, title, wikidata_id, description, properties{typed})
+SELECT raw.wikipedia_id, raw.title, raw.wikidata_id, raw.description, COALESCE((
+    SELECT jsonb_object_agg(prop.name, resolved.value)
+    FROM jsonb_each(raw.claims) claim(prop_id, ranks)
+    JOIN {label_table} prop ON prop.id = claim.prop_id
+    CROSS JOIN LATERAL (
+        SELECT CASE WHEN count(*) = 1 THEN (array_agg(item))[1]
+                    ELSE jsonb_agg(item ORDER BY item #>> '{{}}' COLLATE "C") END AS value
+        FROM (
+            SELECT item, rank_no, min(rank_no) OVER () AS first_rank_no
+            FROM (
+                SELECT rank.rank_no, CASE
+                    WHEN entry.item ->> 'qid' IS NOT NULL THEN to_jsonb(entity.name)
+                    WHEN entry.item ->> 'globe' IS NOT NULL AND globe.id IS NULL THEN entry.item - 'globe'
+                    ELSE entry.item END AS item
+                FROM jsonb_array_elements(claim.ranks) WITH ORDINALITY rank(items, rank_no)
+                CROSS JOIN LATERAL jsonb_array_elements(rank.items) entry(item)
+                LEFT JOIN {label_table} entity ON entity.id = entry.item ->> 'qid'
+                LEFT JOIN {label_table} globe ON globe.id = entry.item ->> 'globe'
+                WHERE entry.item ->> 'qid' IS NULL OR entity.name IS NOT NULL
+            ) named
+        ) ranked
+        WHERE rank_no = first_rank_no
+    ) resolved
+    WHERE resolved.value IS NOT NULL
+), '{{}}'::jsonb){typed_select}
+FROM {raw_table} raw
+"""
+
+
+def parse_typed_properties(spec):
+    """Parse column:property_id:kind,... into a list of (column, property_id, kind)."""
+    typed = []
+    for item in filter(None, spec.split(',')):
+        parts = item.strip().split(':')
+        if (
+            len(parts) != 3
+            or not COLUMN_NAME_RE.match(parts[0])
+            or parts[0] in COLUMNS
+            or not PROPERTY_ID_RE.match(parts[1])
+            or parts[2] not in TYPED_KINDS
+        ):
+            raise ValueError('expected column:property_id:kind with kind one of %s, not %r' % (
+                ', '.join(TYPED_KINDS), item))
+        typed.append(tuple(parts))
+    return typed
+
+
+def typed_columns(typed):
+    return tuple(column for column, _, _ in typed)
+
+
+def table_columns(typed=()):
+    """TABLE_COLUMNS with a column for each of the typed properties."""
+    extra = ''.join(',    %s %s' % (column, TYPED_KINDS[kind][0]) for column, _, kind in typed)
+    return TABLE_COLUMNS[:-1] + extra + ')'
+
+
+def table_indexes(typed=()):
+    return TABLE_INDEXES + [(column, TYPED_KINDS[kind][1] % column) for column, _, kind in typed]
+
+
+def setup_db(connection_string, staged=False, typed=()):
     conn = psycopg2.connect(connection_string)
     cursor = conn.cursor()
-    cursor.execute('DROP TABLE IF EXISTS wikidata')
+    load = TableLoad('wikidata', table_columns(typed), table_indexes(typed), staged)
+    load.create(cursor)
+    return conn, cursor, load
+
+
+def setup_single_pass(cursor, staged=False, typed=()):
+    """Create the label table, which stays around, and the raw table, which is dropped once resolved."""
+    label_load = TableLoad(LABEL_TABLE, LABEL_TABLE_COLUMNS, [], staged)
+    label_load.create(cursor)
+    cursor.execute('DROP TABLE IF EXISTS %s' % RAW_TABLE)
     cursor.execute(
-        'CREATE TABLE wikidata ('
-        '    wikipedia_id TEXT PRIMARY KEY,'
-        '    title TEXT,'
-        '    wikidata_id TEXT,'
-        '    description TEXT,'
-        '    properties JSONB'
-        ')'
+        'CREATE UNLOGGED TABLE %s (wikipedia_id TEXT, title TEXT, wikidata_id TEXT, description TEXT, claims JSONB%s)'
+        % (RAW_TABLE, ''.join(', %s %s' % (column, TYPED_KINDS[kind][0]) for column, _, kind in typed))
     )
-    cursor.execute('CREATE INDEX wikidata_wikidata_id ON wikidata(wikidata_id)')
-    cursor.execute('CREATE INDEX wikidata_properties ON wikidata USING gin(properties)')
-    return conn, cursor
+    return label_load
+
 
+def setup_edges(cursor, staged=False):
+    edge_load = TableLoad(EDGE_TABLE, EDGE_TABLE_COLUMNS, EDGE_TABLE_INDEXES, staged)
+    edge_load.create(cursor)
+    return edge_load
 
-def parse_wikidata(lines):
+
+def parse_wikidata(lines, decode=json.loads):
     for line in lines:
         line = line.strip()
-        if line and line[0] == '{':
-            if line[-1] == ',':
+        # bzcat hands us bytes, which json.loads takes as well
+        if line[:1] in ('{', b'{'):
+            if line[-1:] in (',', b','):
                 line = line[:-1]
-            yield json.loads(line)
+            with instrument.stage('decode json'):
+                entity = decode(line)
+            instrument.count('decode json', 1, len(line))
+            yield entity
+
+
+def lazy_entity(line, claims=True):
+    """Decode only the parts of an entity line we use: the id, labels.en, descriptions.en, sitelinks.enwiki and,
+    with claims set and if there is an enwiki sitelink, the claims.
+
+    The labels, descriptions and aliases in all other languages and the other sitelinks make up most of a line and
+    are never decoded. Each top level section is found by its key and only the values we want are decoded from
+    there. Lines that aren't laid out as expected are decoded in full.
+    """
+    if isinstance(line, bytes):
+        line = line.decode('utf8')
+    starts = {}
+    bounds = []
+    for m in SECTION_RE.finditer(line):
+        if m.group(1) in starts:
+            return json.loads(line)
+        starts[m.group(1)] = m.end()
+        bounds.append(m.start())
+    bounds.append(len(line))
+    # the scalars, the id among them, come before the sections
+    m = ENTITY_ID_RE.search(line, 0, bounds[0])
+    if not m:
+        return json.loads(line)
+
+    def section_value(section, key):
+        """{key: value} for key in the top level section, or {} if it isn't there."""
+        if section not in starts:
+            return {}
+        start = starts[section]
+        found = KEY_RES[key].search(line, start, next(bound for bound in bounds if bound > start))
+        if not found:
+            return {}
+        return {key: DECODER.raw_decode(line, found.end())[0]}
+
+    entity = {
+        'id': m.group(1),
+        'labels': section_value('labels', 'en'),
+        'descriptions': section_value('descriptions', 'en'),
+        'sitelinks': section_value('sitelinks', 'enwiki'),
+        'claims': {},
+    }
+    if claims and entity['sitelinks'] and 'claims' in starts:
+        entity['claims'] = DECODER.raw_decode(line, starts['claims'])[0]
+    return entity
+
+
+def names_entity(line):
+    return lazy_entity(line, claims=False)
+
+
+def prefilter_lines(lines, marker=ENWIKI_MARKER):
+    """Drop the entity lines that don't contain marker before they are decoded or sent to a worker."""
+    entities = 0
+    skipped = 0
+    for line in lines:
+        if marker in line:
+            yield line
+        elif line[:1] == b'{':
+            entities += 1
+            skipped += len(line)
+            instrument.count('prefilter skipped', 1, len(line))
+    print('prefilter skipped %d entities, %d bytes' % (entities, skipped))
 
 
 def map_value(value, id_name_map):
@@ -76,93 +291,446 @@ def map_value(value, id_name_map):
     return None
 
 
-def main(dump, cursor):
+def read_batches(dump, size=ENTITY_BATCH_SIZE, prefilter=False, decompress_workers=1):
+    """The raw lines of the dump in lists of size, for names_batch, articles_batch or single_pass_batch.
+
+    With prefilter only the entities that might have an enwiki sitelink are read.
+    """
+    lines = open_compressed(dump, workers=decompress_workers)
+    lines = instrument.timed(lines, 'decompress', len)
+    if prefilter:
+        lines = prefilter_lines(lines)
+    while True:
+        batch = list(itertools.islice(lines, size))
+        if not batch:
+            return
+        yield batch
+
+
+def entity_name(d):
+    """The name other entities refer to d by: its enwiki title or else its English label."""
+    if d.get('sitelinks') and d['sitelinks'].get('enwiki'):
+        return d['sitelinks']['enwiki']['title']
+    if d['labels'].get('en'):
+        return d['labels']['en']['value']
+    return None
+
+
+def rank_values(claims, id_name_map):
+    """Map the values of the claims for one property and group them by rank."""
+    ranks = defaultdict(list)
+    for claim in claims:
+        mainsnak = claim.get('mainsnak')
+        if mainsnak:
+            data_value = map_value(mainsnak.get('datavalue'), id_name_map)
+            if data_value:
+                lst = ranks[claim['rank']]
+                if mainsnak['datavalue'].get('type') != 'wikibase-entityid':
+                    del lst[:]
+                lst.append(data_value)
+    return ranks
+
+
+def map_properties(claims, id_name_map):
+    """Properties are mapped in a way where we create lists as values for wiki entities if there is more
+    than one value. For other types, we always pick one value. If there is a preferred value, we'll
+    pick that one.
+
+    Mostly this does what you want. For filtering on colors for flags it alllows for the query:
+      SELECT title FROM wikidata WHERE properties @> '{"color": ["Green", "Red", "White"]}'
+    However, if you'd want all flags that have Blue in them, you'd have to check for just "Blue"
+    and also ["Blue"].
+    """
+    properties = {}
+    for prop_id, claims in claims.items():
+        prop_name = id_name_map.get(prop_id)
+        if prop_name:
+            ranks = rank_values(claims, id_name_map)
+            for r in RANKS:
+                value = ranks[r]
+                if value:
+                    if len(value) == 1:
+                        value = value[0]
+                    else:
+                        value = sorted(value)
+                    properties[prop_name] = value
+                    break
+    return properties
+
+
+class DeferredNames:
+    """Stands in for id_name_map in the single pass import: entities map to {"qid": id} to be resolved later."""
+
+    def get(self, entity_id):
+        return {'qid': entity_id}
+
+    def __contains__(self, entity_id):
+        # only used for the globe of coordinates, which RESOLVE_SQL drops if it has no name after all
+        return True
+
+
+def deferred_claims(claims):
+    """The claims keyed by property id, as a list of the values for each of RANKS with entities left as ids."""
+    deferred = {}
+    for prop_id, claims in claims.items():
+        ranks = rank_values(claims, DeferredNames())
+        if any(ranks[r] for r in RANKS):
+            deferred[prop_id] = [ranks[r] for r in RANKS]
+    return deferred
+
+
+def typed_timestamp(value):
+    """A time as map_value returns it in a form postgres reads, or None if it isn't a date postgres can store."""
+    m = isinstance(value, str) and MAPPED_TIME_RE.match(value)
+    if not m:
+        return None
+    year, month, day, hour, minute, second = map(int, m.groups())
+    # wikidata numbers the years before christ historically, -1 is 1 BC and there is no year 0
+    if year == 0:
+        return None
+    astronomical = year + 1 if year < 0 else year
+    if not MIN_YEAR <= astronomical <= MAX_YEAR or not 1 <= month <= 12 or hour > 23 or minute > 59 or second > 59:
+        return None
+    leap = month == 2 and astronomical % 4 == 0 and (astronomical % 100 != 0 or astronomical % 400 == 0)
+    if not 1 <= day <= DAYS_IN_MONTH[month - 1] + leap:
+        return None
+    if year > 0:
+        return '%04d-%02d-%02d %02d:%02d:%02d' % (year, month, day, hour, minute, second)
+    return '%04d-%02d-%02d %02d:%02d:%02d BC' % (-year, month, day, hour, minute, second)
+
+
+def typed_numeric(value):
+    return value if isinstance(value, float) else None
+
+
+def typed_geography(value):
+    """A point for coordinates on earth, the ones map_value doesn't give a globe."""
+    if not isinstance(value, dict) or value.get('globe') or 'lat' not in value:
+        return None
+    lat, lng = value['lat'], value['lng']
+    if lat is None or lng is None or not -90 <= lat <= 90 or not -180 <= lng <= 180:
+        return None
+    return geo_point(lng, lat)
+
+
+TYPED_CONVERTERS = {'timestamp': typed_timestamp, 'numeric': typed_numeric, 'geography': typed_geography}
+
+
+def typed_values(claims, typed):
+    """The value for each of the typed properties: the one map_properties would pick, converted to its kind."""
+    values = []
+    for _, prop_id, kind in typed:
+        # none of the kinds refers to other entities, so the names aren't needed
+        ranks = rank_values(claims.get(prop_id, ()), DeferredNames())
+        value = next((ranks[r][0] for r in RANKS if ranks[r]), None)
+        values.append(TYPED_CONVERTERS[kind](value))
+    return tuple(values)
+
+
+def entity_edges(d):
+    """(subject_qid, property_pid, object_qid, rank) for each distinct claim of item d that refers to another item."""
+    subject = ITEM_ID_RE.match(d['id'])
+    if not subject:
+        return []
+    subject_qid = int(subject.group(1))
+    edges = []
+    seen = set()
+    for prop_id, claims in d['claims'].items():
+        prop = PROPERTY_ID_RE.match(prop_id)
+        if not prop:
+            continue
+        for claim in claims:
+            datavalue = (claim.get('mainsnak') or {}).get('datavalue') or {}
+            if datavalue.get('type') != 'wikibase-entityid' or claim.get('rank') not in EDGE_RANKS:
+                continue
+            target = ITEM_ID_RE.match(datavalue['value'].get('id', ''))
+            if target:
+                edge = (subject_qid, int(prop.group(1)), int(target.group(1)), EDGE_RANKS.index(claim['rank']))
+                if edge not in seen:
+                    seen.add(edge)
+                    edges.append(edge)
+    return edges
+
+
+def article_fields(d):
+    """(wikipedia_id, title, wikidata_id, description) if d has an enwiki page and a label, else None."""
+    wikipedia_id = d.get('sitelinks', {}).get('enwiki', {}).get('title')
+    title = d['labels'].get('en', {}).get('value')
+    if wikipedia_id and title:
+        return wikipedia_id, title, d['id'], d['descriptions'].get('en', {}).get('value')
+    return None
+
+
+def names_batch(lines):
+    """(id, name) for the entities in lines that have a name."""
+    names = []
+    for d in parse_wikidata(lines, names_entity):
+        name = entity_name(d)
+        if name is not None:
+            names.append((d['id'], name))
+    return names
+
+
+def articles_batch(lines, typed=(), edges=False):
+    """(rows, edges) for the articles in lines, with their properties mapped using _worker_names."""
+    rows = []
+    article_edges = []
+    for d in parse_wikidata(lines, lazy_entity):
+        fields = article_fields(d)
+        if fields:
+            rows.append(fields + (map_properties(d['claims'], _worker_names),) + typed_values(d['claims'], typed))
+            if edges:
+                article_edges += entity_edges(d)
+    return rows, article_edges
+
+
+def single_pass_batch(lines, typed=(), edges=False):
+    """(names, rows, edges) for the entities in lines, the rows with deferred claims."""
+    names = []
+    rows = []
+    article_edges = []
+    for d in parse_wikidata(lines, lazy_entity):
+        name = entity_name(d)
+        if name is not None:
+            names.append((d['id'], name))
+        fields = article_fields(d)
+        if fields:
+            rows.append(fields + (deferred_claims(d['claims']),) + typed_values(d['claims'], typed))
+            if edges:
+                article_edges += entity_edges(d)
+    return names, rows, article_edges
+
+
+def load_worker_names(names_file):
+    """Pool initializer that memory maps the names saved by main, so the workers share them through the page cache."""
+    global _worker_names
+    _worker_names = NameMap.load(names_file)
+
+
+def map_batches(process, batches, workers=1, initializer=None, initargs=()):
+    """Yield process(batch) for each batch, in order, computed by a pool of workers if there is more than one.
+
+    Decoding the json is what takes the time, so that happens in the workers; only the raw lines are sent over.
+    Any state the workers need goes through initializer, so this works whatever the start method.
+    """
+    if workers > 1:
+        with multiprocessing.Pool(workers, initializer, initargs) as pool:
+            yield from instrument.timed(pool.imap(process, batches), 'process entities (waiting on pool)')
+    else:
+        yield from instrument.timed(map(process, batches), 'process entities')
+
+
+def dedupe_articles(rows, wp_ids=None):
+    """Drop rows for pages we've seen before.
+
+    There are some duplicate wikipedia_id's in there. We could make wikidata_id the primary key but that doesn't
+    fix the underlying dupe, so only the first entity for each page is kept. wp_ids keeps track of the pages seen,
+    a set unless given.
+    """
+    if wp_ids is None:
+        wp_ids = set()
+    rec = 0
+    dupes = 0
+    for row in rows:
+        wikipedia_id = row[0]
+        if wikipedia_id in wp_ids:
+            dupes += 1
+            continue
+        wp_ids.add(wikipedia_id)
+        rec += 1
+        if rec % 10000 == 0:
+            print(rec, dupes)
+        yield row
+
+
+def write(writer, row):
+    with instrument.stage('write'):
+        writer.add(row)
+    instrument.count('write', 1)
+
+
+def collect_names(dump, id_name_map, workers=1, decompress_workers=1):
+    c = 0
+    for names in map_batches(names_batch, read_batches(dump, decompress_workers=decompress_workers), workers):
+        for entity_id, name in names:
+            id_name_map[entity_id] = name
+        c += len(names)
+        if c % 100000 < len(names):
+            print(c, 'names')
+    return id_name_map
+
+
+def main(
+    dump, writer, compact=False, names_file=None, workers=1, typed=(), edge_writer=None, decompress_workers=1
+):
     """We do two scans:
      - first collect the id -> name / wikipedia title
      - then store the actual objects with a json property.
-     The first step takes quite a bit of memory (5Gb) - could possibly be done using a temporary table in postgres.
+     The first step takes quite a bit of memory (5Gb) as a dict. With compact set we use a NameMap and a TitleSet
+     instead, which take a fraction of that. With names_file the NameMap is saved there and memory mapped; if it
+     already exists, it is loaded from there and the first scan skipped. main_single_pass avoids it altogether.
+     With workers > 1 the entities are decoded and mapped in a pool of that many processes, which memory map the
+     names from names_file, or a temporary file, so that needs compact or names_file. The rows end with a
+     value for each of the typed properties, see parse_typed_properties. With edge_writer the claims of the
+     articles that refer to other items go there as well, see entity_edges. The dump is decompressed by that
+     many decompress_workers, see decompress.open_compressed.
   """
-    c = 0
-    skip = 0
-    id_name_map = {}
-    for d in parse_wikidata(subprocess.Popen(['bzcat'], stdin=open(dump), stdout=subprocess.PIPE).stdout):
-        c += 1
-        if c % 1000 == 0:
-            print(c, skip)
-        if d.get('sitelinks') and d['sitelinks'].get('enwiki'):
-            value = d['sitelinks']['enwiki']['title']
-        elif d['labels'].get('en'):
-            value = id_name_map[d['id']] = d['labels']['en']['value']
-        else:
-            skip += 1
-            continue
-        id_name_map[d['id']] = value
+    global _worker_names
+    if workers > 1 and not (compact or names_file):
+        raise ValueError('workers > 1 needs compact or a names_file, the workers share the names through a file')
+    tmp_dir = None
+    if workers > 1 and not names_file:
+        tmp_dir = tempfile.TemporaryDirectory()
+        names_file = os.path.join(tmp_dir.name, 'names')
+    if names_file and os.path.exists(names_file):
+        print('loading names from', names_file)
+        id_name_map = NameMap.load(names_file)
+    elif compact or names_file:
+        id_name_map = collect_names(dump, NameMapBuilder(), workers, decompress_workers).build(names_file)
+    else:
+        id_name_map = collect_names(dump, {}, workers, decompress_workers)
 
-    wp_ids = set()
-    c = 0
-    rec = 0
-    dupes = 0
-    for d in parse_wikidata(subprocess.Popen(['bzcat'], stdin=open(dump), stdout=subprocess.PIPE).stdout):
-        c += 1
-        if c % 1000 == 0:
-            print(c, rec, dupes)
-        wikipedia_id = d.get('sitelinks', {}).get('enwiki', {}).get('title')
-        title = d['labels'].get('en', {}).get('value')
-        description = d['descriptions'].get('en', {}).get('value')
-        wikidata_id = d['id']
-        properties = {}
-        if wikipedia_id and title:
-            # There are some duplicate wikipedia_id's in there. We could make wikidata_id the primary key
-            # but that doesn't fix the underlying dupe
-            if wikipedia_id in wp_ids:
-                dupes += 1
-                continue
-            wp_ids.add(wikipedia_id)
-            # Properties are mapped in a way where we create lists as values for wiki entities if there is more
-            # than one value. For other types, we always pick one value. If there is a preferred value, we'll
-            # pick that one.
-            # Mostly this does what you want. For filtering on colors for flags it alllows for the query:
-            #   SELECT title FROM wikidata WHERE properties @> '{"color": ["Green", "Red", "White"]}'
-            # However, if you'd want all flags that have Blue in them, you'd have to check for just "Blue"
-            # and also ["Blue"].
-            for prop_id, claims in d['claims'].items():
-                prop_name = id_name_map.get(prop_id)
-                if prop_name:
-                    ranks = defaultdict(list)
-                    for claim in claims:
-                        mainsnak = claim.get('mainsnak')
-                        if mainsnak:
-                            data_value = map_value(mainsnak.get('datavalue'), id_name_map)
-                            if data_value:
-                                lst = ranks[claim['rank']]
-                                if mainsnak['datavalue'].get('type') != 'wikibase-entityid':
-                                    del lst[:]
-                                lst.append(data_value)
-                    for r in 'preferred', 'normal', 'depricated':
-                        value = ranks[r]
-                        if value:
-                            if len(value) == 1:
-                                value = value[0]
-                            else:
-                                value = sorted(value)
-                            properties[prop_name] = value
-                            break
-
-            rec += 1
-            cursor.execute(
-                'INSERT INTO wikidata (wikipedia_id, title, wikidata_id, description, properties) VALUES (%s, %s, %s, %s, %s)',
-                (wikipedia_id, title, wikidata_id, description, extras.Json(properties)),
+    wp_ids = TitleSet() if compact or names_file else None
+    _worker_names = id_name_map
+
+    def rows():
+        process = partial(articles_batch, typed=typed, edges=edge_writer is not None)
+        batches = read_batches(dump, prefilter=True, decompress_workers=decompress_workers)
+        for rows, edges in map_batches(process, batches, workers, load_worker_names, (names_file,)):
+            for edge in edges:
+                write(edge_writer, edge)
+            yield from rows
+
+    try:
+        for row in dedupe_articles(rows(), wp_ids):
+            write(writer, row)
+    finally:
+        _worker_names = None
+        if isinstance(id_name_map, NameMap):
+            id_name_map.close()
+        if tmp_dir:
+            tmp_dir.cleanup()
+
+
+def main_single_pass(
+    dump, raw_writer, label_writer, compact=False, workers=1, typed=(), edge_writer=None, decompress_workers=1
+):
+    """Read the dump once, storing every name in the label table and the claims by raw ids in the raw table.
+
+    resolve_labels then turns those into the same properties main produces, all inside postgres.
+    """
+
+    def rows():
+        process = partial(single_pass_batch, typed=typed, edges=edge_writer is not None)
+        batches = read_batches(dump, decompress_workers=decompress_workers)
+        for names, rows, edges in map_batches(process, batches, workers):
+            for name in names:
+                write(label_writer, name)
+            for edge in edges:
+                write(edge_writer, edge)
+            yield from rows
+
+    wp_ids = TitleSet() if compact else None
+    for row in dedupe_articles(rows(), wp_ids):
+        write(raw_writer, row)
+
+
+def resolve_labels(cursor, table='wikidata', raw_table=RAW_TABLE, label_table=LABEL_TABLE, typed=()):
+    typed_sql = ''.join(', ' + column for column in typed_columns(typed))
+    typed_select = ''.join(', raw.' + column for column in typed_columns(typed))
+    with instrument.stage('resolve labels'):
+        cursor.execute(
+            RESOLVE_SQL.format(
+                table=table, raw_table=raw_table, label_table=label_table, typed=typed_sql, typed_select=typed_select
             )
+        )
+    instrument.count('resolve labels', cursor.rowcount)
+    cursor.execute('DROP TABLE %s' % raw_table)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Import wikidata into postgress')
     parser.add_argument('--postgres', type=str, help='postgres connection string')
+    parser.add_argument(
+        '--staged', action='store_true', help='load into an unlogged staging table and swap it in when done'
+    )
+    parser.add_argument(
+        '--index_workers', type=int, default=DEFAULT_INDEX_WORKERS, help='parallel index builds for --staged'
+    )
+    parser.add_argument(
+        '--single_pass', action='store_true', help='read the dump once and resolve the names in postgres afterwards'
+    )
+    parser.add_argument(
+        '--compact', action='store_true', help='keep the names and seen titles in compact arrays rather than dicts'
+    )
+    parser.add_argument(
+        '--names_file', type=str, help='save the compact names here and memory map them, or reuse them if it exists'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='if larger than 1, decode and map entities in this many processes, needs --compact or --names_file',
+    )
+    parser.add_argument(
+        '--typed_properties',
+        type=parse_typed_properties,
+        default=[],
+        help='properties to also store as indexed columns, column:property_id:kind with kind one of %s, '
+        'for example %s' % (', '.join(TYPED_KINDS), TYPED_PROPERTIES_EXAMPLE),
+    )
+    parser.add_argument(
+        '--edges', action='store_true', help='also store the claims that refer to other items in %s' % EDGE_TABLE
+    )
+    parser.add_argument(
+        '--decompress_workers', type=int, default=1, help='if larger than 1, decompress the dump in this many threads'
+    )
     parser.add_argument('dump', type=str, help='BZipped wikidata dump')
+    instrument.add_arguments(parser)
 
     args = parser.parse_args()
-    conn, cursor = setup_db(args.postgres)
+    if args.workers > 1 and not (args.single_pass or args.compact or args.names_file):
+        parser.error('--workers needs --compact or --names_file, the workers share the names through a file')
+    with instrument.instrumented('import_wikidata', args.profile, args.stats):
+        typed = args.typed_properties
+        conn, cursor, load = setup_db(args.postgres, args.staged, typed)
+        edge_load = setup_edges(cursor, args.staged) if args.edges else None
+        edge_writer = BulkWriter(cursor, edge_load.target, EDGE_COLUMNS) if edge_load else None
+
+        if args.single_pass:
+            label_load = setup_single_pass(cursor, args.staged, typed)
+            with BulkWriter(cursor, RAW_TABLE, RAW_COLUMNS + typed_columns(typed)) as raw_writer:
+                with BulkWriter(cursor, label_load.target, LABEL_COLUMNS) as label_writer:
+                    main_single_pass(
+                        args.dump,
+                        raw_writer,
+                        label_writer,
+                        args.compact,
+                        args.workers,
+                        typed,
+                        edge_writer,
+                        args.decompress_workers,
+                    )
+            resolve_labels(cursor, load.target, RAW_TABLE, label_load.target, typed)
+            load.finish(conn, args.postgres, args.index_workers)
+            label_load.finish(conn, args.postgres, args.index_workers)
+        else:
+            writer = BulkWriter(cursor, load.target, COLUMNS + typed_columns(typed))
+
+            main(
+                args.dump,
+                writer,
+                args.compact,
+                args.names_file,
+                args.workers,
+                typed,
+                edge_writer,
+                args.decompress_workers,
+            )
 
-    main(args.dump, cursor)
+            writer.close()
+            load.finish(conn, args.postgres, args.index_workers)
 
-    conn.commit()
+        if edge_load:
+            edge_writer.close()
+            edge_load.finish(conn, args.postgres, args.index_workers)
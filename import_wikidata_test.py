@@ -1,8 +1,123 @@
 #!/usr/bin/env python
 
+import bz2
 import json
+import multiprocessing
+import os
+import tempfile
 import unittest
-from import_wikidata import parse_wikidata, map_value
+from unittest import mock
+
+import import_wikidata
+from import_wikidata import (
+    RANKS,
+    deferred_claims,
+    entity_edges,
+    lazy_entity,
+    main,
+    main_single_pass,
+    map_properties,
+    map_value,
+    parse_typed_properties,
+    parse_wikidata,
+    prefilter_lines,
+    resolve_labels,
+    table_columns,
+    table_indexes,
+    typed_timestamp,
+    typed_values,
+)
+
+
+def entity_claim(prop_id, qid, rank='normal'):
+    datavalue = {'type': 'wikibase-entityid', 'value': {'entity-type': 'item', 'id': qid}}
+    return {'mainsnak': {'property': prop_id, 'datavalue': datavalue}, 'rank': rank}
+
+
+def coordinate_claim(prop_id, globe):
+    value = {'latitude': 52, 'longitude': 13, 'globe': 'http://www.wikidata.org/entity/' + globe}
+    return {'mainsnak': {'property': prop_id, 'datavalue': {'type': 'globecoordinate', 'value': value}}, 'rank': 'normal'}
+
+
+def value_claim(prop_id, typ, value, rank='normal'):
+    return {'mainsnak': {'property': prop_id, 'datavalue': {'type': typ, 'value': value}}, 'rank': rank}
+
+
+def entity(qid, label=None, enwiki=None, claims=None):
+    return {
+        'id': qid,
+        'labels': {'en': {'value': label}} if label else {},
+        'descriptions': {},
+        'sitelinks': {'enwiki': {'title': enwiki}} if enwiki else {},
+        'claims': claims or {},
+    }
+
+
+ENTITIES = [
+    entity('P31', 'instance of'),
+    entity('P462', 'color'),
+    entity('P625', 'coordinate location'),
+    entity('Q3142', 'red', 'Red'),
+    entity('Q23444', 'white'),
+    entity('Q111', 'Mars', 'Mars'),
+    entity(
+        'Q55',
+        'Netherlands',
+        'Netherlands',
+        {
+            'P31': [entity_claim('P31', 'Q404', 'preferred'), entity_claim('P31', 'Q6256')],
+            'P462': [entity_claim('P462', 'Q3142'), entity_claim('P462', 'Q23444'), entity_claim('P462', 'Q404')],
+            'P625': [coordinate_claim('P625', 'Q111')],
+            'P999': [entity_claim('P999', 'Q3142')],
+            'P1082': [
+                value_claim('P1082', 'quantity', {'amount': '+17000000'}, 'preferred'),
+                value_claim('P1082', 'quantity', {'amount': '+16000000'}),
+            ],
+            'P571': [value_claim('P571', 'time', {'time': '+1581-07-26T00:00:00Z'})],
+        },
+    ),
+    entity('Q6256', 'country'),
+    entity('Q56', 'Holland', 'Netherlands'),
+]
+
+
+def model_resolve(deferred, names):
+    """A python model of what RESOLVE_SQL is meant to do, to check the deferred claims against map_properties.
+
+    There is no postgres to run the query itself against here; test_resolve_labels_sql only checks how it is built.
+    """
+    properties = {}
+    for prop_id, ranks in deferred.items():
+        if prop_id not in names:
+            continue
+        for values in ranks:
+            resolved = []
+            for value in values:
+                if isinstance(value, dict) and 'qid' in value:
+                    if value['qid'] in names:
+                        resolved.append(names[value['qid']])
+                elif isinstance(value, dict) and value.get('globe') and value['globe'] not in names:
+                    resolved.append({k: v for k, v in value.items() if k != 'globe'})
+                else:
+                    resolved.append(value)
+            if resolved:
+                properties[names[prop_id]] = resolved[0] if len(resolved) == 1 else sorted(resolved)
+                break
+    return properties
+
+
+class FakeWriter:
+    def __init__(self, rows):
+        self.add = rows.append
+
+
+class RecordingCursor:
+    def __init__(self):
+        self.statements = []
+        self.rowcount = 0
+
+    def execute(self, sql, params=None):
+        self.statements.append(sql)
 
 
 class TestImportWikidata(unittest.TestCase):
@@ -40,6 +155,175 @@ class TestImportWikidata(unittest.TestCase):
         }
         self.assertEqual(map_value(time, {}), '2001-12-01T00:00:00')
 
+    def test_map_properties(self):
+        names = {'P31': 'instance of', 'P462': 'color', 'P625': 'coordinate location', 'Q3142': 'Red'}
+        names.update({'Q23444': 'white', 'Q6256': 'country', 'Q111': 'Mars'})
+        properties = map_properties(ENTITIES[6]['claims'], names)
+        self.assertEqual(
+            properties,
+            {
+                'instance of': 'country',
+                'color': ['Red', 'white'],
+                'coordinate location': {'lat': 52, 'lng': 13, 'globe': 'Q111'},
+            },
+        )
+        deferred = deferred_claims(ENTITIES[6]['claims'])
+        self.assertEqual(len(deferred['P31']), len(RANKS))
+        self.assertEqual(deferred['P31'][0], [{'qid': 'Q404'}])
+        self.assertEqual(model_resolve(deferred, names), properties)
+        del names['Q111']
+        self.assertEqual(model_resolve(deferred, names), map_properties(ENTITIES[6]['claims'], names))
+
+    def test_resolve_labels_sql(self):
+        cursor = RecordingCursor()
+        typed = parse_typed_properties('population:P1082:numeric,inception:P571:timestamp')
+        resolve_labels(cursor, 'wikidata_staging', 'raw_claims', 'labels', typed)
+        sql, drop = cursor.statements
+        self.assertEqual(drop, 'DROP TABLE raw_claims')
+        self.assertIn(
+            'INSERT INTO wikidata_staging (wikipedia_id, title, wikidata_id, description, properties, population, '
+            'inception)\nSELECT raw.wikipedia_id, raw.title, raw.wikidata_id, raw.description, COALESCE((',
+            sql,
+        )
+        self.assertIn("), '{}'::jsonb), raw.population, raw.inception\nFROM raw_claims raw\n", sql)
+        self.assertIn('JOIN labels prop ON prop.id = claim.prop_id', sql)
+        self.assertIn("LEFT JOIN labels entity ON entity.id = entry.item ->> 'qid'", sql)
+        self.assertIn("LEFT JOIN labels globe ON globe.id = entry.item ->> 'globe'", sql)
+        self.assertIn("ORDER BY item #>> '{}' COLLATE \"C\"", sql)
+        self.assertEqual(sql.count('('), sql.count(')'))
+        self.assertNotIn('{{', sql)
+
+        cursor = RecordingCursor()
+        resolve_labels(cursor)
+        columns = '(wikipedia_id, title, wikidata_id, description, properties)'
+        self.assertIn('INSERT INTO wikidata %s\n' % columns, cursor.statements[0])
+        self.assertIn("), '{}'::jsonb)\nFROM wikidata_raw raw\n", cursor.statements[0])
+
+    def test_lazy_entity(self):
+        netherlands = dict(ENTITIES[6])
+        netherlands['labels'] = {'de': {'value': 'Niederlande'}, 'en': {'value': 'Netherlands'}}
+        netherlands['descriptions'] = {'en': {'value': 'country in "labels": Europe'}, 'nl': {'value': 'land'}}
+        netherlands['aliases'] = {'en': [{'value': 'Holland'}]}
+        netherlands['sitelinks'] = {'dewiki': {'title': 'Niederlande'}, 'enwiki': {'title': 'Netherlands'}}
+        for line in json.dumps(netherlands), json.dumps(netherlands, separators=(',', ':')).encode('utf8'):
+            d = lazy_entity(line)
+            self.assertEqual(d['id'], 'Q55')
+            self.assertEqual(d['labels'], {'en': {'value': 'Netherlands'}})
+            self.assertEqual(d['descriptions'], {'en': {'value': 'country in "labels": Europe'}})
+            self.assertEqual(d['sitelinks'], {'enwiki': {'title': 'Netherlands'}})
+            self.assertEqual(d['claims'], netherlands['claims'])
+            self.assertNotIn('aliases', d)
+        self.assertEqual(lazy_entity(json.dumps(netherlands), claims=False)['claims'], {})
+        # no enwiki sitelink, so no claims either
+        self.assertEqual(lazy_entity(json.dumps(ENTITIES[4])), ENTITIES[4])
+        # the id after the sections isn't where we look for it, so this one is decoded in full
+        moved = {key: value for key, value in netherlands.items() if key != 'id'}
+        moved['id'] = 'Q55'
+        self.assertEqual(lazy_entity(json.dumps(moved)), moved)
+
+    def test_prefilter_lines(self):
+        lines = [b'[\n'] + [json.dumps(d).encode('utf8') + b',\n' for d in ENTITIES] + [b']\n']
+        kept = list(prefilter_lines(lines))
+        self.assertEqual([json.loads(line[:-2])['id'] for line in kept], ['Q3142', 'Q111', 'Q55', 'Q56'])
+
+    def test_entity_edges(self):
+        # the values of P625, P1082 and P571 aren't items
+        self.assertEqual(
+            entity_edges(ENTITIES[6]),
+            [
+                (55, 31, 404, 0),
+                (55, 31, 6256, 1),
+                (55, 462, 3142, 1),
+                (55, 462, 23444, 1),
+                (55, 462, 404, 1),
+                (55, 999, 3142, 1),
+            ],
+        )
+        self.assertEqual(entity_edges(ENTITIES[0]), [])
+
+    def test_typed_properties(self):
+        typed = parse_typed_properties('population:P1082:numeric, inception:P571:timestamp,location:P625:geography')
+        self.assertEqual(typed[0], ('population', 'P1082', 'numeric'))
+        for spec in 'population:P1082', 'population:P1082:int', 'Pop:P1082:numeric', 'title:P1082:numeric':
+            self.assertRaises(ValueError, parse_typed_properties, spec)
+        self.assertTrue(table_columns(typed).endswith(',    location GEOGRAPHY(POINT,4326))'))
+        self.assertEqual(table_indexes(typed)[-1], ('location', 'USING gist(location)'))
+        population, inception, location = typed_values(ENTITIES[6]['claims'], typed)
+        self.assertEqual(population, 17000000.0)
+        self.assertEqual(inception, '1581-07-26 00:00:00')
+        # Q111 isn't earth
+        self.assertEqual(location, None)
+        self.assertEqual(typed_values({}, typed), (None, None, None))
+        self.assertEqual(typed_timestamp('-500-03-15T00:00:00'), '0500-03-15 00:00:00 BC')
+        self.assertEqual(typed_timestamp('-1-01-01T00:00:00'), '0001-01-01 00:00:00 BC')
+        self.assertEqual(typed_timestamp('0-01-01T00:00:00'), None)
+        # 5 BC is astronomical year -4, a leap year, and 4 BC isn't
+        self.assertEqual(typed_timestamp('-5-02-29T00:00:00'), '0005-02-29 00:00:00 BC')
+        self.assertEqual(typed_timestamp('-4-02-29T00:00:00'), None)
+        self.assertEqual(typed_timestamp('-4713-01-01T00:00:00'), '4713-01-01 00:00:00 BC')
+        self.assertEqual(typed_timestamp('-4714-01-01T00:00:00'), None)
+        self.assertEqual(typed_timestamp('2000-02-29T00:00:00'), '2000-02-29 00:00:00')
+        self.assertEqual(typed_timestamp('1900-02-29T00:00:00'), None)
+        self.assertEqual(typed_timestamp('-13798000000-01-01T00:00:00'), None)
+
+    def test_single_pass(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            dump = os.path.join(tmp, 'wikidata.json.bz2')
+            with open(dump, 'wb') as fout:
+                lines = ['[\n'] + [json.dumps(d) + ',\n' for d in ENTITIES] + [']\n']
+                fout.write(bz2.compress(''.join(lines).encode('utf8')))
+            two_pass = []
+            main(dump, FakeWriter(two_pass))
+            compact = []
+            main(dump, FakeWriter(compact), compact=True, names_file=os.path.join(tmp, 'names'))
+            # the second time around the names are read from the names file
+            reused = []
+            main(dump, FakeWriter(reused), names_file=os.path.join(tmp, 'names'))
+            parallel = []
+            main(dump, FakeWriter(parallel), compact=True, workers=2)
+            with self.assertRaises(ValueError):
+                main(dump, FakeWriter([]), workers=2)
+            # the workers get the names through the pool's initializer, so they don't rely on forking
+            spawned = []
+            with mock.patch.object(import_wikidata, 'multiprocessing', multiprocessing.get_context('spawn')):
+                main(dump, FakeWriter(spawned), names_file=os.path.join(tmp, 'names'), workers=2)
+            raw = []
+            labels = []
+            main_single_pass(dump, FakeWriter(raw), FakeWriter(labels))
+            parallel_raw = []
+            parallel_labels = []
+            main_single_pass(dump, FakeWriter(parallel_raw), FakeWriter(parallel_labels), compact=True, workers=2)
+            typed = parse_typed_properties('population:P1082:numeric,inception:P571:timestamp')
+            typed_two_pass = []
+            edges = []
+            main(dump, FakeWriter(typed_two_pass), True, typed=typed, workers=2, edge_writer=FakeWriter(edges))
+            typed_raw = []
+            single_pass_edges = []
+            main_single_pass(
+                dump, FakeWriter(typed_raw), FakeWriter([]), typed=typed, edge_writer=FakeWriter(single_pass_edges)
+            )
+        # Q56 has the same enwiki page as Q55, so it is dropped as a duplicate either way
+        articles = [('Red', 'red', 'Q3142'), ('Mars', 'Mars', 'Q111'), ('Netherlands', 'Netherlands', 'Q55')]
+        self.assertEqual([row[:3] for row in two_pass], articles)
+        self.assertEqual(compact, two_pass)
+        self.assertEqual(reused, two_pass)
+        self.assertEqual(parallel, two_pass)
+        self.assertEqual(spawned, two_pass)
+        self.assertEqual(parallel_raw, raw)
+        self.assertEqual(parallel_labels, labels)
+        self.assertEqual([row[:3] for row in raw], articles)
+        names = dict(labels)
+        self.assertEqual(names['Q3142'], 'Red')
+        self.assertEqual(names['Q23444'], 'white')
+        self.assertEqual([model_resolve(row[4], names) for row in raw], [row[4] for row in two_pass])
+        self.assertEqual(two_pass[2][4]['color'], ['Red', 'white'])
+        self.assertEqual([row[:5] for row in typed_two_pass], two_pass)
+        expected = [(None, None), (None, None), (17e6, '1581-07-26 00:00:00')]
+        self.assertEqual([row[5:] for row in typed_two_pass], expected)
+        self.assertEqual([row[5:] for row in typed_raw], [row[5:] for row in typed_two_pass])
+        self.assertEqual(edges, entity_edges(ENTITIES[6]))
+        self.assertEqual(single_pass_edges, edges)
+
 
 if __name__ == '__main__':
     unittest.main()
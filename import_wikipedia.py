@@ -1,45 +1,153 @@
 #!/usr/bin/env python
 
 import argparse
-import subprocess
+import functools
+import itertools
+import multiprocessing
+import os
+import time
+import xml.parsers.expat
 import xml.sax
-from collections import OrderedDict
+import zlib
+from xml.etree import ElementTree
+from collections import OrderedDict, deque
 
 import mwparserfromhell
 import psycopg2
 import re
 
+import fast_wikitext
+import instrument
+from bulk_writer import BulkWriter, geo_point, upsert_clause
+from decompress import open_compressed
+from staged_load import DEFAULT_INDEX_WORKERS, TableLoad
+
 CAT_PREFIX = 'Category:'
 INFOBOX_PREFIX = 'infobox '
 
 RE_GENERAL = re.compile('(.+?)(\ (in|of|by)\ )(.+)')
 
-
-def setup_db(connection_string):
+COLUMNS = ('title', 'wiki_id', 'infobox', 'wikitext', 'templates', 'categories', 'general', 'lng_lat')
+# precomputed with --features, so analyses like wiki_people don't have to parse the wikitext all over again
+FEATURE_COLUMNS = ('word_count', 'pronouns', 'infobox_params', 'wikilinks')
+WORD_RE = re.compile(r'\w+')
+PRONOUNS = ('he', 'his', 'him', 'she', 'her')
+# where the wikitext goes: the wikitext column, the wikipedia_wikitext side table, the wikitext_zlib column or
+# nowhere, keeping just the dump and bz2 stream offset to fetch it from later
+WIKITEXT_MODES = ('inline', 'table', 'compressed', 'none')
+# the columns the wikitext modes store a page's text in, get_wikitext looks at them in this order
+WIKITEXT_STORAGE_COLUMNS = ('wikitext', 'wikitext_zlib', 'dump', 'stream_offset')
+
+# pages handed to a worker in one go; big enough to amortize the pickling, small enough to keep workers busy
+PIPELINE_CHUNK_SIZE = 64
+# block size for the readers that don't go line by line
+READ_BLOCK_SIZE = 1024 * 1024
+
+TABLE_COLUMNS = (
+    '('
+    '    title TEXT PRIMARY KEY,'
+    '    wiki_id INTEGER,'
+    '    infobox TEXT,'
+    '    wikitext TEXT,'
+    '    templates TEXT[] NOT NULL DEFAULT \'{}\','
+    '    categories TEXT[] NOT NULL DEFAULT \'{}\','
+    '    general TEXT[] NOT NULL DEFAULT \'{}\','
+    '    lng_lat GEOGRAPHY(POINT,4326),'
+    '    wikitext_zlib BYTEA,'
+    '    dump TEXT,'
+    '    stream_offset BIGINT,'
+    '    word_count INTEGER,'
+    '    pronouns JSONB,'
+    '    infobox_params JSONB,'
+    '    wikilinks TEXT[]'
+    ')'
+)
+TABLE_INDEXES = [
+    ('infobox', '(infobox)'),
+    ('templates', 'USING gin(templates)'),
+    ('categories', 'USING gin(categories)'),
+    ('general', 'USING gin(general)'),
+    ('lng_lat', 'USING GIST(lng_lat)'),
+    ('wiki_id', '(wiki_id)'),
+]
+
+
+WIKITEXT_COLUMNS = ('title', 'wikitext')
+WIKITEXT_TABLE_COLUMNS = '(title TEXT PRIMARY KEY, wikitext TEXT)'
+
+REDIRECT_COLUMNS = ('from_title', 'to_title')
+REDIRECT_TABLE_COLUMNS = '(from_title TEXT PRIMARY KEY, to_title TEXT NOT NULL)'
+REDIRECT_TABLE_INDEXES = [('to_title', '(to_title)')]
+
+# the adds-changes dumps applied by an incremental import
+INCREMENTAL_TABLE = (
+    'CREATE TABLE IF NOT EXISTS wikipedia_incremental ('
+    '    dump_date TEXT PRIMARY KEY,'
+    '    applied_at TIMESTAMP NOT NULL DEFAULT now(),'
+    '    pages INTEGER,'
+    '    deleted INTEGER'
+    ')'
+)
+RE_DUMP_DATE = re.compile(r'(\d{8})')
+
+# where a full import got to, so it can be resumed
+CHECKPOINT_TABLE = (
+    'CREATE TABLE IF NOT EXISTS wikipedia_checkpoint ('
+    '    dump TEXT PRIMARY KEY,'
+    '    page_id INTEGER NOT NULL,'
+    '    stream_offset BIGINT NOT NULL,'
+    '    pages INTEGER NOT NULL,'
+    '    updated_at TIMESTAMP NOT NULL DEFAULT now()'
+    ')'
+)
+DEFAULT_COMMIT_EVERY = 100000
+
+
+def setup_db(connection_string, staged=False, resume=False):
     conn = psycopg2.connect(connection_string)
     cursor = conn.cursor()
-    cursor.execute('DROP TABLE IF EXISTS wikipedia')
-    cursor.execute(
-        'CREATE TABLE wikipedia ('
-        '    title TEXT PRIMARY KEY,'
-        '    wiki_id INTEGER,'
-        '    infobox TEXT,'
-        '    wikitext TEXT,'
-        '    templates TEXT[] NOT NULL DEFAULT \'{}\','
-        '    categories TEXT[] NOT NULL DEFAULT \'{}\','
-        '    general TEXT[] NOT NULL DEFAULT \'{}\','
-        '    lng_lat GEOGRAPHY(POINT,4326)'
-        ')'
-    )
-    cursor.execute('CREATE INDEX wikipedia_infobox ON wikipedia(infobox)')
-    cursor.execute('CREATE INDEX wikipedia_templates ON wikipedia USING gin(templates)')
-    cursor.execute('CREATE INDEX wikipedia_categories ON wikipedia USING gin(categories)')
-    cursor.execute('CREATE INDEX wikipedia_general ON wikipedia USING gin(general)')
-    cursor.execute('CREATE INDEX wikipedia_lng_lat ON wikipedia USING GIST(lng_lat)')
+    load = TableLoad('wikipedia', TABLE_COLUMNS, TABLE_INDEXES, staged)
+    if not resume:
+        load.create(cursor)
+
+    return conn, cursor, load
+
+
+def setup_redirects(cursor, staged=False, resume=False):
+    load = TableLoad('wikipedia_redirect', REDIRECT_TABLE_COLUMNS, REDIRECT_TABLE_INDEXES, staged)
+    if not resume:
+        load.create(cursor)
+    return load
+
 
+def setup_wikitext(cursor, staged=False, resume=False):
+    load = TableLoad('wikipedia_wikitext', WIKITEXT_TABLE_COLUMNS, [], staged)
+    if not resume:
+        load.create(cursor)
+    return load
+
+
+def setup_incremental(connection_string, redirects=False, wikitext='inline'):
+    """Make sure the tables exist without touching what is in them."""
+    conn = psycopg2.connect(connection_string)
+    cursor = conn.cursor()
+    TableLoad('wikipedia', TABLE_COLUMNS, TABLE_INDEXES).ensure(cursor)
+    if redirects:
+        TableLoad('wikipedia_redirect', REDIRECT_TABLE_COLUMNS, REDIRECT_TABLE_INDEXES).ensure(cursor)
+    if wikitext == 'table':
+        TableLoad('wikipedia_wikitext', WIKITEXT_TABLE_COLUMNS, []).ensure(cursor)
+    cursor.execute(INCREMENTAL_TABLE)
+    conn.commit()
     return conn, cursor
 
 
+def page_columns(features=False, wikitext='inline'):
+    """The columns written for each page, rows from parse_page are turned into these by WikitextWriter."""
+    stored = {'inline': ('wikitext',), 'table': (), 'compressed': ('wikitext_zlib',), 'none': ('dump', 'stream_offset')}
+    columns = COLUMNS[:3] + stored[wikitext] + COLUMNS[4:]
+    return columns + FEATURE_COLUMNS if features else columns
+
+
 def make_tags(iterable):
     return list(set(x.strip().lower() for x in iterable if x and len(x) < 256))
 
@@ -91,13 +199,268 @@ def parse_coordinate(template):
     return lat, lng
 
 
-class WikiXmlHandler(xml.sax.handler.ContentHandler):
-    def __init__(self, cursor, record_limit):
+def extract_features(wikicode):
+    """Return (word_count, pronoun counts, infobox parameters, wikilink titles) for a parsed page.
+
+    Infobox parameter values are kept as wikitext, so links in them (a birth_place, say) can still be followed.
+    """
+    words = [w.lower() for w in WORD_RE.findall(wikicode.strip_code())]
+    pronouns = dict.fromkeys(PRONOUNS, 0)
+    for word in words:
+        if word in pronouns:
+            pronouns[word] += 1
+    infobox_params = {}
+    for template in wikicode.filter_templates():
+        if template.name.lower().startswith('infobox'):
+            for param in template.params:
+                infobox_params[str(param.name).strip().lower()] = str(param.value).strip()
+    wikilinks = [str(link.title) for link in wikicode.filter_wikilinks()]
+    return len(words), pronouns, infobox_params, wikilinks
+
+
+def parse_page(page, fast=False, features=False, wikitext='inline'):
+    """Turn a raw (title, wiki_id, wikitext) page into a row for the wikipedia table.
+
+    Returns a tuple with a value for each of page_columns(features) or None if the page could not be parsed. This
+    is a plain function so it can be shipped off to worker processes. With fast set, fast_wikitext is tried before
+    falling back to a full mwparserfromhell parse. The features need the full parse, so they bypass the fast path.
+
+    The wikitext is compressed here for the compressed mode and dropped for mode none, so that work is done by
+    the workers and the text isn't shipped back from them for nothing.
+    """
+    title, wiki_id, text = page
+    try:
+        extracted = fast_wikitext.extract(text) if fast and not features else None
+        if extracted is not None:
+            template_dict, category_titles = extracted
+        else:
+            wikicode = mwparserfromhell.parse(text)
+            template_dict = OrderedDict(
+                (strip_template_name(template.name), template) for template in wikicode.filter_templates()
+            )
+            category_titles = [
+                l.title[len(CAT_PREFIX) :] for l in wikicode.filter_wikilinks() if l.title.startswith(CAT_PREFIX)
+            ]
+        lat = lng = None
+        for template_name, template in template_dict.items():
+            if template_name.lower() in ('coord missing', 'coord unknown'):
+                continue
+            if any(template_name.lower().startswith(prefix) for prefix in ('coor', 'geolinks')):
+                try:
+                    lat, lng = parse_coordinate(fast_wikitext.as_template(template))
+                except ValueError:
+                    continue
+                if lat and lng:
+                    break
+
+        templates = make_tags(template_dict.keys())
+        infobox = None
+        for template in templates:
+            if template.startswith(INFOBOX_PREFIX):
+                infobox = template[len(INFOBOX_PREFIX) :]
+                break
+        if len(infobox or '') > 1024 or len(title) > 1024:
+            raise mwparserfromhell.parser.ParserError('too long')
+        categories = make_tags(category_titles)
+        general = make_tags(extact_general(x) for x in categories)
+        if wikitext == 'compressed':
+            text = zlib.compress(text.encode('utf8'))
+        elif wikitext == 'none':
+            text = None
+        row = title, int(wiki_id), infobox, text, templates, categories, general, geo_point(lng, lat)
+        if features:
+            row += extract_features(wikicode)
+    except mwparserfromhell.parser.ParserError:
+        print('mwparser error for:', title)
+        return None
+
+    return row
+
+
+def has_lng_lat(row):
+    lng_lat = row[7]
+    return bool(lng_lat and lng_lat.lng and lng_lat.lat)
+
+
+class WikitextWriter:
+    """Writes rows from parse_page, putting their wikitext where the wikitext mode says it goes."""
+
+    def __init__(self, writer, wikitext='inline', wikitext_writer=None, dump=None, stream_offset=None):
+        """wikitext_writer takes the (title, wikitext) rows for mode table, dump and stream_offset (a function
+        from page id to offset, see Checkpoint) fill in the reference for mode none."""
+        self._writer = writer
+        self._wikitext = wikitext
+        self._wikitext_writer = wikitext_writer
+        self._dump = os.path.basename(dump) if dump else None
+        self._stream_offset = stream_offset
+
+    @property
+    def count(self):
+        return self._writer.count
+
+    def add(self, row):
+        if self._wikitext == 'table':
+            self._wikitext_writer.add((row[0], row[3]))
+            row = row[:3] + row[4:]
+        elif self._wikitext == 'none':
+            offset = self._stream_offset(row[1]) if self._stream_offset else None
+            row = row[:3] + (self._dump, offset) + row[4:]
+        self._writer.add(row)
+
+    def flush(self):
+        self._writer.flush()
+        if self._wikitext_writer:
+            self._wikitext_writer.flush()
+
+    def close(self):
+        self._writer.close()
+        if self._wikitext_writer:
+            self._wikitext_writer.close()
+
+
+def make_writer(
+    cursor,
+    table='wikipedia',
+    features=False,
+    wikitext='inline',
+    wikitext_table='wikipedia_wikitext',
+    dump=None,
+    stream_offset=None,
+):
+    # even though we shouldn't get dupes, sometimes wikidumps are faulty, so merge with ON CONFLICT DO NOTHING
+    writer = BulkWriter(cursor, table, page_columns(features, wikitext), on_conflict='DO NOTHING')
+    if wikitext == 'inline':
+        return writer
+    wikitext_writer = None
+    if wikitext == 'table':
+        wikitext_writer = BulkWriter(cursor, wikitext_table, WIKITEXT_COLUMNS, on_conflict='DO NOTHING')
+    return WikitextWriter(writer, wikitext, wikitext_writer, dump, stream_offset)
+
+
+def make_redirect_writer(cursor, table='wikipedia_redirect'):
+    return BulkWriter(cursor, table, REDIRECT_COLUMNS, on_conflict='DO NOTHING')
+
+
+def make_incremental_writers(cursor, redirects=False, features=False, wikitext='inline', dump=None):
+    """Writers that overwrite existing rows, and clean up after pages that were moved or turned into redirects.
+
+    The adds-changes dumps aren't multistream dumps with an index, so their pages can't be stored with mode none.
+    """
+    if wikitext == 'none':
+        raise ValueError('incremental imports can not store the wikitext with mode none')
+    after_merge = []
+    if wikitext == 'table':
+        after_merge.append(
+            'DELETE FROM wikipedia_wikitext USING wikipedia, {copy_table} c WHERE wikipedia_wikitext.title = '
+            'wikipedia.title AND wikipedia.wiki_id = c.wiki_id AND wikipedia.title <> c.title'
+        )
+    # a moved page comes back with the same wiki_id under its new title
+    after_merge.append(
+        'DELETE FROM wikipedia USING {copy_table} c WHERE wikipedia.wiki_id = c.wiki_id AND wikipedia.title <> c.title'
+    )
+    if redirects:
+        after_merge.append('DELETE FROM wikipedia_redirect USING {copy_table} c WHERE from_title = c.title')
+    columns = page_columns(features, wikitext)
+    # a page stored with another mode before would keep its old text there, which get_wikitext could find first
+    stale = [column for column in WIKITEXT_STORAGE_COLUMNS if column not in columns]
+    on_conflict = upsert_clause('title', columns) + ''.join(', %s = NULL' % column for column in stale)
+    writer = BulkWriter(cursor, 'wikipedia', columns, on_conflict=on_conflict, after_merge=after_merge)
+    if wikitext != 'inline':
+        wikitext_writer = None
+        if wikitext == 'table':
+            wikitext_writer = BulkWriter(
+                cursor, 'wikipedia_wikitext', WIKITEXT_COLUMNS, on_conflict=upsert_clause('title', WIKITEXT_COLUMNS)
+            )
+        writer = WikitextWriter(writer, wikitext, wikitext_writer, dump)
+    redirect_writer = None
+    if redirects:
+        redirect_after_merge = ['DELETE FROM wikipedia USING {copy_table} c WHERE title = c.from_title']
+        if wikitext == 'table':
+            redirect_after_merge.append(
+                'DELETE FROM wikipedia_wikitext USING {copy_table} c WHERE title = c.from_title'
+            )
+        redirect_writer = BulkWriter(
+            cursor,
+            'wikipedia_redirect',
+            REDIRECT_COLUMNS,
+            on_conflict=upsert_clause('from_title', REDIRECT_COLUMNS),
+            after_merge=redirect_after_merge,
+        )
+    return writer, redirect_writer
+
+
+class Checkpoint:
+    """Commits the import every commit_every pages and records how far it got in the same transaction.
+
+    The checkpoint is the id of the last committed page plus, when a multistream index is available, the offset
+    of the bz2 stream holding it, so a resumed import can start decompressing right there. stream_offset is a
+    function from page id to offset, e.g. MultistreamDump.stream_offset.
+    """
+
+    def __init__(self, conn, cursor, dump, writers, commit_every=DEFAULT_COMMIT_EVERY, stream_offset=None):
+        self._conn = conn
+        self._cursor = cursor
+        self._dump = os.path.basename(dump)
+        self._writers = writers
+        self._commit_every = commit_every
+        self._stream_offset = stream_offset
+        self._pending = 0
+        self.page_id = 0
+        self.offset = 0
+        self.pages = 0
+
+    def start(self, resume=False):
+        self._cursor.execute(CHECKPOINT_TABLE)
+        if resume:
+            self._cursor.execute(
+                'SELECT page_id, stream_offset, pages FROM wikipedia_checkpoint WHERE dump = %s', (self._dump,)
+            )
+            row = self._cursor.fetchone()
+            if row:
+                self.page_id, self.offset, self.pages = row
+                print('resuming after page', self.page_id, 'at offset', self.offset)
+        else:
+            self._cursor.execute('DELETE FROM wikipedia_checkpoint WHERE dump = %s', (self._dump,))
+        self._conn.commit()
+
+    def page_done(self, page_id):
+        self.page_id = int(page_id)
+        self.pages += 1
+        self._pending += 1
+        if self._pending >= self._commit_every:
+            self.commit()
+
+    def commit(self):
+        with instrument.stage('checkpoint'):
+            for writer in self._writers:
+                if writer:
+                    writer.flush()
+            if self._stream_offset and self.page_id:
+                self.offset = self._stream_offset(self.page_id) or 0
+            self._cursor.execute(
+                'INSERT INTO wikipedia_checkpoint (dump, page_id, stream_offset, pages) VALUES (%s, %s, %s, %s) '
+                'ON CONFLICT (dump) DO UPDATE SET page_id = excluded.page_id, stream_offset = excluded.stream_offset, '
+                'pages = excluded.pages, updated_at = now()',
+                (self._dump, self.page_id, self.offset, self.pages),
+            )
+            self._conn.commit()
+        self._pending = 0
+
+
+class PageSplitter(xml.sax.handler.ContentHandler):
+    """Splits the dump into raw (title, wiki_id, wikitext) pages and hands each one to on_page.
+
+    Pages outside of namespaces (if given) are dropped and, if on_redirect is given, redirects are handed to it as
+    (from_title, to_title). When resuming, pages up to and including after_page_id are dropped too. All of that is
+    decided on the elements that come before the <text>, so the text of such pages is never even collected.
+    """
+
+    def __init__(self, on_page, namespaces=None, on_redirect=None, after_page_id=0):
         xml.sax.handler.ContentHandler.__init__(self)
-        self._db_cursor = cursor
-        self._count = 0
-        self._lng_lat = 0
-        self._record_limit = record_limit
+        self._on_page = on_page
+        self._namespaces = namespaces
+        self._on_redirect = on_redirect
+        self._after_page_id = after_page_id
         self.reset()
 
     def reset(self):
@@ -105,8 +468,22 @@ class WikiXmlHandler(xml.sax.handler.ContentHandler):
         self._state = None
         self._values = {}
 
+    def skip(self):
+        if self._after_page_id and int(self._values.get('id', 0)) <= self._after_page_id:
+            return True
+        return self._namespaces is not None and int(self._values.get('ns', 0)) not in self._namespaces
+
+    def is_redirect(self):
+        return self._on_redirect is not None and 'redirect' in self._values
+
     def startElement(self, name, attrs):
-        if name in ('title', 'text', 'id'):
+        if name == 'redirect':
+            self._values['redirect'] = attrs.get('title', '')
+        elif name == 'text':
+            if not self.skip() and not self.is_redirect():
+                self._state = name
+        # the page id comes first; revisions and contributors have ids of their own
+        elif name in ('title', 'ns') or (name == 'id' and 'id' not in self._values):
             self._state = name
 
     def endElement(self, name):
@@ -116,95 +493,455 @@ class WikiXmlHandler(xml.sax.handler.ContentHandler):
             self._buffer = []
 
         if name == 'page':
-            try:
-                wikicode = mwparserfromhell.parse(self._values['text'])
-                template_dict = OrderedDict(
-                    (strip_template_name(template.name), template) for template in wikicode.filter_templates()
-                )
-                lat = lng = None
-                for template_name, template in template_dict.items():
-                    if template_name.lower() in ('coord missing', 'coord unknown'):
-                        continue
-                    if any(template_name.lower().startswith(prefix) for prefix in ('coor', 'geolinks')):
-                        try:
-                            lat, lng = parse_coordinate(template)
-                        except ValueError:
-                            continue
-                        if lat and lng:
-                            break
-
-                if lat and lng:
-                    self._lng_lat += 1
-                templates = make_tags(template_dict.keys())
-                infobox = None
-                for template in templates:
-                    if template.startswith(INFOBOX_PREFIX):
-                        infobox = template[len(INFOBOX_PREFIX) :]
-                        break
-                if len(infobox or '') > 1024 or len(self._values['title']) > 1024:
-                    raise mwparserfromhell.parser.ParserError('too long')
-                categories = make_tags(
-                    l.title[len(CAT_PREFIX) :] for l in wikicode.filter_wikilinks() if l.title.startswith(CAT_PREFIX)
-                )
-                general = make_tags(extact_general(x) for x in categories)
-
-                to_insert = (
-                    self._values['title'],
-                    int(self._values['id']),
-                    infobox,
-                    self._values['text'],
-                    templates,
-                    categories,
-                    general,
-                )
-                if lat is None or lng is None:
-                    place_holder = 'NULL'
-                else:
-                    to_insert += (lng, lat)
-                    place_holder = "ST_GeographyFromText('SRID=4326;POINT(%s %s)')"
-                # even though we shouldn't get dupes, sometimes wikidumps are faulty:
-                sql = (
-                    "INSERT INTO wikipedia "
-                    "(title, wiki_id, infobox, wikitext, templates, categories, general, lng_lat) "
-                    "VALUES (%s, %s, %s, %s, %s, %s, %s, " + place_holder + ") "
-                    "ON CONFLICT DO NOTHING"
-                )
-
-                self._db_cursor.execute(sql, to_insert)
-                self._count += 1
-                if self._count % 100000 == 0:
-                    print(self._count, self._lng_lat)
-                if self._record_limit and self._count >= self._record_limit:
-                    raise StopIteration
-            except mwparserfromhell.parser.ParserError:
-                print('mwparser error for:', self._values['title'])
-
+            skip = self.skip()
+            is_redirect = self.is_redirect()
+            values = self._values
             self.reset()
+            if skip:
+                return
+            if is_redirect:
+                self._on_redirect((values['title'], values['redirect']))
+            else:
+                self._on_page((values['title'], values['id'], values.get('text', '')))
 
     def characters(self, content):
         if self._state:
             self._buffer.append(content)
 
 
-def main(dump, cursor, record_limit):
+class RowSink:
+    """Writes parsed rows, keeping the checkpoint and the progress counts up to date."""
+
+    def __init__(self, writer, record_limit=0, checkpoint=None):
+        self._writer = writer
+        self._record_limit = record_limit
+        self._checkpoint = checkpoint
+        self.count = 0
+        self.lng_lat = 0
+        self._start = time.time()
+
+    def add(self, row):
+        """Write row, returns True once record_limit rows have been written."""
+        with instrument.stage('write'):
+            self._writer.add(row)
+            if self._checkpoint:
+                self._checkpoint.page_done(row[1])
+        instrument.count('write', 1)
+        self.count += 1
+        if has_lng_lat(row):
+            self.lng_lat += 1
+        if self.count % 100000 == 0:
+            print(self.count, self.lng_lat, '%.0f pages/sec' % (self.count / (time.time() - self._start)))
+        return bool(self._record_limit and self.count >= self._record_limit)
+
+
+class WikiXmlHandler(PageSplitter):
+    """Parses and inserts every page as it comes by, all in the current process."""
+
+    def __init__(self, writer, record_limit=0, fast=False, namespaces=None, redirect_writer=None, checkpoint=None):
+        PageSplitter.__init__(
+            self,
+            self.handle_page,
+            namespaces,
+            redirect_writer.add if redirect_writer else None,
+            checkpoint.page_id if checkpoint else 0,
+        )
+        self._sink = RowSink(writer, record_limit, checkpoint)
+        self._fast = fast
+
+    def handle_page(self, page):
+        row = parse_page(page, self._fast)
+        if row is not None and self._sink.add(row):
+            raise StopIteration
+
+
+def iter_pages_sax(chunks, namespaces=None, on_redirect=None, after_page_id=0):
+    """Feed the chunks to an xml.sax parser with a PageSplitter as its handler."""
+    pages = []
     parser = xml.sax.make_parser()
-    parser.setContentHandler(WikiXmlHandler(cursor, record_limit))
-    for line in subprocess.Popen(['bzcat'], stdin=open(dump), stdout=subprocess.PIPE).stdout:
-        try:
-            parser.feed(line)
-        except StopIteration:
-            break
+    parser.setContentHandler(PageSplitter(pages.append, namespaces, on_redirect, after_page_id))
+    for chunk in chunks:
+        parser.feed(chunk)
+        if pages:
+            yield from pages
+            del pages[:]
+
+
+def iter_pages_expat(chunks, namespaces=None, on_redirect=None, after_page_id=0):
+    """Drive a PageSplitter straight from expat, skipping the xml.sax layer.
+
+    buffer_text makes expat hand over text in as few pieces as it can, rather than one call per line or entity.
+    """
+    pages = []
+    splitter = PageSplitter(pages.append, namespaces, on_redirect, after_page_id)
+    parser = xml.parsers.expat.ParserCreate()
+    parser.buffer_text = True
+    parser.buffer_size = READ_BLOCK_SIZE
+    parser.StartElementHandler = splitter.startElement
+    parser.EndElementHandler = splitter.endElement
+    parser.CharacterDataHandler = splitter.characters
+    for chunk in chunks:
+        parser.Parse(chunk, False)
+        if pages:
+            yield from pages
+            del pages[:]
+    parser.Parse(b'', True)
+    yield from pages
+
+
+def iter_pages_iterparse(chunks, namespaces=None, on_redirect=None, after_page_id=0):
+    """Build each <page> as an ElementTree element and clear it once it has been handled."""
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    root = None
+    for chunk in chunks:
+        parser.feed(chunk)
+        for event, elem in parser.read_events():
+            if root is None:
+                root = elem
+            if event != 'end' or local_name(elem.tag) != 'page':
+                continue
+            values = {}
+            for child in elem.iter():
+                name = local_name(child.tag)
+                if name in ('title', 'ns', 'text') or (name == 'id' and 'id' not in values):
+                    values[name] = child.text or ''
+                elif name == 'redirect':
+                    values['redirect'] = child.get('title', '')
+            elem.clear()
+            root.clear()
+            if after_page_id and int(values.get('id', 0)) <= after_page_id:
+                continue
+            if namespaces is not None and int(values.get('ns', 0)) not in namespaces:
+                continue
+            if on_redirect is not None and 'redirect' in values:
+                on_redirect((values['title'], values['redirect']))
+            else:
+                yield values['title'], values['id'], values.get('text', '')
+
+
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+READERS = {'sax': iter_pages_sax, 'expat': iter_pages_expat, 'iterparse': iter_pages_iterparse}
+
+
+def iter_pages(chunks, namespaces=None, on_redirect=None, after_page_id=0, reader='sax'):
+    """Yield raw (title, wiki_id, wikitext) pages from the chunks (lines or blocks) of an xml dump."""
+    return READERS[reader](chunks, namespaces, on_redirect, after_page_id)
+
+
+def main_pipelined(
+    pages, sink, workers, fast=False, redirects=None, redirect_writer=None, features=False, wikitext='inline'
+):
+    """The reader splits pages in this process, a pool of workers parses them and the results are written here."""
+    parse = functools.partial(parse_page, fast=fast, features=features, wikitext=wikitext)
+    with multiprocessing.Pool(workers) as pool:
+        rows = instrument.timed(pool.imap(parse, pages, chunksize=PIPELINE_CHUNK_SIZE), 'parse (waiting on pool)')
+        for row in rows:
+            while redirects:
+                redirect_writer.add(redirects.popleft())
+            if row is not None and sink.add(row):
+                break
+    while redirects:
+        redirect_writer.add(redirects.popleft())
+
+
+def open_dump(dump, offset=0, block_size=0, decompress_workers=1):
+    """The decompressed dump as lines or, with block_size, as blocks, starting with the bz2 stream at offset.
+
+    A multistream dump is decompressed by decompress_workers threads if there is more than one.
+    """
+    chunks = open_compressed(dump, offset, block_size, decompress_workers)
+    if offset:
+        # the <mediawiki> header is in the first stream, which we skipped
+        return itertools.chain([b'<mediawiki>\n'], chunks)
+    return chunks
+
+
+def page_size(page):
+    return len(page[2])
+
+
+def main(
+    dump,
+    writer,
+    record_limit,
+    workers=1,
+    fast=False,
+    namespaces=None,
+    redirect_writer=None,
+    checkpoint=None,
+    reader='sax',
+    features=False,
+    wikitext='inline',
+    decompress_workers=1,
+):
+    # the sax reader gets the dump line by line like it always has, the others in big blocks
+    offset = checkpoint.offset if checkpoint else 0
+    chunks = open_dump(dump, offset, 0 if reader == 'sax' else READ_BLOCK_SIZE, decompress_workers)
+    # time spent waiting on bzcat and the bytes it decompressed; splitting includes that time
+    chunks = instrument.timed(chunks, 'decompress', len)
+    sink = RowSink(writer, record_limit, checkpoint)
+    after_page_id = checkpoint.page_id if checkpoint else 0
+    if workers > 1:
+        # the pool consumes the pages from a thread of its own, so redirects are handed over to be written from here
+        redirects = deque()
+        pages = iter_pages(chunks, namespaces, redirects.append if redirect_writer else None, after_page_id, reader)
+        pages = instrument.timed(pages, 'split pages', page_size)
+        main_pipelined(pages, sink, workers, fast, redirects, redirect_writer, features, wikitext)
+    else:
+        pages = iter_pages(chunks, namespaces, redirect_writer.add if redirect_writer else None, after_page_id, reader)
+        for page in instrument.timed(pages, 'split pages', page_size):
+            with instrument.stage('parse'):
+                row = parse_page(page, fast, features, wikitext)
+            instrument.count('parse', 1, page_size(page))
+            if row is not None and sink.add(row):
+                break
+    if checkpoint:
+        checkpoint.commit()
+
+
+def get_wikitext(cursor, title, dump_dir='.', index_db=None):
+    """The wikitext of the page with title, whichever way it was stored, or None if there is no such page.
+
+    Pages stored with mode none are read back from their dump in dump_dir. Without a stream offset that needs
+    the multistream index_db to find the page in the dump.
+    """
+    cursor.execute('SELECT wikitext, wikitext_zlib, dump, stream_offset FROM wikipedia WHERE title = %s', (title,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    wikitext, wikitext_zlib, dump, stream_offset = row
+    if wikitext is not None:
+        return wikitext
+    if wikitext_zlib is not None:
+        return zlib.decompress(bytes(wikitext_zlib)).decode('utf8')
+    if dump is not None:
+        from multistream import MultistreamDump, read_stream, stream_pages
+
+        if stream_offset is None:
+            if index_db is None:
+                raise ValueError('no stream offset for %s in %s, it needs the multistream index_db' % (title, dump))
+            with MultistreamDump(os.path.join(dump_dir, dump), index_db) as multistream:
+                page = multistream.get_page(title)
+                return page[2] if page else None
+        with open(os.path.join(dump_dir, dump), 'rb') as fin:
+            for page in stream_pages(read_stream(fin, stream_offset)):
+                if page[0] == title:
+                    return page[2]
+        return None
+    cursor.execute('SELECT wikitext FROM wikipedia_wikitext WHERE title = %s', (title,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def dump_date(dump):
+    m = RE_DUMP_DATE.search(os.path.basename(dump))
+    return m.group(1) if m else os.path.basename(dump)
+
+
+def delete_titles(cursor, titles, redirects=False, wikitext='inline'):
+    cursor.execute('DELETE FROM wikipedia WHERE title = ANY(%s)', (titles,))
+    deleted = cursor.rowcount
+    if wikitext == 'table':
+        cursor.execute('DELETE FROM wikipedia_wikitext WHERE title = ANY(%s)', (titles,))
+    if redirects:
+        cursor.execute('DELETE FROM wikipedia_redirect WHERE from_title = ANY(%s)', (titles,))
+        deleted += cursor.rowcount
+    return deleted
+
+
+def main_incremental(
+    dumps,
+    conn,
+    cursor,
+    workers=1,
+    fast=False,
+    namespaces=None,
+    redirects=False,
+    deletions=(),
+    force=False,
+    features=False,
+    wikitext='inline',
+    decompress_workers=1,
+):
+    """Apply adds-changes dumps in date order, one transaction each, skipping those applied before.
+
+    The adds-changes dumps have the latest revision of every page that changed, but say nothing about deleted
+    pages, so the titles of those are passed in as deletions and removed along with the last dump.
+    """
+    cursor.execute('SELECT dump_date FROM wikipedia_incremental')
+    applied = {row[0] for row in cursor.fetchall()}
+    todo = [dump for dump in sorted(dumps, key=dump_date) if force or dump_date(dump) not in applied]
+    for dump in dumps:
+        if dump not in todo:
+            print('already applied:', dump)
+    for idx, dump in enumerate(todo):
+        writer, redirect_writer = make_incremental_writers(cursor, redirects, features, wikitext, dump)
+        main(
+            dump,
+            writer,
+            0,
+            workers,
+            fast,
+            namespaces,
+            redirect_writer,
+            features=features,
+            wikitext=wikitext,
+            decompress_workers=decompress_workers,
+        )
+        writer.close()
+        pages = writer.count
+        if redirect_writer:
+            redirect_writer.close()
+            pages += redirect_writer.count
+        deleted = 0
+        if deletions and idx == len(todo) - 1:
+            deleted = delete_titles(cursor, list(deletions), redirects, wikitext)
+        cursor.execute(
+            'INSERT INTO wikipedia_incremental (dump_date, pages, deleted) VALUES (%s, %s, %s) '
+            'ON CONFLICT (dump_date) DO UPDATE SET applied_at = now(), pages = excluded.pages, deleted = excluded.deleted',
+            (dump_date(dump), pages, deleted),
+        )
+        conn.commit()
+        print(dump_date(dump), pages, deleted)
+    if deletions and not todo:
+        print('deleted', delete_titles(cursor, list(deletions), redirects, wikitext))
+        conn.commit()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Import wikipedia into postgress')
     parser.add_argument('--postgres', type=str, help='postgres connection string')
     parser.add_argument('--record_limit', type=int, default=0, help='if larger than 0, import only so many records')
-    parser.add_argument('dump', type=str, help='BZipped wikipedia dump')
+    parser.add_argument(
+        '--workers', type=int, default=1, help='if larger than 1, parse pages in a pool of this many processes'
+    )
+    parser.add_argument(
+        '--fast_parse', action='store_true', help='scan for templates and categories, only fully parse when needed'
+    )
+    parser.add_argument(
+        '--features', action='store_true', help='also store word counts, pronouns, infobox parameters and wikilinks'
+    )
+    parser.add_argument(
+        '--wikitext', type=str, default='inline', choices=WIKITEXT_MODES, help='where to store the wikitext'
+    )
+    parser.add_argument(
+        '--namespaces', type=str, default='', help='comma separated namespaces to import, e.g. 0 for articles only'
+    )
+    parser.add_argument(
+        '--redirects', action='store_true', help='store redirects in wikipedia_redirect rather than as pages'
+    )
+    parser.add_argument(
+        '--staged', action='store_true', help='load into an unlogged staging table and swap it in when done'
+    )
+    parser.add_argument(
+        '--index_workers', type=int, default=DEFAULT_INDEX_WORKERS, help='parallel index builds for --staged'
+    )
+    parser.add_argument(
+        '--reader', type=str, default='sax', choices=sorted(READERS), help='xml reader to split the dump with'
+    )
+    parser.add_argument(
+        '--commit_every', type=int, default=DEFAULT_COMMIT_EVERY, help='commit and checkpoint every so many pages'
+    )
+    parser.add_argument('--resume', action='store_true', help='continue an interrupted import from its checkpoint')
+    parser.add_argument(
+        '--index_db', type=str, help='multistream index built by multistream.py, lets --resume seek in the dump'
+    )
+    parser.add_argument(
+        '--incremental', action='store_true', help='upsert the pages from adds-changes dumps into the existing table'
+    )
+    parser.add_argument('--deletions', type=str, help='with --incremental, a file with titles of deleted pages')
+    parser.add_argument('--force', action='store_true', help='with --incremental, reapply dumps applied before')
+    parser.add_argument(
+        '--decompress_workers',
+        type=int,
+        default=1,
+        help='if larger than 1, decompress a multistream dump in this many threads',
+    )
+    parser.add_argument('dump', type=str, nargs='+', help='BZipped wikipedia dump, or adds-changes dumps')
+    instrument.add_arguments(parser)
 
     args = parser.parse_args()
-    conn, cursor = setup_db(args.postgres)
-
-    main(args.dump, cursor, args.record_limit)
-
-    conn.commit()
+    with instrument.instrumented('import_wikipedia', args.profile, args.stats):
+        namespaces = {int(ns) for ns in args.namespaces.split(',')} if args.namespaces else None
+        if args.incremental:
+            if args.wikitext == 'none':
+                parser.error('the adds-changes dumps can not be read back, so --incremental needs another --wikitext')
+            conn, cursor = setup_incremental(args.postgres, args.redirects, args.wikitext)
+            deletions = []
+            if args.deletions:
+                with open(args.deletions) as fin:
+                    deletions = [line.strip() for line in fin if line.strip()]
+            main_incremental(
+                args.dump,
+                conn,
+                cursor,
+                args.workers,
+                args.fast_parse,
+                namespaces,
+                args.redirects,
+                deletions,
+                args.force,
+                args.features,
+                args.wikitext,
+                args.decompress_workers,
+            )
+        else:
+            if len(args.dump) > 1:
+                parser.error('only --incremental imports take more than one dump')
+            if args.resume and args.staged:
+                # crash recovery empties unlogged tables, so the checkpoint can't be trusted for a staging table
+                parser.error('--resume can not be combined with --staged')
+            conn, cursor, load = setup_db(args.postgres, args.staged, args.resume)
+
+            stream_offset = None
+            if args.index_db:
+                from multistream import MultistreamDump
+
+                stream_offset = MultistreamDump(args.dump[0], args.index_db).stream_offset
+            wikitext_load = None
+            if args.wikitext == 'table':
+                wikitext_load = setup_wikitext(cursor, args.staged, args.resume)
+            writer = make_writer(
+                cursor,
+                load.target,
+                args.features,
+                args.wikitext,
+                wikitext_load.target if wikitext_load else None,
+                args.dump[0],
+                stream_offset,
+            )
+            redirect_load = redirect_writer = None
+            if args.redirects:
+                redirect_load = setup_redirects(cursor, args.staged, args.resume)
+                redirect_writer = make_redirect_writer(cursor, redirect_load.target)
+            checkpoint = Checkpoint(
+                conn, cursor, args.dump[0], [writer, redirect_writer], args.commit_every, stream_offset
+            )
+            checkpoint.start(args.resume)
+
+            main(
+                args.dump[0],
+                writer,
+                args.record_limit,
+                args.workers,
+                args.fast_parse,
+                namespaces,
+                redirect_writer,
+                checkpoint,
+                args.reader,
+                args.features,
+                args.wikitext,
+                args.decompress_workers,
+            )
+
+            writer.close()
+            if redirect_writer:
+                redirect_writer.close()
+            load.finish(conn, args.postgres, args.index_workers)
+            if redirect_load:
+                redirect_load.finish(conn, args.postgres, args.index_workers)
+            if wikitext_load:
+                wikitext_load.finish(conn, args.postgres, args.index_workers)
@@ -1,12 +1,30 @@
 #!/usr/bin/env python
 
+import bz2
+import os
+import tempfile
 import unittest
 import xml
 
 import mwparserfromhell
 
-import re
-from import_wikipedia import WikiXmlHandler, extact_general, parse_coordinate
+from import_wikipedia import (
+    COLUMNS,
+    READERS,
+    Checkpoint,
+    WikiXmlHandler,
+    WikitextWriter,
+    dump_date,
+    extact_general,
+    get_wikitext,
+    iter_pages,
+    page_columns,
+    parse_page,
+    main,
+    main_incremental,
+    make_incremental_writers,
+    parse_coordinate,
+)
 
 DUMP = """<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.mediawiki.org/xml/export-0.10/ http://www.mediawiki.org/xml/export-0.10.xsd" version="0.10" xml:lang="en">
   <siteinfo>
@@ -72,23 +90,55 @@ DUMP = """<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" xmlns:xsi
 </mediawiki>"""
 
 
-RE_PAR = re.compile('\(([^\)]+)\)')
+class FakeWriter:
+    def __init__(self):
+        self.results = []
+
+    def add(self, row):
+        self.results.append(dict(zip(COLUMNS, row)))
+
+    def flush(self):
+        pass
+
+
+class FakeRedirectWriter:
+    def __init__(self, redirects):
+        self.add = redirects.append
 
 
 class FakeCursor:
+    def __init__(self, applied=(), checkpoint=None):
+        self.statements = []
+        self.copied = []
+        self.rowcount = 0
+        self._applied = applied
+        self._checkpoint = checkpoint
+
+    def execute(self, sql, params=None):
+        self.statements.append((sql, params))
+
+    def copy_expert(self, sql, data):
+        self.copied.append(data.read())
+
+    def fetchall(self):
+        return [(d,) for d in self._applied]
+
+    def fetchone(self):
+        return self._checkpoint
+
+
+class FakeConnection:
     def __init__(self):
-        self.results = []
+        self.commits = 0
 
-    def execute(self, sql, params):
-        g = RE_PAR.search(sql)
-        fields = [x.strip() for x in g.group(1).split(',')]
-        self.results.append(dict(zip(fields, params)))
+    def commit(self):
+        self.commits += 1
 
 
 class TestImportWikipedia(unittest.TestCase):
     def test_parse_wikipedia(self):
         parser = xml.sax.make_parser()
-        fc = FakeCursor()
+        fc = FakeWriter()
         parser.setContentHandler(WikiXmlHandler(fc))
         for line in DUMP.split('\n'):
             parser.feed(line + '\n')
@@ -101,6 +151,154 @@ class TestImportWikipedia(unittest.TestCase):
         self.assertTrue('main article' in fc.results[1]['templates'])
         self.assertTrue('ideas' in fc.results[1]['general'])
 
+    def test_redirects_and_namespaces(self):
+        parser = xml.sax.make_parser()
+        fc = FakeWriter()
+        redirects = []
+        parser.setContentHandler(WikiXmlHandler(fc, namespaces={0}, redirect_writer=FakeRedirectWriter(redirects)))
+        for line in DUMP.split('\n'):
+            parser.feed(line + '\n')
+        self.assertEqual([r['title'] for r in fc.results], ['Anarchism'])
+        self.assertEqual(redirects, [('AccessibleComputing', 'Computer accessibility')])
+
+        pages = list(iter_pages((line + '\n' for line in DUMP.split('\n')), namespaces={4}))
+        self.assertEqual(pages, [])
+
+    def test_features(self):
+        text = (
+            "{{Infobox writer\n| name = Jane Doe\n| birth_place = [[Leiden]], [[Netherlands]]\n}}\n"
+            "'''Jane Doe''' was a [[writer]]. She wrote a book, her first.\n[[Category:1905 births]]"
+        )
+        row = dict(zip(page_columns(True), parse_page(('Jane Doe', '7', text), fast=True, features=True)))
+        self.assertEqual(row['infobox'], 'writer')
+        self.assertEqual(row['word_count'], 14)
+        self.assertEqual(row['pronouns'], {'he': 0, 'his': 0, 'him': 0, 'she': 1, 'her': 1})
+        self.assertEqual(row['infobox_params'], {'name': 'Jane Doe', 'birth_place': '[[Leiden]], [[Netherlands]]'})
+        self.assertEqual(row['wikilinks'], ['Leiden', 'Netherlands', 'writer', 'Category:1905 births'])
+        self.assertEqual(len(parse_page(('Jane Doe', '7', text))), len(COLUMNS))
+
+    def test_iter_pages(self):
+        pages = list(iter_pages(line + '\n' for line in DUMP.split('\n')))
+        self.assertEqual([(title, wiki_id) for title, wiki_id, _ in pages], [('AccessibleComputing', '10'), ('Anarchism', '12')])
+
+    def test_readers_agree(self):
+        blocks = [DUMP.encode('utf8')[i : i + 500] for i in range(0, len(DUMP.encode('utf8')), 500)]
+        expected = list(iter_pages(line + '\n' for line in DUMP.split('\n')))
+        for reader in READERS:
+            self.assertEqual(list(iter_pages(blocks, reader=reader)), expected, reader)
+            redirects = []
+            pages = list(iter_pages(blocks, namespaces={0}, on_redirect=redirects.append, reader=reader))
+            self.assertEqual([page[0] for page in pages], ['Anarchism'], reader)
+            self.assertEqual(redirects, [('AccessibleComputing', 'Computer accessibility')], reader)
+            self.assertEqual(list(iter_pages(blocks, after_page_id=10, reader=reader)), expected[1:], reader)
+
+    def test_pipelined_matches_single_process(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            dump = os.path.join(tmp, 'dump.xml.bz2')
+            with open(dump, 'wb') as fout:
+                fout.write(bz2.compress(DUMP.encode('utf8')))
+            single = FakeWriter()
+            main(dump, single, 0)
+            pipelined = FakeWriter()
+            main(dump, pipelined, 0, workers=2)
+            expat = FakeWriter()
+            main(dump, expat, 0, reader='expat')
+        self.assertEqual(single.results, pipelined.results)
+        self.assertEqual(single.results, expat.results)
+        self.assertEqual(len(pipelined.results), 2)
+
+    def test_incremental(self):
+        self.assertEqual(dump_date('/dumps/enwiki-20261016-pages-meta-hist-incr.xml.bz2'), '20261016')
+        with tempfile.TemporaryDirectory() as tmp:
+            dumps = []
+            for date in '20261016', '20261015':
+                dumps.append(os.path.join(tmp, 'enwiki-%s-pages-meta-hist-incr.xml.bz2' % date))
+                with open(dumps[-1], 'wb') as fout:
+                    fout.write(bz2.compress(DUMP.encode('utf8')))
+            cursor = FakeCursor(applied=['20261015'])
+            conn = FakeConnection()
+            main_incremental(dumps, conn, cursor, deletions=['Gone'])
+        statements = [sql for sql, _ in cursor.statements]
+        self.assertEqual(len(cursor.copied), 1)
+        self.assertEqual(conn.commits, 1)
+        self.assertTrue(any(sql.startswith('INSERT INTO wikipedia (title') and 'DO UPDATE SET' in sql for sql in statements))
+        self.assertIn(('DELETE FROM wikipedia WHERE title = ANY(%s)', (['Gone'],)), cursor.statements)
+        self.assertEqual(cursor.statements[-1][1], ('20261016', 2, 0))
+        with self.assertRaises(ValueError):
+            make_incremental_writers(FakeCursor(), wikitext='none')
+
+        # switching modes clears whatever the pages were stored with before
+        cursor = FakeCursor()
+        writer, _ = make_incremental_writers(cursor, wikitext='compressed')
+        writer.add(parse_page(('Anarchism', '12', 'An [[idea]].')))
+        writer.close()
+        (upsert,) = [sql for sql, _ in cursor.statements if sql.startswith('INSERT INTO wikipedia (')]
+        self.assertIn('wikitext_zlib = excluded.wikitext_zlib', upsert)
+        self.assertTrue(upsert.endswith(', wikitext = NULL, dump = NULL, stream_offset = NULL'))
+
+    def test_checkpoint_and_resume(self):
+        pages = DUMP[DUMP.index('  <page>') : DUMP.index('</mediawiki>')]
+        second = pages.index('  <page>', 10)
+        streams = [DUMP[: DUMP.index('  <page>')], pages[:second], pages[second:] + '</mediawiki>']
+        with tempfile.TemporaryDirectory() as tmp:
+            dump = os.path.join(tmp, 'dump-multistream.xml.bz2')
+            offsets = []
+            with open(dump, 'wb') as fout:
+                for stream in streams:
+                    offsets.append(fout.tell())
+                    fout.write(bz2.compress(stream.encode('utf8')))
+            stream_offset = {10: offsets[1], 12: offsets[2]}.get
+
+            fw = FakeWriter()
+            conn = FakeConnection()
+            cursor = FakeCursor()
+            checkpoint = Checkpoint(conn, cursor, dump, [fw], commit_every=1, stream_offset=stream_offset)
+            checkpoint.start()
+            main(dump, fw, 0, checkpoint=checkpoint)
+            self.assertEqual(len(fw.results), 2)
+            self.assertEqual(cursor.statements[-1][1], ('dump-multistream.xml.bz2', 12, offsets[2], 2))
+
+            # resume after the first page, starting at the stream holding it
+            fw = FakeWriter()
+            cursor = FakeCursor(checkpoint=(10, offsets[1], 1))
+            checkpoint = Checkpoint(conn, cursor, dump, [fw], stream_offset=stream_offset)
+            checkpoint.start(resume=True)
+            main(dump, fw, 0, workers=2, checkpoint=checkpoint, decompress_workers=2)
+            self.assertEqual([r['title'] for r in fw.results], ['Anarchism'])
+            self.assertEqual(checkpoint.pages, 2)
+
+    def test_wikitext_modes(self):
+        page = ('Anarchism', '12', "'''Anarchism''' is a [[political philosophy]].")
+        self.assertEqual(page_columns(wikitext='none')[3:5], ('dump', 'stream_offset'))
+        self.assertNotIn('wikitext', page_columns(wikitext='table'))
+
+        row = parse_page(page, wikitext='compressed')
+        self.assertEqual(get_wikitext(FakeCursor(checkpoint=(None, row[3], None, None)), 'Anarchism'), page[2])
+
+        rows = []
+        texts = []
+        writer = WikitextWriter(FakeRedirectWriter(rows), 'table', FakeRedirectWriter(texts))
+        writer.add(parse_page(page))
+        self.assertEqual(texts, [('Anarchism', page[2])])
+        self.assertEqual(rows[0][:4], ('Anarchism', 12, None, []))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            dump = os.path.join(tmp, 'dump-multistream.xml.bz2')
+            with open(dump, 'wb') as fout:
+                fout.write(bz2.compress(DUMP[: DUMP.index('  <page>')].encode('utf8')))
+                offset = fout.tell()
+                fout.write(bz2.compress(DUMP[DUMP.index('  <page>') : DUMP.index('</mediawiki>')].encode('utf8')))
+            rows = []
+            writer = WikitextWriter(FakeRedirectWriter(rows), 'none', dump=dump, stream_offset=lambda page_id: offset)
+            writer.add(parse_page(page, wikitext='none'))
+            self.assertEqual(rows[0][3:5], ('dump-multistream.xml.bz2', offset))
+            cursor = FakeCursor(checkpoint=(None, None, 'dump-multistream.xml.bz2', offset))
+            self.assertIn('[[political philosophy]]', get_wikitext(cursor, 'Anarchism', tmp))
+            # incremental imports don't record the stream offset
+            cursor = FakeCursor(checkpoint=(None, None, 'dump-multistream.xml.bz2', None))
+            with self.assertRaisesRegex(ValueError, 'index_db'):
+                get_wikitext(cursor, 'Anarchism', tmp)
+
     def test_extract_general(self):
         self.assertEqual(extact_general('something something dark'), None)
         self.assertEqual(extact_general('the streets of philadelpha'), 'the streets')
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+"""Timing, throughput and memory instrumentation shared by the importers.
+
+Code marks the stages it goes through with `with stage('parse'):`, counts what passes through a stage with
+count('parse', rows=1, nbytes=len(text)) and times the steps of an iterator with timed(). Stages can nest, the
+time of a stage includes that of the stages inside it. Only the current process is measured; work done in a pool
+shows up as the time spent waiting for its results.
+
+instrumented() wraps a whole run. At the end it prints a table with time, rows/sec and bytes/sec per stage and the
+peak memory, followed by a JSON summary (or writes that to --stats) to diff between runs. With --profile the run
+goes under cProfile and tracemalloc as well; the profile is saved to <name>.prof and the top entries printed.
+"""
+
+import contextlib
+import cProfile
+import json
+import pstats
+import resource
+import sys
+import time
+import tracemalloc
+
+PROFILE_TOP = 25
+TRACEMALLOC_TOP = 15
+
+
+class Stage:
+    def __init__(self):
+        self.seconds = 0.0
+        self.calls = 0
+        self.rows = 0
+        self.bytes = 0
+
+    def as_dict(self):
+        return {
+            'seconds': round(self.seconds, 3),
+            'calls': self.calls,
+            'rows': self.rows,
+            'bytes': self.bytes,
+            'rows_per_sec': round(self.rows / self.seconds, 1) if self.seconds and self.rows else None,
+            'bytes_per_sec': round(self.bytes / self.seconds, 1) if self.seconds and self.bytes else None,
+        }
+
+
+class Stats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.stages = {}
+        self.started = time.time()
+
+    def get(self, name):
+        if name not in self.stages:
+            self.stages[name] = Stage()
+        return self.stages[name]
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage = self.get(name)
+            stage.seconds += time.perf_counter() - start
+            stage.calls += 1
+
+    def count(self, name, rows=0, nbytes=0):
+        stage = self.get(name)
+        stage.rows += rows
+        stage.bytes += nbytes
+
+    def timed(self, iterable, name, size=None):
+        """Yield from iterable, timing each step as stage name and counting a row (and size(item) bytes) per item."""
+        stage = self.get(name)
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                stage.seconds += time.perf_counter() - start
+                return
+            stage.seconds += time.perf_counter() - start
+            stage.calls += 1
+            stage.rows += 1
+            if size:
+                stage.bytes += size(item)
+            yield item
+
+    def summary(self):
+        return {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'seconds': round(time.time() - self.started, 3),
+            'peak_rss_mb': peak_rss_mb(),
+            'peak_rss_children_mb': peak_rss_mb(resource.RUSAGE_CHILDREN),
+            'stages': {name: stage.as_dict() for name, stage in self.stages.items()},
+        }
+
+
+STATS = Stats()
+
+
+def stage(name):
+    return STATS.stage(name)
+
+
+def count(name, rows=0, nbytes=0):
+    STATS.count(name, rows, nbytes)
+
+
+def timed(iterable, name, size=None):
+    return STATS.timed(iterable, name, size)
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on linux
+    return round(resource.getrusage(who).ru_maxrss / 1024, 1)
+
+
+def format_rate(value, unit):
+    if value is None:
+        return '-'
+    for prefix in '', 'k', 'M', 'G':
+        if value < 1000:
+            break
+        value /= 1000
+    return '%.1f%s%s/s' % (value, prefix, unit)
+
+
+def print_summary(summary, out=sys.stdout):
+    print('%-24s %10s %10s %14s %14s' % ('stage', 'seconds', 'rows', 'rows/sec', 'bytes/sec'), file=out)
+    for name, stage in summary['stages'].items():
+        print(
+            '%-24s %10.1f %10d %14s %14s'
+            % (
+                name,
+                stage['seconds'],
+                stage['rows'],
+                format_rate(stage['rows_per_sec'], ''),
+                format_rate(stage['bytes_per_sec'], 'B'),
+            ),
+            file=out,
+        )
+    print(
+        'total %.1fs, peak rss %.1f MB (children %.1f MB)'
+        % (summary['seconds'], summary['peak_rss_mb'], summary['peak_rss_children_mb']),
+        file=out,
+    )
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        '--profile', action='store_true', help='run under cProfile and tracemalloc, the profile goes to <script>.prof'
+    )
+    parser.add_argument('--stats', type=str, help='write the JSON summary of the run to this file')
+
+
+@contextlib.contextmanager
+def instrumented(name, profile=False, stats_path=None):
+    """Instrument the run of script name, see the module docstring."""
+    STATS.reset()
+    profiler = None
+    if profile:
+        tracemalloc.start()
+        profiler = cProfile.Profile()
+        profiler.enable()
+    status = 'failed'
+    try:
+        yield STATS
+        status = 'ok'
+    finally:
+        summary = {'name': name, 'status': status}
+        summary.update(STATS.summary())
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(name + '.prof')
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(PROFILE_TOP)
+            snapshot = tracemalloc.take_snapshot()
+            print('top allocations:')
+            for stat in snapshot.statistics('lineno')[:TRACEMALLOC_TOP]:
+                print(' ', stat)
+            summary['tracemalloc_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+            tracemalloc.stop()
+        print_summary(summary)
+        if stats_path:
+            with open(stats_path, 'w') as fout:
+                json.dump(summary, fout, indent=2)
+        else:
+            print(json.dumps(summary))
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+import json
+import os
+import tempfile
+import unittest
+
+import instrument
+
+
+class TestInstrument(unittest.TestCase):
+    def test_stages(self):
+        stats = instrument.Stats()
+        with stats.stage('parse'):
+            stats.count('parse', rows=2, nbytes=10)
+        with stats.stage('parse'):
+            pass
+        self.assertEqual(list(stats.timed(['ab', 'cde'], 'read', len)), ['ab', 'cde'])
+        summary = stats.summary()
+        self.assertEqual(summary['stages']['parse']['calls'], 2)
+        self.assertEqual(summary['stages']['parse']['rows'], 2)
+        self.assertEqual(summary['stages']['read']['rows'], 2)
+        self.assertEqual(summary['stages']['read']['bytes'], 5)
+        self.assertGreater(summary['peak_rss_mb'], 0)
+
+    def test_instrumented(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                with instrument.instrumented('test_run', profile=True, stats_path='stats.json'):
+                    with instrument.stage('work'):
+                        instrument.count('work', 3)
+                with open('stats.json') as fin:
+                    summary = json.load(fin)
+                self.assertTrue(os.path.exists('test_run.prof'))
+            finally:
+                os.chdir(cwd)
+        self.assertEqual(summary['name'], 'test_run')
+        self.assertEqual(summary['status'], 'ok')
+        self.assertEqual(summary['stages']['work']['rows'], 3)
+        self.assertIn('tracemalloc_peak_mb', summary)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""Extract the English label of every entity in a local wikidata dump into an on-disk label store.
+
+The store is a NameMap file: the ids sorted as integers with the labels in one utf-8 blob, memory mapped by
+NameMap.load, so looking up millions of ids takes seconds and next to no memory. build_labels.py --label_store
+fills qid_label from it instead of asking a SPARQL endpoint.
+"""
+
+import argparse
+
+import instrument
+from import_wikidata import lazy_entity, map_batches, parse_wikidata, read_batches
+from name_map import NameMapBuilder
+
+
+def label_entity(line):
+    return lazy_entity(line, claims=False)
+
+
+def labels_batch(lines):
+    """(id, English label) for the entities in lines that have one."""
+    labels = []
+    for d in parse_wikidata(lines, label_entity):
+        label = d['labels'].get('en', {}).get('value')
+        if label:
+            labels.append((d['id'], label))
+    return labels
+
+
+def build_label_store(dump, path, workers=1, decompress_workers=1):
+    """Write the English labels in dump to a label store at path and return it opened."""
+    builder = NameMapBuilder()
+    count = 0
+    for labels in map_batches(labels_batch, read_batches(dump, decompress_workers=decompress_workers), workers):
+        for entity_id, label in labels:
+            builder[entity_id] = label
+        count += len(labels)
+        if count % 1000000 < len(labels):
+            print(count, 'labels')
+    with instrument.stage('write label store'):
+        return builder.build(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extract the English labels from a wikidata dump')
+    parser.add_argument(
+        '--workers', type=int, default=1, help='if larger than 1, decode the entities in this many processes'
+    )
+    parser.add_argument(
+        '--decompress_workers', type=int, default=1, help='if larger than 1, decompress the dump in this many threads'
+    )
+    parser.add_argument('dump', type=str, help='BZipped wikidata dump')
+    parser.add_argument('store', type=str, help='the label store to write')
+    instrument.add_arguments(parser)
+
+    args = parser.parse_args()
+    with instrument.instrumented('label_store', args.profile, args.stats):
+        store = build_label_store(args.dump, args.store, args.workers, args.decompress_workers)
+        print('%d labels in %s' % (len(store), args.store))
+        store.close()
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+
+import bz2
+import json
+import os
+import tempfile
+import unittest
+
+from import_wikidata_test import ENTITIES
+from label_store import build_label_store
+from name_map import NameMap
+
+
+class TestLabelStore(unittest.TestCase):
+    def test_build_label_store(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            dump = os.path.join(tmp, 'wikidata.json.bz2')
+            with open(dump, 'wb') as fout:
+                lines = ['[\n'] + [json.dumps(d) + ',\n' for d in ENTITIES] + [']\n']
+                fout.write(bz2.compress(''.join(lines).encode('utf8')))
+            path = os.path.join(tmp, 'labels')
+            for workers in 1, 2:
+                build_label_store(dump, path, workers).close()
+                store = NameMap.load(path)
+                self.assertEqual(len(store), len(ENTITIES))
+                # the label, not the enwiki title import_wikidata names Q3142 by
+                self.assertEqual(store.get('Q3142'), 'red')
+                self.assertEqual(store.get('P462'), 'color')
+                self.assertIsNone(store.get('Q404'))
+                store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""Random access to single pages in a multistream wikipedia dump.
+
+The pages-articles-multistream dumps are a concatenation of independent bz2 streams of about 100 pages each.
+The accompanying pages-articles-multistream-index.txt(.bz2) has a line offset:page_id:title for every page,
+where offset is the byte offset of the stream holding it. We load that into a small sqlite database once, after
+which fetching a page means seeking to its stream and decompressing just that stream.
+"""
+
+import argparse
+import bz2
+import os
+import sqlite3
+
+from import_wikipedia import iter_pages
+
+INDEX_BATCH_SIZE = 100000
+READ_SIZE = 256 * 1024
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS page (
+    title TEXT PRIMARY KEY,
+    page_id INTEGER NOT NULL,
+    offset INTEGER NOT NULL
+);
+"""
+
+
+def parse_index_line(line):
+    offset, page_id, title = line.rstrip('\n').split(':', 2)
+    return title, int(page_id), int(offset)
+
+
+def build_index(index_path, index_db):
+    """Load the multistream index text file into the sqlite database at index_db."""
+    opener = bz2.open if index_path.endswith('.bz2') else open
+    conn = sqlite3.connect(index_db)
+    conn.executescript(INDEX_SCHEMA)
+    batch = []
+    count = 0
+    with opener(index_path, 'rt', encoding='utf8') as fin:
+        for line in fin:
+            if not line.strip():
+                continue
+            batch.append(parse_index_line(line))
+            if len(batch) >= INDEX_BATCH_SIZE:
+                conn.executemany('INSERT OR REPLACE INTO page (title, page_id, offset) VALUES (?, ?, ?)', batch)
+                count += len(batch)
+                batch = []
+                print(count)
+    conn.executemany('INSERT OR REPLACE INTO page (title, page_id, offset) VALUES (?, ?, ?)', batch)
+    conn.execute('CREATE INDEX IF NOT EXISTS page_page_id ON page(page_id)')
+    conn.commit()
+    return conn
+
+
+def read_stream(fin, offset):
+    """Decompress the single bz2 stream starting at offset."""
+    fin.seek(offset)
+    decompressor = bz2.BZ2Decompressor()
+    chunks = []
+    while not decompressor.eof:
+        data = fin.read(READ_SIZE)
+        if not data:
+            break
+        chunks.append(decompressor.decompress(data))
+    return b''.join(chunks).decode('utf8')
+
+
+def stream_pages(xml):
+    """Yield the raw (title, wiki_id, wikitext) pages in the xml of one stream."""
+    start = xml.find('<page>')
+    end = xml.rfind('</page>')
+    if start == -1 or end == -1:
+        return
+    yield from iter_pages(['<mediawiki>', xml[start : end + len('</page>')], '</mediawiki>'])
+
+
+class MultistreamDump:
+    def __init__(self, dump, index_db, index_path=None):
+        """Open dump for random access. If index_db does not exist yet, it is built from index_path."""
+        if not os.path.exists(index_db):
+            if not index_path:
+                raise ValueError('%s does not exist and no multistream index file given to build it' % index_db)
+            self._index = build_index(index_path, index_db)
+        else:
+            self._index = sqlite3.connect(index_db)
+        self._dump = open(dump, 'rb')
+
+    def close(self):
+        self._dump.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def lookup(self, title=None, page_id=None):
+        """Return (title, page_id, offset) for a page or None if it is not in the index."""
+        if title is not None:
+            cur = self._index.execute('SELECT title, page_id, offset FROM page WHERE title = ?', (title,))
+        else:
+            cur = self._index.execute('SELECT title, page_id, offset FROM page WHERE page_id = ?', (page_id,))
+        return cur.fetchone()
+
+    def stream_offset(self, page_id):
+        """Offset of the bz2 stream holding page_id, or None if it is not in the index."""
+        found = self.lookup(page_id=page_id)
+        return found[2] if found else None
+
+    def get_page(self, title=None, page_id=None):
+        """Return the raw (title, wiki_id, wikitext) of a page or None if it can't be found."""
+        found = self.lookup(title, page_id)
+        if not found:
+            return None
+        title, page_id, offset = found
+        for page in stream_pages(read_stream(self._dump, offset)):
+            if page[0] == title:
+                return page
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fetch single pages from a multistream wikipedia dump')
+    parser.add_argument('--index', type=str, help='pages-articles-multistream-index.txt(.bz2), to build the index_db')
+    parser.add_argument('--index_db', type=str, required=True, help='sqlite file holding the title -> offset index')
+    parser.add_argument('--page_id', action='store_true', help='look up pages by page id rather than by title')
+    parser.add_argument('dump', type=str, help='pages-articles-multistream.xml.bz2')
+    parser.add_argument('pages', type=str, nargs='*', help='titles (or page ids) to print the wikitext of')
+
+    args = parser.parse_args()
+    with MultistreamDump(args.dump, args.index_db, args.index) as dump:
+        for page in args.pages:
+            if args.page_id:
+                found = dump.get_page(page_id=int(page))
+            else:
+                found = dump.get_page(title=page)
+            if found:
+                print(found[2])
+            else:
+                print('not found:', page)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+import bz2
+import os
+import tempfile
+import unittest
+
+from multistream import MultistreamDump
+
+HEADER = '<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" xml:lang="en">\n  <siteinfo>\n  </siteinfo>\n'
+FOOTER = '</mediawiki>\n'
+
+
+def page(title, page_id, text):
+    return (
+        '  <page>\n    <title>%s</title>\n    <ns>0</ns>\n    <id>%d</id>\n    <revision>\n      <id>%d</id>\n'
+        '      <text xml:space="preserve">%s</text>\n    </revision>\n  </page>\n'
+    ) % (title, page_id, page_id * 1000, text)
+
+
+class TestMultistream(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        streams = [
+            HEADER,
+            page('Anarchism', 12, "'''Anarchism''' is a [[political philosophy]]")
+            + page('Albedo', 39, 'Albedo is the measure of the diffuse reflection'),
+            page('Amsterdam', 40, '{{coord|52|22|N|4|54|E}}') + FOOTER,
+        ]
+        self.dump = os.path.join(self.tmp.name, 'dump.xml.bz2')
+        index = []
+        offset = 0
+        with open(self.dump, 'wb') as fout:
+            for idx, stream in enumerate(streams):
+                compressed = bz2.compress(stream.encode('utf8'))
+                fout.write(compressed)
+                if idx == 1:
+                    index += ['%d:12:Anarchism' % offset, '%d:39:Albedo' % offset]
+                elif idx == 2:
+                    index.append('%d:40:Amsterdam' % offset)
+                offset += len(compressed)
+        self.index = os.path.join(self.tmp.name, 'index.txt.bz2')
+        with bz2.open(self.index, 'wt') as fout:
+            fout.write('\n'.join(index) + '\n')
+        self.index_db = os.path.join(self.tmp.name, 'index.db')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_get_page(self):
+        with MultistreamDump(self.dump, self.index_db, self.index) as dump:
+            self.assertEqual(dump.get_page('Albedo'), ('Albedo', '39', 'Albedo is the measure of the diffuse reflection'))
+            self.assertEqual(dump.get_page(page_id=40)[0], 'Amsterdam')
+            self.assertIsNone(dump.get_page('Utrecht'))
+        # the second time around the index is already there
+        with MultistreamDump(self.dump, self.index_db) as dump:
+            self.assertEqual(dump.lookup('Anarchism')[1], 12)
+
+
+if __name__ == '__main__':
+    unittest.main()
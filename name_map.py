@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+"""Compact stand-ins for the id -> name dict and the set of seen titles import_wikidata keeps in memory.
+
+As python objects the names of the ~100M wikidata entities take well over 5Gb. NameMap keeps the numeric part of
+the ids (Q42, P31 and L7 all fit) in one sorted array of 32 bit ints and the names in a single utf-8 blob with an
+array of offsets into it; a lookup is a binary search. The few ids that don't fit that pattern go in a plain dict.
+A NameMap can be saved to a file and memory mapped from there, so it doesn't have to live on the heap at all and
+can be reused by a later import.
+
+NameMapBuilder collects the names in sorted runs of run_size and merges those at the end, so building never
+needs more than the arrays and one run of python objects. Given a path, the merged map is written there and
+memory mapped rather than built in memory a second time.
+
+TitleSet remembers 64 bit hashes of the titles in an open addressing table rather than the titles themselves.
+"""
+
+import bisect
+import hashlib
+import heapq
+import json
+import mmap
+import re
+import shutil
+import struct
+import tempfile
+from array import array
+from operator import itemgetter
+
+ID_RE = re.compile(r'([QPL])([0-9]+)$')
+ID_KINDS = 'QPL'
+MAX_KEY = 2 ** 32 - 1
+KEY_TYPE = 'I'
+OFFSET_TYPE = 'Q'
+DEFAULT_RUN_SIZE = 1 << 20
+WRITE_BATCH = 1 << 16
+
+MAGIC = b'NAMEMAP1'
+HEADER = struct.Struct('<8sQQ')
+
+
+def encode_id(entity_id):
+    """The integer key for entity_id or None if it doesn't have one."""
+    m = ID_RE.match(entity_id)
+    if not m:
+        return None
+    key = int(m.group(2)) * len(ID_KINDS) + ID_KINDS.index(m.group(1))
+    return key if key <= MAX_KEY else None
+
+
+class NameMap:
+    def __init__(self, keys, offsets, blob, other=None, mapped=None):
+        """keys are sorted, the name for keys[i] is blob[offsets[i]:offsets[i + 1]]."""
+        self._keys = keys
+        self._offsets = offsets
+        self._blob = blob
+        self._other = other or {}
+        self._mapped = mapped
+
+    def __len__(self):
+        return len(self._keys) + len(self._other)
+
+    def _find(self, key):
+        idx = bisect.bisect_left(self._keys, key)
+        if idx < len(self._keys) and self._keys[idx] == key:
+            return idx
+        return None
+
+    def get(self, entity_id, default=None):
+        key = encode_id(entity_id)
+        if key is None:
+            return self._other.get(entity_id, default)
+        idx = self._find(key)
+        if idx is None:
+            return default
+        return bytes(self._blob[self._offsets[idx] : self._offsets[idx + 1]]).decode('utf8')
+
+    def __contains__(self, entity_id):
+        key = encode_id(entity_id)
+        if key is None:
+            return entity_id in self._other
+        return self._find(key) is not None
+
+    def items(self):
+        """(key, utf-8 name) for the ids that have a key, in key order."""
+        for idx, key in enumerate(self._keys):
+            yield key, bytes(self._blob[self._offsets[idx] : self._offsets[idx + 1]])
+
+    def save(self, path):
+        write_map(path, self.items(), self._other)
+
+    @classmethod
+    def load(cls, path):
+        """Memory map a NameMap saved to path."""
+        with open(path, 'rb') as fin:
+            mapped = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, other_size = HEADER.unpack_from(mapped)
+        if magic != MAGIC:
+            raise ValueError('%s is not a saved NameMap' % path)
+        view = memoryview(mapped)
+        pos = HEADER.size
+        other = {}
+        if other_size:
+            other = json.loads(bytes(view[pos : pos + other_size]).decode('utf8'))
+        pos += other_size
+        keys = view[pos : pos + count * 4].cast(KEY_TYPE)
+        pos += count * 4
+        offsets = view[pos : pos + (count + 1) * 8].cast(OFFSET_TYPE)
+        pos += (count + 1) * 8
+        return cls(keys, offsets, view[pos:], other, mapped)
+
+    def close(self):
+        if self._mapped is not None:
+            self._keys = self._offsets = self._blob = None
+            self._mapped.close()
+            self._mapped = None
+
+
+class NameMapBuilder:
+    def __init__(self, run_size=DEFAULT_RUN_SIZE):
+        self._run_size = run_size
+        self._pending = []
+        self._runs = []
+        self._other = {}
+
+    def __setitem__(self, entity_id, name):
+        key = encode_id(entity_id)
+        if key is None:
+            self._other[entity_id] = name
+            return
+        self._pending.append((key, name.encode('utf8')))
+        if len(self._pending) >= self._run_size:
+            self._flush_run()
+
+    def _flush_run(self):
+        # a stable sort, so when an id comes by twice the last name wins, like it would in a dict
+        self._pending.sort(key=itemgetter(0))
+        self._runs.append(build_arrays(self._pending))
+        self._pending = []
+
+    def build(self, path=None):
+        """The NameMap with everything added, written to and memory mapped from path if given."""
+        if self._pending or not self._runs:
+            self._flush_run()
+
+        def iter_run(run):
+            keys, offsets, blob = run
+            for idx, key in enumerate(keys):
+                yield key, blob[offsets[idx] : offsets[idx + 1]]
+
+        def last_of_each_key(merged):
+            previous = None
+            for item in merged:
+                if previous is not None and previous[0] != item[0]:
+                    yield previous
+                previous = item
+            if previous is not None:
+                yield previous
+
+        runs, self._runs = self._runs, []
+        # heapq.merge keeps equal keys in the order of the runs, so the last one is the last one added
+        items = last_of_each_key(heapq.merge(*(iter_run(run) for run in runs), key=itemgetter(0)))
+        if path:
+            write_map(path, items, self._other)
+            return NameMap.load(path)
+        keys, offsets, blob = build_arrays(items)
+        return NameMap(keys, offsets, blob, self._other)
+
+
+def write_map(path, items, other):
+    """Write (key, utf-8 name) items in key order to path in the format NameMap.load reads."""
+    other = json.dumps(other).encode('utf8') if other else b''
+    count = 0
+    with tempfile.TemporaryFile() as keys_file, tempfile.TemporaryFile() as offsets_file:
+        with open(path, 'wb') as fout:
+            # the keys, offsets and blob are collected in temporary files and copied in after the header, which
+            # is filled in once we know the count
+            fout.write(HEADER.pack(MAGIC, 0, 0))
+            fout.write(other)
+            blob_file = tempfile.TemporaryFile()
+            keys = array(KEY_TYPE)
+            offsets = array(OFFSET_TYPE, [0])
+            offset = 0
+            with blob_file:
+                for key, name in items:
+                    keys.append(key)
+                    blob_file.write(name)
+                    offset += len(name)
+                    offsets.append(offset)
+                    count += 1
+                    if len(keys) >= WRITE_BATCH:
+                        keys.tofile(keys_file)
+                        offsets.tofile(offsets_file)
+                        keys = array(KEY_TYPE)
+                        offsets = array(OFFSET_TYPE)
+                keys.tofile(keys_file)
+                offsets.tofile(offsets_file)
+                for part in keys_file, offsets_file, blob_file:
+                    part.seek(0)
+                    shutil.copyfileobj(part, fout)
+            fout.seek(0)
+            fout.write(HEADER.pack(MAGIC, count, len(other)))
+
+
+def build_arrays(items):
+    keys = array(KEY_TYPE)
+    offsets = array(OFFSET_TYPE, [0])
+    blob = bytearray()
+    for key, name in items:
+        keys.append(key)
+        blob += name
+        offsets.append(len(blob))
+    return keys, offsets, blob
+
+
+class TitleSet:
+    """A set of titles that only keeps a 64 bit hash of each; a collision is in the order of one in 10^12."""
+
+    def __init__(self, capacity=1 << 16):
+        self._slots = array('Q', bytes(8 * capacity))
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    @staticmethod
+    def _hash(title):
+        # 0 marks an empty slot
+        return int.from_bytes(hashlib.blake2b(title.encode('utf8'), digest_size=8).digest(), 'little') or 1
+
+    def _slot(self, slots, value):
+        mask = len(slots) - 1
+        idx = value & mask
+        while slots[idx] and slots[idx] != value:
+            idx = (idx + 1) & mask
+        return idx
+
+    def __contains__(self, title):
+        return self._slots[self._slot(self._slots, self._hash(title))] != 0
+
+    def add(self, title):
+        value = self._hash(title)
+        idx = self._slot(self._slots, value)
+        if self._slots[idx]:
+            return
+        self._slots[idx] = value
+        self._count += 1
+        if self._count * 2 > len(self._slots):
+            slots = array('Q', bytes(16 * len(self._slots)))
+            for value in self._slots:
+                if value:
+                    slots[self._slot(slots, value)] = value
+            self._slots = slots
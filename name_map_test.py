@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+import os
+import tempfile
+import unittest
+
+from name_map import NameMap, NameMapBuilder, TitleSet, encode_id
+
+
+class TestNameMap(unittest.TestCase):
+    def names(self):
+        names = {'Q%d' % i: 'Name %d' % i for i in range(300, 0, -1)}
+        names.update({'P31': 'instance of', 'L7': 'lexeme', 'L7-F1': 'a form', 'Q42': 'Douglas Adams', 'Q5': 'mens'})
+        return names
+
+    def test_encode_id(self):
+        self.assertNotEqual(encode_id('Q31'), encode_id('P31'))
+        self.assertIsNone(encode_id('L7-F1'))
+        self.assertIsNone(encode_id('Q99999999999'))
+
+    def test_build(self):
+        names = self.names()
+        builder = NameMapBuilder(run_size=64)
+        for entity_id, name in names.items():
+            builder[entity_id] = name
+        # added twice, the last one wins like with a dict
+        builder['Q5'] = 'human'
+        names['Q5'] = 'human'
+        name_map = builder.build()
+        self.assertEqual(len(name_map), len(names))
+        for entity_id, name in names.items():
+            self.assertEqual(name_map.get(entity_id), name)
+            self.assertIn(entity_id, name_map)
+        self.assertIsNone(name_map.get('Q1000'))
+        self.assertNotIn('Q1000', name_map)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'names')
+            name_map.save(path)
+            loaded = NameMap.load(path)
+            self.assertEqual({entity_id: loaded.get(entity_id) for entity_id in names}, names)
+            loaded.close()
+
+            builder = NameMapBuilder(run_size=64)
+            for entity_id, name in names.items():
+                builder[entity_id] = name
+            mapped = builder.build(os.path.join(tmp, 'mapped'))
+            self.assertEqual(mapped.get('Q42'), 'Douglas Adams')
+            self.assertEqual(mapped.get('L7-F1'), 'a form')
+            mapped.close()
+
+    def test_title_set(self):
+        titles = TitleSet(capacity=4)
+        for i in range(100):
+            titles.add('Title %d' % i)
+        titles.add('Title 1')
+        self.assertEqual(len(titles), 100)
+        self.assertIn('Title 99', titles)
+        self.assertNotIn('Title 100', titles)
+
+
+if __name__ == '__main__':
+    unittest.main()
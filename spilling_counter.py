@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""A Counter for more keys than fit in memory.
+
+Counts are kept in a dict until its estimated size passes memory_budget bytes. The dict is then written to a
+temporary file as a run sorted by key and cleared. items() merges the runs and what is still in memory with a
+k-way merge, adding up the counts of equal keys, and yields them in key order. Merging holds only a chunk of
+each run in memory, so the peak stays around the budget however many keys there are.
+"""
+
+import heapq
+import pickle
+import sys
+import tempfile
+from operator import itemgetter
+
+# rough bytes a str key and int count take in a dict on top of the characters of the key
+ENTRY_OVERHEAD = 120
+# items pickled together in a run; reading back a run takes one such chunk at a time
+CHUNK_SIZE = 1 << 16
+
+
+def estimated_size(counts):
+    """Roughly the bytes the str keys and int counts in counts take."""
+    return sum(len(key) for key in counts) + len(counts) * ENTRY_OVERHEAD
+
+
+class SpillingCounter:
+    def __init__(self, memory_budget=None, spill_dir=None):
+        """memory_budget in bytes, None to never spill; runs go to temporary files in spill_dir."""
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        self._counts = {}
+        self._size = 0
+        self._runs = []
+
+    def add(self, key, count=1):
+        counts = self._counts
+        if key in counts:
+            counts[key] += count
+            return
+        counts[key] = count
+        self._size += len(key) + ENTRY_OVERHEAD
+        if self.memory_budget and self._size > self.memory_budget:
+            self.spill()
+
+    @property
+    def spills(self):
+        return len(self._runs)
+
+    def spill(self):
+        """Write what is in memory to a new sorted run."""
+        if not self._counts:
+            return
+        run = tempfile.TemporaryFile(dir=self.spill_dir)
+        items = sorted(self._counts.items())
+        for start in range(0, len(items), CHUNK_SIZE):
+            pickle.dump(items[start : start + CHUNK_SIZE], run, pickle.HIGHEST_PROTOCOL)
+        run.seek(0)
+        self._runs.append(run)
+        self._counts = {}
+        self._size = 0
+        print('spilled %d counts to run %d' % (len(items), len(self._runs)), file=sys.stderr)
+
+    def items(self):
+        """(key, total count) for all keys in key order. Consumes the runs; the counter is empty afterwards."""
+        runs, self._runs = self._runs, []
+        in_memory = sorted(self._counts.items())
+        self._counts = {}
+        self._size = 0
+        merged = heapq.merge(*[read_run(run) for run in runs], in_memory, key=itemgetter(0))
+        previous = None
+        total = 0
+        for key, count in merged:
+            if key != previous:
+                if previous is not None:
+                    yield previous, total
+                previous = key
+                total = 0
+            total += count
+        if previous is not None:
+            yield previous, total
+
+
+def read_run(run):
+    with run:
+        while True:
+            try:
+                chunk = pickle.load(run)
+            except EOFError:
+                return
+            yield from chunk
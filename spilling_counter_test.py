@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+import random
+import unittest
+from collections import Counter
+
+import spilling_counter
+from spilling_counter import SpillingCounter
+
+
+class TestSpillingCounter(unittest.TestCase):
+    def test_matches_counter(self):
+        rnd = random.Random(4)
+        expected = Counter()
+        # room for about 20 keys, so it spills all the time
+        counter = SpillingCounter(memory_budget=20 * (spilling_counter.ENTRY_OVERHEAD + 8))
+        for _ in range(5000):
+            key = 'Page %d' % rnd.randint(0, 500)
+            count = rnd.randint(1, 10)
+            expected[key] += count
+            counter.add(key, count)
+        self.assertGreater(counter.spills, 10)
+        self.assertEqual(list(counter.items()), sorted(expected.items()))
+        self.assertEqual(list(counter.items()), [])
+
+    def test_no_budget(self):
+        counter = SpillingCounter()
+        for key in 'banana':
+            counter.add(key)
+        self.assertEqual(counter.spills, 0)
+        self.assertEqual(list(counter.items()), [('a', 3), ('b', 1), ('n', 2)])
+
+    def test_chunks(self):
+        counter = SpillingCounter()
+        chunk_size, spilling_counter.CHUNK_SIZE = spilling_counter.CHUNK_SIZE, 3
+        try:
+            counter.add('x', 2)
+            for i in range(10):
+                counter.add('k%d' % i)
+            counter.spill()
+        finally:
+            spilling_counter.CHUNK_SIZE = chunk_size
+        counter.add('x', 5)
+        self.assertEqual(counter.spills, 1)
+        items = list(counter.items())
+        self.assertEqual(len(items), 11)
+        self.assertEqual(dict(items)['x'], 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""Create the tables the importers load into, optionally as a staged load.
+
+A plain load drops the live table and recreates it with all its indexes, so every insert pays for index
+maintenance and readers see an empty table until the import finishes. A staged load instead fills an unlogged
+<table>_staging that only has its primary key (ON CONFLICT DO NOTHING needs it to find duplicates). When the
+load is done the staging table is marked logged, the secondary indexes are built in parallel over separate
+connections and the result is swapped in for the live table with a rename in a single transaction.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+
+import instrument
+
+STAGING_SUFFIX = '_staging'
+DEFAULT_INDEX_WORKERS = 4
+
+
+class TableLoad:
+    def __init__(self, table, columns_sql, indexes, staged=False):
+        """columns_sql is the column list for CREATE TABLE, indexes a list of (name, definition) where the index
+        is created as CREATE INDEX <table>_<name> ON <table> <definition>."""
+        self.table = table
+        self.columns_sql = columns_sql
+        self.indexes = indexes
+        self.staged = staged
+        self.target = table + STAGING_SUFFIX if staged else table
+
+    def index_sql(self, table, name, definition, if_not_exists=False):
+        return 'CREATE INDEX %s%s_%s ON %s %s' % (
+            'IF NOT EXISTS ' if if_not_exists else '', table, name, table, definition)
+
+    def ensure(self, cursor):
+        """Create the live table and its indexes if they aren't there yet, for updating the table in place."""
+        cursor.execute('CREATE TABLE IF NOT EXISTS %s %s' % (self.table, self.columns_sql))
+        for name, definition in self.indexes:
+            cursor.execute(self.index_sql(self.table, name, definition, if_not_exists=True))
+
+    def create(self, cursor):
+        cursor.execute('DROP TABLE IF EXISTS %s' % self.target)
+        if not self.staged:
+            cursor.execute('CREATE TABLE %s %s' % (self.target, self.columns_sql))
+            for name, definition in self.indexes:
+                cursor.execute(self.index_sql(self.target, name, definition))
+        else:
+            cursor.execute('CREATE UNLOGGED TABLE %s %s' % (self.target, self.columns_sql))
+
+    def build_index(self, connection_string, name, definition):
+        conn = psycopg2.connect(connection_string)
+        try:
+            cursor = conn.cursor()
+            cursor.execute(self.index_sql(self.target, name, definition))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def finish(self, conn, connection_string, index_workers=DEFAULT_INDEX_WORKERS):
+        """Commit the load and, for a staged load, index the staging table and swap it in."""
+        self.prepare(conn, connection_string, index_workers)
+        self.swap(conn.cursor())
+        conn.commit()
+
+    def prepare(self, conn, connection_string, index_workers=DEFAULT_INDEX_WORKERS):
+        """For a staged load, commit it and index the staging table, so all that is left is to swap it in."""
+        if not self.staged:
+            return
+        conn.commit()
+        cursor = conn.cursor()
+        # SET LOGGED rewrites the table and any indexes on it, so do it before building the indexes
+        print('marking %s logged' % self.target)
+        with instrument.stage('set logged ' + self.table):
+            cursor.execute('ALTER TABLE %s SET LOGGED' % self.target)
+            conn.commit()
+
+        print('building %d indexes on %s' % (len(self.indexes), self.target))
+        with instrument.stage('index ' + self.table), ThreadPoolExecutor(max(1, index_workers)) as executor:
+            futures = [
+                executor.submit(self.build_index, connection_string, name, definition)
+                for name, definition in self.indexes
+            ]
+            for future in futures:
+                future.result()
+
+    def swap(self, cursor):
+        """Swap a prepared staging table in for the live one, in the transaction of cursor, which the caller commits."""
+        if not self.staged:
+            return
+        print('swapping %s in for %s' % (self.target, self.table))
+        cursor.execute('DROP TABLE IF EXISTS %s' % self.table)
+        cursor.execute('ALTER TABLE %s RENAME TO %s' % (self.target, self.table))
+        cursor.execute('ALTER INDEX IF EXISTS %s_pkey RENAME TO %s_pkey' % (self.target, self.table))
+        for name, _ in self.indexes:
+            cursor.execute('ALTER INDEX %s_%s RENAME TO %s_%s' % (self.target, name, self.table, name))
+        self.target = self.table
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+import unittest
+
+from staged_load import TableLoad
+
+
+class FakeCursor:
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, sql, params=None):
+        self.statements.append(sql)
+
+
+class TestStagedLoad(unittest.TestCase):
+    def test_create_live(self):
+        cursor = FakeCursor()
+        load = TableLoad('wikistats', '(title TEXT PRIMARY KEY)', [('viewcount', '(viewcount)')])
+        load.create(cursor)
+        self.assertEqual(load.target, 'wikistats')
+        self.assertEqual(
+            cursor.statements,
+            [
+                'DROP TABLE IF EXISTS wikistats',
+                'CREATE TABLE wikistats (title TEXT PRIMARY KEY)',
+                'CREATE INDEX wikistats_viewcount ON wikistats (viewcount)',
+            ],
+        )
+
+    def test_create_staged(self):
+        cursor = FakeCursor()
+        load = TableLoad('wikistats', '(title TEXT PRIMARY KEY)', [('viewcount', '(viewcount)')], staged=True)
+        load.create(cursor)
+        self.assertEqual(load.target, 'wikistats_staging')
+        self.assertEqual(
+            cursor.statements,
+            ['DROP TABLE IF EXISTS wikistats_staging', 'CREATE UNLOGGED TABLE wikistats_staging (title TEXT PRIMARY KEY)'],
+        )
+
+    def test_swap(self):
+        cursor = FakeCursor()
+        load = TableLoad('wikistats', '(title TEXT PRIMARY KEY)', [('viewcount', '(viewcount)')], staged=True)
+        load.swap(cursor)
+        self.assertEqual(load.target, 'wikistats')
+        self.assertEqual(
+            cursor.statements,
+            [
+                'DROP TABLE IF EXISTS wikistats',
+                'ALTER TABLE wikistats_staging RENAME TO wikistats',
+                'ALTER INDEX IF EXISTS wikistats_staging_pkey RENAME TO wikistats_pkey',
+                'ALTER INDEX wikistats_staging_viewcount RENAME TO wikistats_viewcount',
+            ],
+        )
+        # a live load has nothing to swap
+        cursor = FakeCursor()
+        TableLoad('wikistats', '(title TEXT PRIMARY KEY)', []).swap(cursor)
+        self.assertEqual(cursor.statements, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
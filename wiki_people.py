@@ -12,39 +12,39 @@ import psycopg2.extras
 import yaml
 from shapely import wkt
 
+import instrument
+from bulk_writer import BulkWriter
+from import_wikipedia import extract_features
+from staged_load import DEFAULT_INDEX_WORKERS, TableLoad
+
 
-WORD_RE = re.compile(r'\w+')
 CAT_PREFIX = 'Category:'
 DIED_POSTFIX = ' deaths'
 BIRTH_POSTFIX = ' births'
 
-
-def setup_db(connection_string):
+TABLE_COLUMNS = ('('
+                 '    person_name TEXT PRIMARY KEY,'
+                 '    view_count INTEGER,'
+                 '    word_count INTEGER,'
+                 '    year_born INTEGER,'
+                 '    year_died INTEGER, '
+                 '    gender TEXT,'
+                 '    occupation TEXT,'
+                 '    field TEXT,'
+                 '    country_code TEXT,'
+                 '    continent TEXT'
+                 ')')
+TABLE_INDEXES = [(column, '(%s)' % column) for column in (
+    'view_count', 'word_count', 'year_born', 'gender', 'country_code', 'continent', 'occupation', 'field')]
+
+
+def setup_db(connection_string, staged=False):
     conn = psycopg2.connect(connection_string)
     cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cursor.execute('DROP TABLE IF EXISTS wikitrends')
-    cursor.execute('CREATE TABLE wikitrends ('
-                   '    person_name TEXT PRIMARY KEY,'
-                   '    view_count INTEGER,'
-                   '    word_count INTEGER,'
-                   '    year_born INTEGER,'
-                   '    year_died INTEGER, '
-                   '    gender TEXT,'
-                   '    occupation TEXT,'
-                   '    field TEXT,'
-                   '    country_code TEXT,'
-                   '    continent TEXT'
-                   ')')
-    cursor.execute('CREATE INDEX wikitrends_view_count ON wikitrends(view_count)')
-    cursor.execute('CREATE INDEX wikitrends_word_count ON wikitrends(word_count)')
-    cursor.execute('CREATE INDEX wikitrends_year_born ON wikitrends(year_born)')
-    cursor.execute('CREATE INDEX wikitrends_gender ON wikitrends(gender)')
-    cursor.execute('CREATE INDEX wikitrends_country_code ON wikitrends(country_code)')
-    cursor.execute('CREATE INDEX wikitrends_continent ON wikitrends(continent)')
-    cursor.execute('CREATE INDEX wikitrends_occupation ON wikitrends(occupation)')
-    cursor.execute('CREATE INDEX wikitrends_field ON wikitrends(field)')
-
-    return conn, cursor
+    load = TableLoad('wikitrends', TABLE_COLUMNS, TABLE_INDEXES, staged)
+    load.create(cursor)
+
+    return conn, cursor, load
 
 
 def tolerant_int(s):
@@ -55,29 +55,21 @@ def tolerant_int(s):
 
 
 def parse_person(rec):
-    wikitext = rec['wikitext']
-    parsed = mwparserfromhell.parse(wikitext)
-
-    words = [w.lower() for w in WORD_RE.findall(parsed.strip_code())]
-    word_count = len(words)
-    word_counts = Counter(words)
-    gender_words = {w: word_counts[w] for w in ('him', 'his', 'he', 'her', 'she')}
-
-    res = {}
-    for template in parsed.filter_templates():
-        if template.name.lower().startswith('infobox'):
-            for param in template.params:
-                res[param.name.strip().lower()] = param.value
-    wikilinks = [str(x.title) for x in parsed.filter_wikilinks()]
+    if rec.get('wikilinks') is not None:
+        # imported with --features, no need to parse the wikitext again
+        word_count, gender_words, res = rec['word_count'], rec['pronouns'], rec['infobox_params']
+        wikilinks = rec['wikilinks']
+    else:
+        word_count, gender_words, res, wikilinks = extract_features(mwparserfromhell.parse(rec['wikitext']))
+
     locations = []
     for k in 'birth_place', 'death_place':
         if k in res:
-            locations += [str(x.title) for x in res[k].filter_wikilinks()]
+            locations += [str(x.title) for x in mwparserfromhell.parse(res[k]).filter_wikilinks()]
 
     born = None
     died = None
-    for wl in parsed.filter_wikilinks():
-        title = str(wl.title)
+    for title in wikilinks:
         if title.startswith(CAT_PREFIX):
             if title.endswith(BIRTH_POSTFIX):
                 born = tolerant_int(title[len(CAT_PREFIX): -len(BIRTH_POSTFIX)])
@@ -107,12 +99,16 @@ def fetch_people(json_dir, cursor, max_year, min_year):
             q = ("SELECT wikipedia.*, wikistats.viewcount "
                  "FROM wikipedia LEFT JOIN wikistats ON wikipedia.title = wikistats.title "
                  "WHERE categories @> ARRAY['%s']") % cat
-            cursor.execute(q)
+            with instrument.stage('query'):
+                cursor.execute(q)
+                rows = cursor.fetchall()
             people = []
-            for r in cursor.fetchall():
+            for r in rows:
                 if len(people) % 100 == 0:
                     print(' ', r['title'])
-                people.append(parse_person(r))
+                with instrument.stage('parse people'):
+                    people.append(parse_person(r))
+                instrument.count('parse people', 1)
             with open(json_path, 'w') as fout:
                 json.dump(people, fout, indent=2)
         all_people += people
@@ -214,25 +210,28 @@ def add_fields(people):
         p['occupation'] = occupation_count.most_common(1)[0][0] if occupation_count else ''
 
 
-def main(json_dir, cursor, min_year=-2000, max_year=2000):
-    people = fetch_people(json_dir, cursor, max_year, min_year)
+def main(json_dir, cursor, min_year=-2000, max_year=2000, table='wikitrends'):
+    with instrument.stage('fetch people'):
+        people = fetch_people(json_dir, cursor, max_year, min_year)
     print('assigning genders')
-    assign_genders(people)
+    with instrument.stage('assign genders'):
+        assign_genders(people)
     print('finding locations')
-    find_locations(people)
+    with instrument.stage('find locations'):
+        find_locations(people)
     print('adding fields')
-    add_fields(people)
+    with instrument.stage('add fields'):
+        add_fields(people)
     print('inserting data')
     seen = set()
-    for p in people:
-        if p['person_name'] in seen or p['born'] < 200 or (p['died'] and p['died'] < 200):
-            continue
-        seen.add(p['person_name'])
-        cursor.execute("INSERT INTO wikitrends "
-                       "(person_name, view_count, year_born, year_died, word_count, gender, "
-                       "continent, country_code, occupation, field) "
-                       "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
-                       (p['person_name'], p['view_count'],
+    columns = ('person_name', 'view_count', 'year_born', 'year_died', 'word_count', 'gender',
+               'continent', 'country_code', 'occupation', 'field')
+    with BulkWriter(cursor, table, columns) as writer:
+        for p in people:
+            if p['person_name'] in seen or p['born'] < 200 or (p['died'] and p['died'] < 200):
+                continue
+            seen.add(p['person_name'])
+            writer.add((p['person_name'], p['view_count'],
                         p['born'], p['died'],
                         p['word_count'], p['gender'],
                         p['continent'], p['country_code'], p['occupation'], p['field']))
@@ -241,14 +240,20 @@ def main(json_dir, cursor, min_year=-2000, max_year=2000):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Import wikidata into postgress')
     parser.add_argument('--postgres', type=str, help='postgres connection string')
+    parser.add_argument('--staged', action='store_true',
+                        help='load into an unlogged staging table and swap it in when done')
+    parser.add_argument('--index_workers', type=int, default=DEFAULT_INDEX_WORKERS,
+                        help='parallel index builds for --staged')
     parser.add_argument('json_dir', type=str, help='directory to store intermediate jsons')
+    instrument.add_arguments(parser)
 
     args = parser.parse_args()
-    conn, cursor = setup_db(args.postgres)
+    with instrument.instrumented('wiki_people', args.profile, args.stats):
+        conn, cursor, load = setup_db(args.postgres, args.staged)
 
-    if not os.path.isdir(args.json_dir):
-        os.makedirs(args.json_dir)
+        if not os.path.isdir(args.json_dir):
+            os.makedirs(args.json_dir)
 
-    main(args.json_dir, cursor)
+        main(args.json_dir, cursor, table=load.target)
 
-    conn.commit()
+        load.finish(conn, args.postgres, args.index_workers)